@@ -12,6 +12,7 @@
 #    under the License.
 
 from manuka.api.v1.resources import external_id
+from manuka.api.v1.resources import idp_domain_mapping
 from manuka.api.v1.resources import user
 
 
@@ -21,7 +22,12 @@ def initialize_resources(api):
     api.add_resource(user.PendingUserList, '/v1/pending-users/')
     api.add_resource(user.PendingUser, '/v1/pending-users/<id>/')
     api.add_resource(user.UserSearch, '/v1/users/search/')
+    api.add_resource(user.UserExport, '/v1/users/export/')
     api.add_resource(user.RefreshOrcid, '/v1/users/<id>/refresh-orcid/')
     api.add_resource(user.ProjectsWithRole,
                      '/v1/users/<id>/projects/<role_name>/')
     api.add_resource(external_id.ExternalId, '/v1/external-ids/<id>/')
+    api.add_resource(idp_domain_mapping.IdpDomainMappingList,
+                     '/v1/idp-domain-mappings/')
+    api.add_resource(idp_domain_mapping.IdpDomainMapping,
+                     '/v1/idp-domain-mappings/<id>/')
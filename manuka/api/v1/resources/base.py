@@ -11,19 +11,98 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import base64
+import binascii
+import functools
+import json
+from urllib import parse
+
 import flask
 from flask import request
 import flask_restful
+from oslo_config import cfg
+import sqlalchemy
+from sqlalchemy import orm
 
+from manuka.api.v1.schemas import compiled
+from manuka.common import cache
 from manuka.common import keystone
+from manuka.extensions import db
 from manuka import policy
 
 
+CONF = cfg.CONF
+
 API_LIMIT = 1000
 
+# Totals for with_total=estimated, keyed by the SQL and parameters of
+# the filtered query
+_count_cache = cache.TTLCache(lambda: CONF.api.count_cache_ttl)
+
+
+def add_pagination_arguments(parser):
+    """Add the query arguments understood by Resource.paginate"""
+    parser.add_argument('limit', type=int, location='args')
+    parser.add_argument('cursor', location='args')
+    parser.add_argument('with_total', location='args', default='true',
+                        choices=('true', 'false', 'estimated'))
+
+
+def add_fields_argument(parser):
+    """Add the sparse fieldset argument understood by Resource.sparse"""
+    parser.add_argument('fields', location='args')
+
+
+@functools.lru_cache(maxsize=128)
+def _sparse_schema(schema_class, many, only):
+    return schema_class(many=many, only=only)
+
+
+def encode_cursor(value):
+    data = json.dumps([value]).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        data = base64.urlsafe_b64decode(cursor.encode('ascii'))
+        value, = json.loads(data.decode('utf-8'))
+    except (binascii.Error, UnicodeError, ValueError, TypeError):
+        flask_restful.abort(400, message="Invalid cursor")
+    return value
+
+
+def _page_number():
+    try:
+        page = int(request.args.get('page', 1))
+    except (TypeError, ValueError):
+        flask.abort(404)
+    if page < 1:
+        flask.abort(404)
+    return page
+
+
+def count(query):
+    return query.order_by(None).count()
+
+
+def estimated_count(query):
+    """A COUNT(*) of query, cached for [api] count_cache_ttl seconds"""
+    compiled_query = query.statement.compile(dialect=db.engine.dialect)
+    key = (str(compiled_query), repr(sorted(compiled_query.params.items())))
+    total = _count_cache.get(key)
+    if total is None:
+        total = count(query)
+        _count_cache.set(key, total)
+    return total
+
 
 class Resource(flask_restful.Resource):
 
+    # Name of a unique, indexed column used to seek through results
+    # when the client asks for cursor based pagination
+    cursor_column = None
+
     def authorize(self, rule, target={}, do_raise=True):
         rule = self.POLICY_PREFIX % rule
         enforcer = policy.get_enforcer()
@@ -33,16 +112,99 @@ class Resource(flask_restful.Resource):
     def oslo_context(self):
         return flask.request.environ.get(keystone.REQUEST_CONTEXT_ENV, None)
 
-    def paginate(self, query, args):
+    def sparse(self, query, args, required=()):
+        """Restrict a query and the schema to the requested fields
+
+        ?fields=email,state returns only those fields, loads only the
+        columns they need and skips the join for any relationship (such
+        as external_ids) that wasn't asked for.
+
+        Return the query and the schema to dump its results with.
+        """
+        if not args.get('fields'):
+            return query, self.schema
+
+        fields = [f.strip() for f in args['fields'].split(',') if f.strip()]
+        unknown = sorted(set(fields) - set(self.schema.fields))
+        if unknown:
+            flask_restful.abort(
+                400, message="Unknown fields: %s" % ', '.join(unknown))
+
+        entity = query.column_descriptions[0]['entity']
+        mapper = sqlalchemy.inspect(entity)
+        attrs = {self.schema.fields[f].attribute or f for f in fields}
+        attrs.update(required)
+        if self.cursor_column:
+            attrs.add(self.cursor_column)
+        columns = [a for a in attrs if a in mapper.column_attrs]
+        options = [orm.load_only(*columns)]
+        for rel in mapper.relationships:
+            if rel.key not in attrs:
+                options.append(orm.lazyload(rel.key))
+        query = query.options(*options)
+
+        schema = _sparse_schema(self.schema.__class__, self.schema.many,
+                                tuple(fields))
+        return query, schema
+
+    def paginate(self, query, args, schema=None):
+        """Return a page of results
+
+        ?with_total=false skips the COUNT(*) of the whole result set and
+        ?with_total=estimated returns a recently cached count instead.
+        """
         limit = args.get('limit')
         if limit is None:
             limit = API_LIMIT
+        elif limit < 0:
+            flask.abort(404)
+        if schema is None:
+            schema = self.schema
+
+        if args.get('cursor') is not None:
+            return self.paginate_by_cursor(query, args.get('cursor'), limit,
+                                           schema)
+
+        # Fetch one row more than asked for to tell whether there is a
+        # next page without needing the total
+        page = _page_number()
+        items = query.limit(limit + 1).offset((page - 1) * limit).all()
+        if not items and page != 1:
+            flask.abort(404)
+
+        response = {'results': compiled.dump(schema, items[:limit])}
+        with_total = args.get('with_total') or 'true'
+        if with_total == 'true':
+            response['total'] = count(query)
+        elif with_total == 'estimated':
+            response['total'] = estimated_count(query)
+
+        if limit and len(items) > limit:
+            next_args = request.args.to_dict()
+            next_args['page'] = page + 1
+            response['next'] = "%s?%s" % (request.base_url,
+                                          parse.urlencode(next_args))
+        return response
+
+    def paginate_by_cursor(self, query, cursor, limit, schema):
+        """Keyset pagination
 
-        items = query.paginate(per_page=limit)
-        response = {'results': self.schema.dump(items.items),
-                    'total': items.total}
+        Rather than OFFSET/LIMIT and a COUNT(*) of the whole result
+        set, seek past the last row of the previous page using the
+        (indexed) cursor column. An empty cursor starts at the
+        beginning. No total is returned in this mode.
+        """
+        entity = query.column_descriptions[0]['entity']
+        column = getattr(entity, self.cursor_column)
+        if cursor:
+            query = query.filter(column > decode_cursor(cursor))
+        items = query.order_by(None).order_by(column).limit(limit + 1).all()
 
-        if items.has_next:
-            response['next'] = "%s?page=%s" % (request.base_url,
-                                               items.next_num)
+        response = {'results': compiled.dump(schema, items[:limit])}
+        if limit and len(items) > limit:
+            last = getattr(items[limit - 1], self.cursor_column)
+            next_args = request.args.to_dict()
+            next_args['cursor'] = encode_cursor(last)
+            response['next'] = "%s?%s" % (request.base_url,
+                                          parse.urlencode(next_args))
         return response
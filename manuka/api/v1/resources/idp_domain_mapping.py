@@ -0,0 +1,132 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import datetime
+
+from flask import request
+import flask_restful
+from flask_restful import reqparse
+import marshmallow
+from oslo_log import log as logging
+from oslo_policy import policy
+import sqlalchemy
+
+from manuka.api.v1.resources import base
+from manuka.api.v1.schemas import idp_domain_mapping as schemas
+from manuka.common import idp_domains
+from manuka.common import policies
+from manuka.extensions import db
+from manuka import models
+
+
+LOG = logging.getLogger(__name__)
+
+
+class IdpDomainMappingList(base.Resource):
+
+    POLICY_PREFIX = policies.IDP_DOMAIN_MAPPING_PREFIX
+    schema = schemas.idp_domain_mappings
+    cursor_column = 'idp'
+
+    def get(self):
+        try:
+            self.authorize('list')
+        except policy.PolicyNotAuthorized:
+            flask_restful.abort(403, message="Not authorised")
+
+        parser = reqparse.RequestParser()
+        parser.add_argument('domain', location='args')
+        base.add_pagination_arguments(parser)
+        args = parser.parse_args()
+
+        query = db.session.query(models.IdpDomainMapping)
+        if args.get('domain'):
+            query = query.filter_by(domain=args['domain'])
+        query = query.order_by(models.IdpDomainMapping.idp)
+        return self.paginate(query, args)
+
+    def post(self):
+        try:
+            self.authorize('create')
+        except policy.PolicyNotAuthorized:
+            flask_restful.abort(403, message="Not authorised")
+
+        data = request.get_json()
+        try:
+            mapping = schemas.idp_domain_mapping.load(data)
+        except marshmallow.ValidationError as e:
+            flask_restful.abort(400, message=e.messages)
+
+        db.session.add(mapping)
+        try:
+            db.session.commit()
+        except sqlalchemy.exc.IntegrityError:
+            db.session.rollback()
+            flask_restful.abort(
+                409, message="IdP {} is already mapped".format(data['idp']))
+        idp_domains.invalidate(mapping.idp)
+        LOG.info("Mapped IdP %s to domain %s", mapping.idp, mapping.domain)
+        return schemas.idp_domain_mapping.dump(mapping), 201
+
+
+class IdpDomainMapping(base.Resource):
+
+    POLICY_PREFIX = policies.IDP_DOMAIN_MAPPING_PREFIX
+    schema = schemas.idp_domain_mapping
+
+    def _get_mapping(self, id):
+        return db.session.query(models.IdpDomainMapping).filter_by(
+            id=id).first_or_404()
+
+    def get(self, id):
+        try:
+            self.authorize('get')
+        except policy.PolicyNotAuthorized:
+            flask_restful.abort(
+                404, message="IdP domain mapping {} doesn't exist".format(id))
+
+        return self.schema.dump(self._get_mapping(id))
+
+    def patch(self, id):
+        try:
+            self.authorize('update')
+        except policy.PolicyNotAuthorized:
+            flask_restful.abort(
+                404, message="IdP domain mapping {} doesn't exist".format(id))
+
+        mapping = self._get_mapping(id)
+        data = request.get_json()
+        errors = schemas.idp_domain_mapping_update.validate(data)
+        if errors:
+            flask_restful.abort(400, message=errors)
+
+        mapping = schemas.idp_domain_mapping_update.load(data,
+                                                         instance=mapping)
+        mapping.updated_at = datetime.datetime.now()
+        db.session.commit()
+        idp_domains.invalidate(mapping.idp)
+        return self.schema.dump(mapping)
+
+    def delete(self, id):
+        try:
+            self.authorize('delete')
+        except policy.PolicyNotAuthorized:
+            flask_restful.abort(
+                404, message="IdP domain mapping {} doesn't exist".format(id))
+
+        mapping = self._get_mapping(id)
+        idp = mapping.idp
+        db.session.delete(mapping)
+        db.session.commit()
+        idp_domains.invalidate(idp)
+        return '', 204
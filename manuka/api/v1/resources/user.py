@@ -11,19 +11,28 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import csv
+import io
+import json
+
+import flask
 from flask import request
 import flask_restful
 from flask_restful import reqparse
 from oslo_log import log as logging
 from oslo_policy import policy
+from sqlalchemy import orm
 
 from manuka.api.v1.resources import base
+from manuka.api.v1.schemas import compiled
 from manuka.api.v1.schemas import user as schemas
 from manuka.common import clients
 from manuka.common import keystone
+from manuka.common import keystone_cache
 from manuka.common import policies
 from manuka.extensions import db
 from manuka import models
+from manuka import search as search_backend
 from manuka.worker import utils
 
 
@@ -34,26 +43,19 @@ class UserList(base.Resource):
 
     POLICY_PREFIX = policies.USER_PREFIX
     schema = schemas.users
+    cursor_column = 'keystone_user_id'
 
     def _get_users(self):
         return db.session.query(models.User) \
             .filter(models.User.keystone_user_id.isnot(None))
 
-    def get(self, **kwargs):
-        try:
-            self.authorize('list')
-        except policy.PolicyNotAuthorized:
-            flask_restful.abort(403, message="Not authorised")
-
-        parser = reqparse.RequestParser()
+    def _add_filter_arguments(self, parser):
         parser.add_argument('registered_at__lt', location='args')
         parser.add_argument('last_login__lt', location='args')
         parser.add_argument('state', location='args')
         parser.add_argument('expiry_status', location='args')
-        parser.add_argument('limit', type=int, location='args')
-        args = parser.parse_args()
 
-        query = self._get_users()
+    def _filter_users(self, query, args):
         registered_at__lt = args.get('registered_at__lt')
         last_login__lt = args.get('last_login__lt')
 
@@ -76,14 +78,113 @@ class UserList(base.Resource):
             else:
                 query = query.filter(
                     models.User.expiry_status == args.get('expiry_status'))
+        return query
+
+    def get(self, **kwargs):
+        try:
+            self.authorize('list')
+        except policy.PolicyNotAuthorized:
+            flask_restful.abort(403, message="Not authorised")
+
+        parser = reqparse.RequestParser()
+        self._add_filter_arguments(parser)
+        base.add_pagination_arguments(parser)
+        base.add_fields_argument(parser)
+        args = parser.parse_args()
+
+        query = self._filter_users(self._get_users(), args)
         query = query.order_by(models.User.keystone_user_id)
-        return self.paginate(query, args)
+        query, schema = self.sparse(query, args)
+        return self.paginate(query, args, schema)
+
+
+class UserExport(UserList):
+    """Stream every matching user as NDJSON or CSV
+
+    Rows are fetched in keyset-paginated batches and serialised one at
+    a time, so memory use doesn't grow with the size of the user table.
+    Each batch is read in full before the next query; an open streaming
+    cursor (yield_per) would break selectinload on MySQL.
+    """
+
+    BATCH_SIZE = 500
+
+    def get(self):
+        try:
+            self.authorize('export')
+        except policy.PolicyNotAuthorized:
+            flask_restful.abort(403, message="Not authorised")
+
+        parser = reqparse.RequestParser()
+        self._add_filter_arguments(parser)
+        parser.add_argument('format', choices=('ndjson', 'csv'),
+                            default='ndjson', location='args')
+        base.add_fields_argument(parser)
+        args = parser.parse_args()
+
+        query = self._filter_users(self._get_users(), args)
+        query, schema = self.sparse(query, args)
+        if args['format'] == 'csv':
+            # External IDs don't fit in a flat row, so they aren't
+            # loaded or dumped at all
+            query = query.options(orm.lazyload(models.User.external_ids))
+            schema = schema.__class__(only=schema.only,
+                                      exclude=('external_ids',))
+        else:
+            if 'external_ids' in schema.fields:
+                query = query.options(
+                    orm.selectinload(models.User.external_ids))
+            else:
+                query = query.options(
+                    orm.lazyload(models.User.external_ids))
+            schema = schema.__class__(only=schema.only)
+        if args['format'] == 'csv':
+            rows = self._csv_rows(query, schema)
+            mimetype = 'text/csv'
+        else:
+            rows = self._ndjson_rows(query, schema)
+            mimetype = 'application/x-ndjson'
+        return flask.Response(flask.stream_with_context(rows),
+                              mimetype=mimetype)
+
+    def _batches(self, query):
+        """Yield the users from query, BATCH_SIZE at a time by id"""
+        query = query.order_by(models.User.id)
+        last_id = None
+        while True:
+            batch_query = query
+            if last_id is not None:
+                batch_query = query.filter(models.User.id > last_id)
+            batch = batch_query.limit(self.BATCH_SIZE).all()
+            yield from batch
+            if len(batch) < self.BATCH_SIZE:
+                return
+            last_id = batch[-1].id
+
+    def _ndjson_rows(self, query, schema):
+        serializer = compiled.get_serializer(schema)
+        for db_user in self._batches(query):
+            yield json.dumps(serializer.dump(db_user)) + '\n'
+
+    def _csv_rows(self, query, schema):
+        serializer = compiled.get_serializer(schema)
+        fields = list(schema.fields)
+        buf = io.StringIO()
+        writer = csv.DictWriter(buf, fields, extrasaction='ignore')
+        writer.writeheader()
+        for db_user in self._batches(query):
+            writer.writerow(serializer.dump(db_user))
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+        yield buf.getvalue()
 
 
 class UserSearch(base.Resource):
 
     POLICY_PREFIX = policies.USER_PREFIX
     schema = schemas.users
+    cursor_column = 'keystone_user_id'
 
     def post(self):
         try:
@@ -93,7 +194,8 @@ class UserSearch(base.Resource):
 
         parser = reqparse.RequestParser()
         parser.add_argument('search', required=True, location='form')
-        parser.add_argument('limit', type=int, location='args')
+        base.add_pagination_arguments(parser)
+        base.add_fields_argument(parser)
         args = parser.parse_args()
         search = args.get('search')
         if len(search) < 3:
@@ -102,12 +204,9 @@ class UserSearch(base.Resource):
 
         query = db.session.query(models.User)
         query = query.filter(models.User.keystone_user_id.isnot(None))
-        query = query.filter(db.or_(
-            models.User.email.ilike("%%%s%%" % search),
-            models.User.displayname.ilike("%%%s%%" % search)))
-
-        query = query.order_by(models.User.keystone_user_id)
-        return self.paginate(query, args)
+        query = search_backend.search_users(query, search)
+        query, schema = self.sparse(query, args)
+        return self.paginate(query, args, schema)
 
 
 class User(base.Resource):
@@ -116,12 +215,20 @@ class User(base.Resource):
     schema = schemas.user
     update_schema = schemas.user_update
 
+    def _user_query(self, id):
+        return db.session.query(models.User).filter_by(keystone_user_id=id)
+
     def _get_user(self, id):
-        return db.session.query(models.User) \
-                         .filter_by(keystone_user_id=id).first_or_404()
+        return self._user_query(id).first_or_404()
 
     def get(self, id):
-        db_user = self._get_user(id)
+        parser = reqparse.RequestParser()
+        base.add_fields_argument(parser)
+        args = parser.parse_args()
+
+        query, schema = self.sparse(self._user_query(id), args,
+                                    required=['keystone_user_id'])
+        db_user = query.first_or_404()
 
         target = {'user_id': db_user.keystone_user_id}
         try:
@@ -130,7 +237,7 @@ class User(base.Resource):
             flask_restful.abort(404,
                                 message="User {} doesn't exist".format(id))
 
-        return self.schema.dump(db_user)
+        return compiled.dump(schema, db_user)
 
     def patch(self, id):
         data = request.get_json()
@@ -174,7 +281,7 @@ class RefreshOrcid(base.Resource):
         except policy.PolicyNotAuthorized:
             flask_restful.abort(404,
                                 message="User {} doesn't exist".format(id))
-        if utils.refresh_orcid(db_user):
+        if utils.refresh_orcid(db_user, force=True):
             return self.schema.dump(db_user)
         else:
             flask_restful.abort(500,
@@ -198,10 +305,9 @@ class ProjectsWithRole(base.Resource):
             flask_restful.abort(404,
                                 message="User {} doesn't exist".format(id))
 
-        k_session = keystone.KeystoneSession()
-        session = k_session.get_session()
+        session = keystone.get_shared_session().get_session()
         client = clients.get_admin_keystoneclient(session)
-        roles = utils.get_roles(client, [role_name])
+        roles = keystone_cache.get_roles(client, [role_name])
         if roles:
             ra_list = client.role_assignments.list(
                 user=db_user.keystone_user_id,
@@ -217,6 +323,8 @@ class PendingUserList(UserList):
 
     schema = schemas.pending_users
     update_schema = schemas.pending_user_update
+    # Pending users don't have a keystone_user_id yet
+    cursor_column = 'id'
 
     def _get_users(self):
         # The filter for 'terms_accepted_at' is to exclude records where
@@ -231,11 +339,11 @@ class PendingUser(User):
 
     schema = schemas.pending_user
 
-    def _get_user(self, id):
+    def _user_query(self, id):
         return db.session.query(models.User) \
                          .filter_by(keystone_user_id=None) \
                          .filter(models.User.terms_accepted_at.isnot(None)) \
-                         .filter_by(id=id).first_or_404()
+                         .filter_by(id=id)
 
     def delete(self, id):
         try:
@@ -0,0 +1,131 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+
+import marshmallow
+from marshmallow import decorators
+from marshmallow import fields
+from marshmallow import utils
+
+
+def _nullable(convert):
+    def serialize(value):
+        return None if value is None else convert(value)
+    return serialize
+
+
+def _identity(value):
+    return value
+
+
+def _isoformat(value):
+    return None if value is None else value.isoformat()
+
+
+class CompiledSchema(object):
+    """A precompiled serializer equivalent to Schema.dump
+
+    The fields of the schema are resolved once into (key, attribute,
+    converter) triples, so dumping an object is a plain loop of getattr
+    calls and simple conversions instead of marshmallow's per-field,
+    per-object dispatch. Field types without a fast path fall back to
+    the field's own _serialize, so the output is always identical to
+    schema.dump for ORM objects.
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.many = schema.many
+        self._fields = []
+        for name, field in schema.dump_fields.items():
+            key = field.data_key if field.data_key is not None else name
+            attr = field.attribute if field.attribute is not None else name
+            self._fields.append((key, attr, field,
+                                 self._converter(name, field)))
+
+    @staticmethod
+    def _converter(name, field):
+        if type(field) is fields.Field:
+            return _identity
+        if type(field) is fields.String:
+            return _nullable(utils.ensure_text_type)
+        if type(field) is fields.Integer and not field.as_string:
+            return _nullable(int)
+        if (type(field) in (fields.DateTime, fields.Date)
+                and field.format in (None, 'iso')):
+            return _isoformat
+        if type(field) is fields.Nested:
+            nested = get_serializer(field.schema)
+            many = field.schema.many or field.many
+            return _nullable(lambda value: nested.dump(value, many=many))
+
+        def serialize(value, _field=field, _name=name):
+            return _field._serialize(value, _name, None)
+        return serialize
+
+    def dump_one(self, obj):
+        ret = {}
+        for key, attr, field, convert in self._fields:
+            value = getattr(obj, attr, marshmallow.missing)
+            if value is marshmallow.missing:
+                value = field.serialize(attr, obj)
+                if value is marshmallow.missing:
+                    continue
+                ret[key] = value
+            else:
+                ret[key] = convert(value)
+        return ret
+
+    def dump(self, obj, many=None):
+        many = self.many if many is None else many
+        if many:
+            dump_one = self.dump_one
+            return [dump_one(o) for o in obj]
+        return self.dump_one(obj)
+
+
+_serializers = {}
+_serializers_lock = threading.Lock()
+
+
+def _can_compile(schema):
+    if schema.dict_class is not dict:
+        return False
+    return not (schema._has_processors(decorators.PRE_DUMP)
+                or schema._has_processors(decorators.POST_DUMP))
+
+
+def get_serializer(schema):
+    """Return a CompiledSchema for schema, compiled at most once
+
+    Schemas are keyed by class and options rather than instance, so
+    schemas built per request with only=... reuse the same serializer.
+    Schemas with dump hooks aren't compiled; the schema is returned.
+    """
+    if not _can_compile(schema):
+        return schema
+    key = (type(schema), schema.many,
+           tuple(sorted(schema.only)) if schema.only else None,
+           tuple(sorted(schema.exclude)))
+    with _serializers_lock:
+        serializer = _serializers.get(key)
+    if serializer is None:
+        serializer = CompiledSchema(schema)
+        with _serializers_lock:
+            serializer = _serializers.setdefault(key, serializer)
+    return serializer
+
+
+def dump(schema, obj):
+    return get_serializer(schema).dump(obj)
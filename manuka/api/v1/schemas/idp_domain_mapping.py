@@ -0,0 +1,36 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from manuka.extensions import ma
+from manuka import models
+
+
+class IdpDomainMappingSchema(ma.SQLAlchemyAutoSchema):
+
+    class Meta:
+        model = models.IdpDomainMapping
+        load_instance = True
+        dump_only = ('id', 'created_at', 'updated_at')
+
+
+class IdpDomainMappingUpdateSchema(ma.SQLAlchemyAutoSchema):
+
+    class Meta:
+        model = models.IdpDomainMapping
+        load_instance = True
+        fields = ('domain',)
+
+
+idp_domain_mapping = IdpDomainMappingSchema()
+idp_domain_mappings = IdpDomainMappingSchema(many=True)
+idp_domain_mapping_update = IdpDomainMappingUpdateSchema()
@@ -11,12 +11,142 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+from concurrent import futures
+import datetime
+
 import click
 from flask.cli import FlaskGroup
+from flask.cli import with_appcontext
+import sqlalchemy
 
 from manuka import app
+from manuka.common import clients
+from manuka.common import idp_domains
+from manuka.common import ratelimit
+from manuka.extensions import db
+from manuka import models
+from manuka.worker import utils as worker_utils
 
 
 @click.group(cls=FlaskGroup, create_app=app.create_app)
 def cli():
     """Management script for the Manuka application."""
+
+
+@cli.group('idp-domain-mappings')
+def idp_domain_mappings():
+    """Manage the IdP to domain mappings."""
+
+
+@idp_domain_mappings.command('import')
+@click.option('--update', is_flag=True,
+              help="Change existing mappings to match the files.")
+@with_appcontext
+def import_idp_domain_mappings(update):
+    """Import the mapping files in idp_domain_mapping_dir."""
+    existing = {m.idp: m for m in
+                db.session.query(models.IdpDomainMapping)}
+    added = updated = 0
+    for idp, domain in sorted(idp_domains.load_files().items()):
+        mapping = existing.get(idp)
+        if mapping is None:
+            db.session.add(models.IdpDomainMapping(idp, domain))
+            added += 1
+        elif update and mapping.domain != domain:
+            mapping.domain = domain
+            mapping.updated_at = datetime.datetime.now()
+            updated += 1
+    db.session.commit()
+    click.echo("Added %d and updated %d IdP domain mappings"
+               % (added, updated))
+
+
+@cli.group('orcid')
+def orcid():
+    """Manage users' ORCIDs."""
+
+
+def _fresh_lookups(users):
+    emails = [u.email.lower() for u in users]
+    return {lookup.email for lookup in db.session.query(
+        models.OrcidLookup).filter(models.OrcidLookup.email.in_(emails))
+        if lookup.is_fresh()}
+
+
+@orcid.command('refresh-all')
+@click.option('--all', 'all_users', is_flag=True,
+              help="Also search for users who already have an ORCID.")
+@click.option('--force', is_flag=True,
+              help="Search even if the cached search for an email is "
+                   "still fresh.")
+@click.option('--concurrency', default=8, show_default=True,
+              type=click.IntRange(min=1),
+              help="Searches to run at once.")
+@click.option('--rate', default=8.0, show_default=True,
+              type=click.FloatRange(min=0, min_open=True),
+              help="Most searches to start per second.")
+@click.option('--batch-size', default=100, show_default=True,
+              type=click.IntRange(min=1),
+              help="Users to search for between commits.")
+@with_appcontext
+def refresh_all_orcids(all_users, force, concurrency, rate, batch_size):
+    """Search ORCID for users without an ORCID or with a stale search.
+
+    Searches run concurrently but are rate limited, and the results are
+    committed a batch at a time, so an interrupted run keeps the work
+    it has done.
+    """
+    client = clients.get_orcid_client()
+    bucket = ratelimit.TokenBucket(rate, burst=concurrency)
+
+    def search(email):
+        bucket.acquire()
+        return client.search_by_email(email)
+
+    query = db.session.query(models.User).filter(
+        models.User.email.isnot(None)).order_by(models.User.id)
+    if not all_users:
+        query = query.filter(sqlalchemy.or_(models.User.orcid.is_(None),
+                                            models.User.orcid == ''))
+    counts = collections.Counter()
+    last_id = None
+    with futures.ThreadPoolExecutor(
+            max_workers=concurrency,
+            thread_name_prefix='manuka-orcid') as pool:
+        while True:
+            batch_query = query
+            if last_id is not None:
+                batch_query = query.filter(models.User.id > last_id)
+            users = batch_query.limit(batch_size).all()
+            if not users:
+                break
+            last_id = users[-1].id
+            if not force:
+                fresh = _fresh_lookups(users)
+                counts['skipped'] += sum(u.email.lower() in fresh
+                                         for u in users)
+                users = [u for u in users if u.email.lower() not in fresh]
+
+            # Only the searches run on the pool, the session stays on
+            # this thread
+            searches = [pool.submit(search, u.email) for u in users]
+            for db_user, future in zip(users, searches):
+                try:
+                    found = future.result()
+                except Exception as e:
+                    click.echo("Search for user %s failed: %s"
+                               % (db_user.id, e), err=True)
+                    counts['failed'] += 1
+                    continue
+                models.record_orcid_lookup(db_user.email, found,
+                                           commit=False)
+                counts['found' if found else 'not found'] += 1
+                if worker_utils.update_orcid(db_user, found, commit=False):
+                    counts['changed'] += 1
+            db.session.commit()
+
+    click.echo("Found %d ORCIDs (%d changed), %d not found, %d failed "
+               "and %d skipped with a fresh search"
+               % (counts['found'], counts['changed'], counts['not found'],
+                  counts['failed'], counts['skipped']))
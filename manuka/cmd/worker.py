@@ -20,6 +20,7 @@ from oslo_config import cfg
 
 from manuka.common import service
 from manuka.worker import consumer
+from manuka.worker import pool
 
 
 CONF = cfg.CONF
@@ -31,6 +32,8 @@ def main():
     sm = cotyledon.ServiceManager()
     sm.add(consumer.ConsumerService, workers=CONF.worker.workers,
            args=(CONF,))
+    if CONF.trial_pool.size > 0:
+        sm.add(pool.PoolService, workers=1, args=(CONF,))
     oslo_config_glue.setup(sm, CONF, reload_method="mutate")
     sm.run()
 
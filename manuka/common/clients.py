@@ -11,6 +11,9 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import threading
+import weakref
+
 from keystoneauth1.identity import v3
 from keystoneauth1 import session
 from keystoneclient.v3 import client as ks_client
@@ -28,6 +31,14 @@ CONF = cfg.CONF
 
 NOVA_VERSION = '2.60'
 
+# Admin clients keyed by the session they were built from
+_admin_keystoneclients = weakref.WeakKeyDictionary()
+_admin_keystoneclients_lock = threading.Lock()
+_admin_openstack_clients = weakref.WeakKeyDictionary()
+_admin_openstack_clients_lock = threading.Lock()
+_orcid_client = None
+_orcid_client_lock = threading.Lock()
+
 
 def get_session(token, project_id):
     auth = v3.Token(token=token,
@@ -38,7 +49,12 @@ def get_session(token, project_id):
 
 
 def get_admin_keystoneclient(sesh):
-    return ks_client.Client(session=sesh)
+    with _admin_keystoneclients_lock:
+        client = _admin_keystoneclients.get(sesh)
+        if client is None:
+            client = _admin_keystoneclients[sesh] = ks_client.Client(
+                session=sesh)
+    return client
 
 
 def get_openstack_client(project_id, token):
@@ -46,6 +62,15 @@ def get_openstack_client(project_id, token):
     return connection.Connection(session=auth_session)
 
 
+def get_admin_openstack_client(sesh):
+    with _admin_openstack_clients_lock:
+        client = _admin_openstack_clients.get(sesh)
+        if client is None:
+            client = _admin_openstack_clients[sesh] = connection.Connection(
+                session=sesh)
+    return client
+
+
 def get_nova_client(project_id, token):
     auth_session = get_session(token, project_id)
     return nova_client.Client(NOVA_VERSION, session=auth_session)
@@ -68,4 +93,18 @@ def get_swift_client(sesh, project_id):
 
 
 def get_orcid_client():
-    return orcid_client.Client()
+    """Return the process wide ORCID client
+
+    Sharing the client reuses its search token and HTTP connections.
+    """
+    global _orcid_client
+    with _orcid_client_lock:
+        if _orcid_client is None:
+            _orcid_client = orcid_client.Client()
+    return _orcid_client
+
+
+def reset_orcid_client():
+    global _orcid_client
+    with _orcid_client_lock:
+        _orcid_client = None
@@ -0,0 +1,176 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""IdP to Keystone domain mappings
+
+Mappings are stored in the idp_domain_mapping table, and lookups are
+cached for CONF.idp_domain_mapping_cache_ttl seconds.
+
+IdPs without a mapping in the database fall back to the mapping files.
+Each file in CONF.idp_domain_mapping_dir is named after a domain and
+lists the entity ids of the IdPs in it, one per line. The files are
+compiled into a dict, which is only rebuilt when the names, sizes or
+mtimes of the files change.
+"""
+
+import os
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from manuka.common import cache
+from manuka.extensions import db
+from manuka import models
+
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+
+class IdpDomainIndex(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._path = None
+        self._signature = None
+        self._checked_at = None
+        self._domains = {}
+        self.reloads = 0
+        self.lookups = 0
+        self.lookup_time = 0.0
+
+    @staticmethod
+    def _scan(path):
+        """Return the signature of the mapping files in path"""
+        entries = []
+        try:
+            for entry in os.scandir(path):
+                if entry.is_file():
+                    st = entry.stat()
+                    entries.append((entry.name, st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            return None
+        return tuple(sorted(entries))
+
+    @staticmethod
+    def _load(path, signature):
+        domains = {}
+        for domain, mtime, size in signature or ():
+            try:
+                with open(os.path.join(path, domain)) as f:
+                    lines = f.read().split('\n')
+            except IOError:
+                continue
+            for idp in lines:
+                idp = idp.strip()
+                if not idp:
+                    continue
+                if idp in domains:
+                    LOG.warning("IdP %s is mapped to domains %s and %s, "
+                                "using %s", idp, domains[idp], domain,
+                                domains[idp])
+                    continue
+                domains[idp] = domain
+        return domains
+
+    def _refresh(self):
+        path = CONF.idp_domain_mapping_dir
+        now = time.monotonic()
+        with self._lock:
+            if (path == self._path and self._checked_at is not None
+                    and now - self._checked_at
+                    < CONF.idp_domain_mapping_check_interval):
+                return
+            self._checked_at = now
+            signature = self._scan(path)
+            if path == self._path and signature == self._signature:
+                return
+            self._domains = self._load(path, signature)
+            self._path = path
+            self._signature = signature
+            self.reloads += 1
+        LOG.info("Loaded %d IdP domain mappings from %s (reload %d)",
+                 len(self._domains), path, self.reloads)
+
+    def lookup(self, idp):
+        """Return the domain for idp, or None if it isn't mapped"""
+        start = time.monotonic()
+        self._refresh()
+        domain = self._domains.get(idp)
+        self.lookups += 1
+        self.lookup_time += time.monotonic() - start
+        return domain
+
+    def stats(self):
+        return {'reloads': self.reloads,
+                'lookups': self.lookups,
+                'mean_lookup_time': (self.lookup_time / self.lookups
+                                     if self.lookups else 0.0),
+                'size': len(self._domains)}
+
+    def reset(self):
+        with self._lock:
+            self._path = None
+            self._signature = None
+            self._checked_at = None
+            self._domains = {}
+            self.reloads = 0
+            self.lookups = 0
+            self.lookup_time = 0.0
+
+
+_index = IdpDomainIndex()
+
+# Domains from the database by IdP; '' for IdPs without a mapping
+_db_cache = cache.TTLCache(lambda: CONF.idp_domain_mapping_cache_ttl)
+
+
+def _db_lookup(idp):
+    domain = _db_cache.get(idp)
+    if domain is None:
+        domain = db.session.query(models.IdpDomainMapping.domain).filter_by(
+            idp=idp).scalar() or ''
+        _db_cache.set(idp, domain)
+    return domain
+
+
+def get_domain(idp, default='default'):
+    """Return the domain for idp from the database or mapping files"""
+    if idp is None:
+        return default
+    return _db_lookup(idp) or _index.lookup(idp) or default
+
+
+def invalidate(idp):
+    """Forget the cached domain for idp after its mapping has changed
+
+    Only this process's cache is invalidated; other processes see the
+    change within idp_domain_mapping_cache_ttl seconds.
+    """
+    _db_cache.invalidate(idp)
+
+
+def load_files():
+    """Return the mappings from the mapping files as a dict"""
+    path = CONF.idp_domain_mapping_dir
+    return IdpDomainIndex._load(path, IdpDomainIndex._scan(path))
+
+
+def stats():
+    return dict(_index.stats(), cache=_db_cache.stats())
+
+
+def reset():
+    _index.reset()
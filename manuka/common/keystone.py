@@ -11,6 +11,8 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import threading
+
 from keystoneauth1 import loading as ks_loading
 from keystonemiddleware import auth_token
 from oslo_config import cfg
@@ -29,6 +31,7 @@ class KeystoneSession(object):
     def __init__(self, section='service_auth'):
         self._session = None
         self._auth = None
+        self._lock = threading.RLock()
 
         self.section = section
         ks_loading.register_auth_conf_options(cfg.CONF, self.section)
@@ -39,22 +42,47 @@ class KeystoneSession(object):
 
         :return: a Keystone Session object
         """
-        if not self._session:
-            self._session = ks_loading.load_session_from_conf_options(
-                cfg.CONF, self.section, auth=self.get_auth())
+        with self._lock:
+            if not self._session:
+                self._session = ks_loading.load_session_from_conf_options(
+                    cfg.CONF, self.section, auth=self.get_auth())
 
         return self._session
 
     def get_auth(self):
-        if not self._auth:
-            self._auth = ks_loading.load_auth_from_conf_options(
-                cfg.CONF, self.section)
+        with self._lock:
+            if not self._auth:
+                self._auth = ks_loading.load_auth_from_conf_options(
+                    cfg.CONF, self.section)
         return self._auth
 
     def get_service_user_id(self):
         return self.get_auth().get_user_id(self.get_session())
 
 
+_shared_sessions = {}
+_shared_sessions_lock = threading.Lock()
+
+
+def get_shared_session(section='service_auth'):
+    """Return the process wide KeystoneSession for section
+
+    The underlying keystoneauth session keeps the service user's token
+    until it is close to expiry and pools its HTTP connections, so
+    sharing it saves an authentication and a TLS handshake per call.
+    """
+    with _shared_sessions_lock:
+        k_session = _shared_sessions.get(section)
+        if k_session is None:
+            k_session = _shared_sessions[section] = KeystoneSession(section)
+    return k_session
+
+
+def reset_shared_sessions():
+    with _shared_sessions_lock:
+        _shared_sessions.clear()
+
+
 class SkippingAuthProtocol(auth_token.AuthProtocol):
     """SkippingAuthProtocol to reach special endpoints
 
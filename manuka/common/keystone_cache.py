@@ -0,0 +1,71 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+"""Cached Keystone roles and domains
+
+Roles and domains are all but static, so keep them out of the login
+and account creation paths.
+"""
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from manuka.common import cache
+
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+_role_cache = cache.TTLCache(lambda: CONF.keystone.role_cache_ttl)
+_domain_cache = cache.TTLCache(lambda: CONF.keystone.domain_cache_ttl)
+
+
+def _list_roles(client):
+    role_list = client.roles.list()
+    LOG.debug('Roles %s', role_list)
+    _role_cache.set('roles', role_list)
+    return role_list
+
+
+def get_roles(client, role_names):
+    role_list = _role_cache.get('roles')
+    if role_list is None:
+        role_list = _list_roles(client)
+    elif not set(role_names) <= {role.name for role in role_list}:
+        # A role may have been added since the list was cached
+        role_list = _list_roles(client)
+
+    roles = []
+    for role in role_list:
+        LOG.debug('Testing role %s in %s', role.name, role_names)
+        if role.name in role_names:
+            roles.append(role)
+    return roles
+
+
+def get_domain(client, domain_id):
+    domain = _domain_cache.get(domain_id)
+    if domain is None:
+        domain = client.domains.get(domain_id)
+        _domain_cache.set(domain_id, domain)
+    return domain
+
+
+def invalidate():
+    _role_cache.clear()
+    _domain_cache.clear()
+
+
+def stats():
+    return {'roles': _role_cache.stats(), 'domains': _domain_cache.stats()}
@@ -11,33 +11,135 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import threading
 import time
 
 import orcid
 from oslo_config import cfg
 from oslo_log import log as logging
+import requests
+from requests import adapters
 from requests import exceptions
 
+from manuka.common import retry
+
 
 LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
 
+# Refresh the search token this long before ORCID says it expires
+TOKEN_EXPIRY_MARGIN = 60
+
+
+def is_transient(ex):
+    """Return True if a failed request is worth retrying"""
+    # A Response is falsy for error statuses, so compare with None
+    return (ex.response is not None
+            and ex.response.status_code in [500, 503])
+
+
+def _is_unauthorized(ex):
+    return ex.response is not None and ex.response.status_code == 401
+
+
+class PublicAPI(orcid.PublicAPI):
+    """orcid.PublicAPI that sends its requests through a requests.Session
+
+    The library calls requests.get and requests.post, which open a new
+    connection for every request.
+    """
+
+    def __init__(self, key, secret, sandbox, session, timeout=None):
+        super().__init__(key, secret, sandbox, timeout=timeout)
+        self.session = session
+
+    def get_search_token(self, scope='/read-public'):
+        """Return a search token and its lifetime in seconds"""
+        payload = {'client_id': self._key,
+                   'client_secret': self._secret,
+                   'scope': scope,
+                   'grant_type': 'client_credentials'}
+        response = self.session.post(
+            "%s/oauth/token" % self._endpoint, data=payload,
+            headers={'Accept': 'application/json'}, timeout=self._timeout)
+        response.raise_for_status()
+        data = response.json()
+        return data['access_token'], data.get('expires_in')
+
+    def _search(self, query, method, start, rows, headers, endpoint):
+        url = "%s%s/search/?defType=%s&q=%s" % (
+            endpoint, orcid.orcid.SEARCH_VERSION, method, query)
+        if start:
+            url += "&start=%s" % start
+        if rows:
+            url += "&rows=%s" % rows
+        response = self.session.get(url, headers=headers,
+                                    timeout=self._timeout)
+        response.raise_for_status()
+        return response.json()
+
+
+def make_session():
+    """Return a requests.Session with a connection pool for ORCID"""
+    session = requests.Session()
+    adapter = adapters.HTTPAdapter(pool_connections=1,
+                                   pool_maxsize=CONF.orcid.pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if CONF.orcid.http_proxy:
+        session.proxies['http'] = CONF.orcid.http_proxy
+    if CONF.orcid.https_proxy:
+        session.proxies['https'] = CONF.orcid.https_proxy
+    return session
+
 
 class Client(object):
+    """ORCID search client
+
+    A Client is safe to share between threads. The search token is
+    fetched on first use and kept until it expires, or until ORCID
+    rejects it.
+    """
 
     def __init__(self, max_retries=None, retry_delay=None):
-        self.max_retries = max_retries or CONF.orcid.max_retries
-        self.retry_delay = retry_delay or CONF.orcid.retry_delay
-        proxies = {}
-        if CONF.orcid.http_proxy:
-            proxies['http'] = CONF.orcid.http_proxy
-        if CONF.orcid.https_proxy:
-            proxies['https'] = CONF.orcid.https_proxy
-        self.api = orcid.PublicAPI(CONF.orcid.key, CONF.orcid.secret,
-                                   CONF.orcid.sandbox,
-                                   timeout=CONF.orcid.timeout,
-                                   proxies=proxies)
-        self.token = self.api.get_search_token_from_orcid()
+        self.max_retries = (CONF.orcid.max_retries if max_retries is None
+                            else max_retries)
+        self.retry_delay = (CONF.orcid.retry_delay if retry_delay is None
+                            else retry_delay)
+        self.session = make_session()
+        self.api = PublicAPI(CONF.orcid.key, CONF.orcid.secret,
+                             CONF.orcid.sandbox, self.session,
+                             timeout=CONF.orcid.timeout)
+        self._token_lock = threading.Lock()
+        self._token = None
+        self._token_expires = None
+        self.tokens_fetched = 0
+        self.searches = 0
+
+    def _get_token(self):
+        with self._token_lock:
+            if (self._token is None
+                    or time.monotonic() >= self._token_expires):
+                token, expires_in = self.api.get_search_token()
+                ttl = CONF.orcid.token_ttl
+                if expires_in:
+                    ttl = min(ttl, expires_in - TOKEN_EXPIRY_MARGIN)
+                self._token = token
+                self._token_expires = time.monotonic() + ttl
+                self.tokens_fetched += 1
+                LOG.info("Fetched ORCID search token (%d fetched for %d "
+                         "searches)", self.tokens_fetched, self.searches)
+            return self._token
+
+    def _drop_token(self, token):
+        with self._token_lock:
+            # Another thread may already have replaced it
+            if self._token == token:
+                self._token = None
+
+    def stats(self):
+        return {'tokens_fetched': self.tokens_fetched,
+                'searches': self.searches}
 
     @staticmethod
     def _get_orcid(result):
@@ -50,43 +152,55 @@ class Client(object):
         query = 'family-name:%s+AND+given-names:%s' % (surname, first_name)
         return self._search(query)
 
-    def _handle_http_error(self, ex):
-        if ex.response and ex.response.status_code in [500, 503]:
-            if self.tries < self.max_retries:
-                LOG.info("Sleeping and retrying request: url %s",
-                         ex.request.url)
-                self.tries += 1
-                time.sleep(self.retry_delay)
-                return
-        raise ex
+    def _call(self, func, max_retries=None):
+        """Call func with a search token, retrying transient errors
 
-    def _search(self, query):
-        self.tries = 0
+        A token that is rejected is fetched again once.
+        """
+        if max_retries is None:
+            max_retries = self.max_retries
+        with self._token_lock:
+            self.searches += 1
+        tries = 0
+        reauthenticated = False
         while True:
+            token = self._get_token()
             try:
-                results = self.api.search_generator(query,
-                                                    pagination=100,
-                                                    access_token=self.token)
-                # Sometimes the result JSON includes a 'null' ...
-                return [self._get_orcid(r) for r in results if r]
+                return func(token)
             except exceptions.HTTPError as ex:
-                self._handle_http_error(ex)
+                if _is_unauthorized(ex) and not reauthenticated:
+                    LOG.info("ORCID search token was rejected, "
+                             "fetching a new one")
+                    self._drop_token(token)
+                    reauthenticated = True
+                    continue
+                if not is_transient(ex) or tries >= max_retries:
+                    raise
+                delay = retry.backoff(tries, self.retry_delay)
+                LOG.info("Retrying request in %.1fs: url %s", delay,
+                         ex.request.url)
+                tries += 1
+                time.sleep(delay)
 
-    def search_by_email(self, email):
-        self.tries = 0
-        while True:
-            try:
-                results = self.api.search('email:%s' % email,
-                                          rows=2,
-                                          access_token=self.token)
-                if results['num-found'] == 0:
-                    return None
-                elif results['num-found'] == 1:
-                    return self._get_orcid(results['result'][0])
-                else:
-                    # This indicates something is fundamentally wrong
-                    # in the service.  This relation is one to one (or
-                    # one to none).
-                    raise Exception("email to ORCID mapping not unique")
-            except exceptions.HTTPError as ex:
-                self._handle_http_error(ex)
+    def _search(self, query):
+        def search(token):
+            results = self.api.search_generator(query, pagination=100,
+                                                access_token=token)
+            # Sometimes the result JSON includes a 'null' ...
+            return [self._get_orcid(r) for r in results if r]
+        return self._call(search)
+
+    def search_by_email(self, email, max_retries=None):
+        def search(token):
+            results = self.api.search('email:%s' % email, rows=2,
+                                      access_token=token)
+            if results['num-found'] == 0:
+                return None
+            elif results['num-found'] == 1:
+                return self._get_orcid(results['result'][0])
+            else:
+                # This indicates something is fundamentally wrong
+                # in the service.  This relation is one to one (or
+                # one to none).
+                raise Exception("email to ORCID mapping not unique")
+        return self._call(search, max_retries)
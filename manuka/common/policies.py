@@ -78,6 +78,12 @@ user_rules = [
                      'method': 'GET'},
                     {'path': '/v1/users/',
                      'method': 'HEAD'}]),
+    policy.DocumentedRuleDefault(
+        name=USER_PREFIX % 'export',
+        check_str='rule:admin_required',
+        description='Export all users.',
+        operations=[{'path': '/v1/users/export/',
+                     'method': 'GET'}]),
     policy.DocumentedRuleDefault(
         name=USER_PREFIX % 'search',
         check_str='rule:%s' % ADMIN_OR_READER,
@@ -139,11 +145,52 @@ external_id_rules = [
                      'method': 'DELETE'}]),
 ]
 
+IDP_DOMAIN_MAPPING_PREFIX = "account:idp-domain-mapping:%s"
+
+idp_domain_mapping_rules = [
+    policy.DocumentedRuleDefault(
+        name=IDP_DOMAIN_MAPPING_PREFIX % 'list',
+        check_str='rule:%s' % ADMIN_OR_READER,
+        description='List IdP domain mappings.',
+        operations=[{'path': '/v1/idp-domain-mappings/',
+                     'method': 'GET'},
+                    {'path': '/v1/idp-domain-mappings/',
+                     'method': 'HEAD'}]),
+    policy.DocumentedRuleDefault(
+        name=IDP_DOMAIN_MAPPING_PREFIX % 'get',
+        check_str='rule:%s' % ADMIN_OR_READER,
+        description='Show IdP domain mapping details.',
+        operations=[{'path': '/v1/idp-domain-mappings/{mapping_id}/',
+                     'method': 'GET'},
+                    {'path': '/v1/idp-domain-mappings/{mapping_id}/',
+                     'method': 'HEAD'}]),
+    policy.DocumentedRuleDefault(
+        name=IDP_DOMAIN_MAPPING_PREFIX % 'create',
+        check_str='rule:admin_required',
+        description='Create an IdP domain mapping.',
+        operations=[{'path': '/v1/idp-domain-mappings/',
+                     'method': 'POST'}]),
+    policy.DocumentedRuleDefault(
+        name=IDP_DOMAIN_MAPPING_PREFIX % 'update',
+        check_str='rule:admin_required',
+        description='Update an IdP domain mapping.',
+        operations=[{'path': '/v1/idp-domain-mappings/{mapping_id}/',
+                     'method': 'PATCH'}]),
+    policy.DocumentedRuleDefault(
+        name=IDP_DOMAIN_MAPPING_PREFIX % 'delete',
+        check_str='rule:admin_required',
+        description='Delete an IdP domain mapping.',
+        operations=[{'path': '/v1/idp-domain-mappings/{mapping_id}/',
+                     'method': 'DELETE'}]),
+]
+
 
 enforcer.register_defaults(base_rules)
 enforcer.register_defaults(user_rules)
 enforcer.register_defaults(external_id_rules)
+enforcer.register_defaults(idp_domain_mapping_rules)
 
 
 def list_rules():
-    return base_rules + user_rules + external_id_rules
+    return (base_rules + user_rules + external_id_rules
+            + idp_domain_mapping_rules)
@@ -0,0 +1,115 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Delayed retries without sleeping threads
+
+A task that fails with a transient error raises RetryLater. Rather than
+sleeping, the caller schedules the task again on a RetryScheduler after
+a backoff delay, freeing its thread for other work in the meantime.
+"""
+
+from concurrent import futures
+import functools
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from oslo_log import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+class RetryLater(Exception):
+    """A transient failure; the task can be tried again later"""
+
+
+def backoff(attempt, base, cap=300):
+    """Return the delay before retry number attempt (from 0)
+
+    Exponential backoff with full jitter, so that tasks which failed
+    together don't all retry at the same moment.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class RetryScheduler(object):
+    """Runs callables after a delay
+
+    Pending calls are kept in a heap ordered by due time and a single
+    timer thread hands them to a small thread pool when they are due.
+    """
+
+    def __init__(self, max_workers=4):
+        self._cond = threading.Condition()
+        self._heap = []
+        self._counter = itertools.count()
+        self._thread = None
+        self._stopped = False
+        self._pool = futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='manuka-retry')
+
+    def schedule(self, delay, func, *args, **kwargs):
+        call = functools.partial(func, *args, **kwargs)
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("Retry scheduler is shut down")
+            heapq.heappush(self._heap, (time.monotonic() + delay,
+                                        next(self._counter), call))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='manuka-retry-timer',
+                    daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        with self._cond:
+            while not self._stopped:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                wait = self._heap[0][0] - time.monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                call = heapq.heappop(self._heap)[2]
+                self._pool.submit(self._call, call)
+
+    @staticmethod
+    def _call(call):
+        try:
+            call()
+        except Exception:
+            LOG.exception("Scheduled retry %s failed", call.func)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def shutdown(self, wait=True):
+        """Stop the scheduler
+
+        Return the pending calls, as functools.partial objects, so the
+        caller can hand them on rather than lose them.
+        """
+        with self._cond:
+            self._stopped = True
+            pending = [entry[2] for entry in sorted(self._heap)]
+            self._heap.clear()
+            self._cond.notify()
+        if pending:
+            LOG.warning("Stopped with %d pending retries", len(pending))
+        self._pool.shutdown(wait=wait)
+        return pending
@@ -0,0 +1,165 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Account status notifications
+
+The worker broadcasts on the manuka-status fanout topic when it has
+created a user's account. Each API process listens on that topic, so
+/login/account_status?wait=N can block until the account is ready
+rather than being polled.
+"""
+
+import contextlib
+import threading
+
+from oslo_config import cfg
+from oslo_context import context
+from oslo_log import log as logging
+import oslo_messaging
+
+from manuka.common import cache
+from manuka.common import rpc
+
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+TOPIC = 'manuka-status'
+
+# Current API version
+API_VERSION = '1.0'
+
+# Account states by persistent id, dropped when the account is created
+state_cache = cache.TTLCache(lambda: CONF.account_status_cache_ttl)
+
+
+class StatusAPI(object):
+    """Status notification api
+
+    Version history:
+
+    1.0 - Add account_created
+    """
+
+    def __init__(self):
+        target = oslo_messaging.Target(topic=TOPIC, version=API_VERSION)
+        self._client = oslo_messaging.RPCClient(rpc.TRANSPORT, target)
+
+    def account_created(self, ctxt, persistent_id):
+        cctxt = self._client.prepare(version='1.0', fanout=True)
+        cctxt.cast(ctxt, 'account_created', persistent_id=persistent_id)
+
+
+def notify_account_created(persistent_id):
+    """Tell every API process that an account is ready
+
+    This is best effort; waiting clients fall back to polling.
+    """
+    try:
+        StatusAPI().account_created(context.RequestContext(), persistent_id)
+    except Exception:
+        LOG.exception("Failed to send account created notification for %s",
+                      persistent_id)
+
+
+class StatusWaiter(object):
+    """Lets request threads wait for account created notifications
+
+    Each waiting request holds a WSGI worker thread, so at most
+    max_waiters (a callable, None or 0 for no limit) may wait at once.
+    """
+
+    def __init__(self, max_waiters=None):
+        self._lock = threading.Lock()
+        self._events = {}
+        self._waiting = 0
+        self._max_waiters = max_waiters
+
+    @contextlib.contextmanager
+    def watch(self, persistent_id):
+        """Watch for a notification for persistent_id
+
+        Start watching before checking the user's state, so that a
+        notification sent in between isn't missed. Yields an Event that
+        is set once the notification arrives, or None if too many
+        requests are already waiting.
+        """
+        limit = self._max_waiters() if self._max_waiters else None
+        with self._lock:
+            if limit and self._waiting >= limit:
+                event = None
+            else:
+                self._waiting += 1
+                event, count = self._events.get(persistent_id,
+                                                (threading.Event(), 0))
+                self._events[persistent_id] = (event, count + 1)
+        if event is None:
+            yield None
+            return
+        try:
+            yield event
+        finally:
+            with self._lock:
+                self._waiting -= 1
+                event, count = self._events[persistent_id]
+                if count > 1:
+                    self._events[persistent_id] = (event, count - 1)
+                else:
+                    del self._events[persistent_id]
+
+    def notify(self, persistent_id):
+        with self._lock:
+            event, count = self._events.get(persistent_id, (None, 0))
+        if event is not None:
+            LOG.debug("Waking %d waiters for %s", count, persistent_id)
+            event.set()
+
+    def __len__(self):
+        return len(self._events)
+
+
+class StatusEndpoints(object):
+
+    target = oslo_messaging.Target(version=API_VERSION)
+
+    def __init__(self, waiter):
+        self.waiter = waiter
+
+    def account_created(self, ctxt, persistent_id):
+        state_cache.invalidate(persistent_id)
+        self.waiter.notify(persistent_id)
+
+
+_waiter = None
+_waiter_lock = threading.Lock()
+
+
+def get_waiter():
+    """Return the process wide StatusWaiter, starting its listener"""
+    global _waiter
+    with _waiter_lock:
+        if _waiter is None:
+            waiter = StatusWaiter(
+                lambda: CONF.account_status_max_waiters)
+            _start_listener(waiter)
+            _waiter = waiter
+    return _waiter
+
+
+def _start_listener(waiter):
+    target = oslo_messaging.Target(topic=TOPIC, server=CONF.host,
+                                   fanout=True)
+    server = rpc.get_server(target, [StatusEndpoints(waiter)],
+                            executor='threading')
+    server.start()
+    LOG.info('Listening for account status notifications')
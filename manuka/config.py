@@ -33,10 +33,49 @@ default_opts = [
                default=socket.gethostname()),
     cfg.StrOpt('idp_domain_mapping_dir',
                default='/etc/manuka/idp_domain_mappings'),
+    cfg.IntOpt('idp_domain_mapping_check_interval',
+               default=10,
+               help="Seconds between checks of idp_domain_mapping_dir "
+                    "for changed mapping files. 0 checks on every "
+                    "lookup."),
+    cfg.IntOpt('idp_domain_mapping_cache_ttl',
+               default=60,
+               help="Seconds to cache IdP domain mappings read from the "
+                    "database."),
     cfg.StrOpt('default_target'),
     cfg.ListOpt('whitelist'),
     cfg.BoolOpt('fake_shib', default=False),
     cfg.BoolOpt('fake_shib_no_shib_orcid', default=False),
+    cfg.StrOpt('search_backend', default='auto',
+               choices=['auto', 'like', 'ngram', 'trigram', 'fulltext'],
+               help="How user searches are indexed. 'auto' picks the "
+                    "backend for the database in use."),
+    cfg.IntOpt('search_index_ttl', default=60,
+               help="Seconds before the in-process n-gram search index "
+                    "is rebuilt, picking up changes other processes "
+                    "made to existing users. 0 turns the index off."),
+    cfg.IntOpt('account_status_max_wait', default=25,
+               help="Longest time in seconds an account_status request "
+                    "may wait for the account to be created. A waiting "
+                    "request holds a WSGI worker thread for the whole "
+                    "time, see account_status_max_waiters. 0 turns "
+                    "waiting off."),
+    cfg.IntOpt('account_status_max_waiters', default=4,
+               help="Most account_status requests that may wait at once "
+                    "in each API process. Each holds a WSGI worker "
+                    "thread, so keep this well below the threads per "
+                    "process or waiting clients can starve /login/. "
+                    "Requests over the limit are answered at once and "
+                    "the page falls back to polling every 2 seconds. "
+                    "0 means no limit."),
+    cfg.IntOpt('account_status_cache_ttl', default=2,
+               help="Seconds to cache account states for "
+                    "account_status. 0 disables the cache."),
+    cfg.IntOpt('last_login_flush_interval', default=0,
+               help="Opt-in: buffer users' last login times and write "
+                    "them in batches this many seconds apart, saving "
+                    "two UPDATEs per login. The default of 0 writes "
+                    "them with the rest of the login."),
     cfg.StrOpt('auth_strategy', default='keystone',
                choices=['noauth',
                         'keystone',
@@ -53,6 +92,48 @@ flask_opts = [
                default=5000),
 ]
 
+trial_pool_opts = [
+    cfg.IntOpt('size',
+               default=0,
+               help="Number of ready made trial projects to keep. 0 "
+                    "disables the pool."),
+    cfg.IntOpt('refill_interval',
+               default=60,
+               help="Seconds between checks of the pool size."),
+    cfg.IntOpt('refill_batch',
+               default=5,
+               help="Most projects to build per refill."),
+    cfg.StrOpt('domain',
+               default='default',
+               help="Domain the pooled projects are created in. Only "
+                    "users whose IdP maps to this domain use the pool."),
+]
+
+security_group_opts = [
+    cfg.MultiStrOpt('group',
+                    default=['icmp:Allow ICMP (eg. ping)',
+                             'ssh:Allow SSH',
+                             'http:Allow HTTP/S'],
+                    help="A security group added to new projects, as "
+                         "name:description. Repeat for each group."),
+    cfg.MultiStrOpt('rule',
+                    default=['icmp:icmp::0.0.0.0/0',
+                             'ssh:tcp:22:0.0.0.0/0',
+                             'http:tcp:80:0.0.0.0/0',
+                             'http:tcp:443:0.0.0.0/0'],
+                    help="An ingress rule for one of the groups, as "
+                         "group:protocol:ports:remote_ip_prefix where "
+                         "ports is a port, a min-max range or empty for "
+                         "all ports. Repeat for each rule."),
+]
+
+api_opts = [
+    cfg.IntOpt('count_cache_ttl',
+               default=60,
+               help="Seconds to cache the totals returned for "
+                    "with_total=estimated listings."),
+]
+
 database_opts = [
     cfg.StrOpt('connection'),
     cfg.IntOpt('connection_recycle_time',
@@ -62,6 +143,31 @@ database_opts = [
 worker_opts = [
     cfg.IntOpt('workers',
                default=1),
+    cfg.IntOpt('step_workers',
+               default=8,
+               min=1,
+               help="Size of the thread pool that runs the independent "
+                    "steps of account provisioning"),
+    cfg.IntOpt('provisioning_lease',
+               default=900,
+               help="Seconds a worker holds a user's provisioning record. "
+                    "A duplicate create_user message for the user is "
+                    "ignored until the lease expires"),
+    cfg.IntOpt('retry_max_attempts',
+               default=10,
+               help="Attempts at a task that keeps failing with a "
+                    "transient error before giving up"),
+    cfg.FloatOpt('retry_base_delay',
+                 default=2.0,
+                 help="Seconds of backoff before the first retry; doubled "
+                      "for each further attempt, with random jitter"),
+    cfg.FloatOpt('retry_max_delay',
+                 default=300.0,
+                 help="Longest backoff between retries in seconds"),
+    cfg.IntOpt('retry_workers',
+               default=4,
+               min=1,
+               help="Threads that run scheduled retries"),
 ]
 
 swift_opts = [
@@ -75,6 +181,14 @@ keystone_opts = [
                secret=True,
                default=None),
     cfg.StrOpt('auth_url'),
+    cfg.IntOpt('role_cache_ttl',
+               default=3600,
+               help="Seconds to cache the list of Keystone roles. "
+                    "0 disables the cache."),
+    cfg.IntOpt('domain_cache_ttl',
+               default=3600,
+               help="Seconds to cache Keystone domain lookups. "
+                    "0 disables the cache."),
 ]
 
 smtp_opts = [
@@ -99,6 +213,21 @@ orcid_opts = [
                default=None),
     cfg.StrOpt('https_proxy',
                default=None),
+    cfg.IntOpt('token_ttl',
+               default=86400,
+               help="Longest time in seconds to reuse an ORCID search "
+                    "token, even if ORCID says it lasts longer."),
+    cfg.IntOpt('pool_size',
+               default=10,
+               help="Connections to keep open to the ORCID API."),
+    cfg.IntOpt('lookup_ttl',
+               default=30 * 86400,
+               help="Seconds to trust a cached ORCID search that found "
+                    "an ORCID before searching for the email again."),
+    cfg.IntOpt('lookup_negative_ttl',
+               default=7 * 86400,
+               help="Seconds to trust a cached ORCID search that found "
+                    "nothing before searching for the email again."),
 ]
 
 
@@ -109,6 +238,9 @@ cfg.CONF.register_opts(swift_opts, group='swift')
 cfg.CONF.register_opts(worker_opts, group='worker')
 cfg.CONF.register_opts(database_opts, group='database')
 cfg.CONF.register_opts(flask_opts, group='flask')
+cfg.CONF.register_opts(api_opts, group='api')
+cfg.CONF.register_opts(trial_pool_opts, group='trial_pool')
+cfg.CONF.register_opts(security_group_opts, group='security_groups')
 cfg.CONF.register_opts(default_opts)
 
 logging.register_options(cfg.CONF)
@@ -150,6 +282,9 @@ def list_opts():
         ('worker', worker_opts),
         ('database', database_opts),
         ('flask', flask_opts),
+        ('api', api_opts),
+        ('trial_pool', trial_pool_opts),
+        ('security_groups', security_group_opts),
         add_auth_opts(),
     ]
 
@@ -0,0 +1,44 @@
+"""Add user search indexes
+
+Revision ID: c3f1e8a2d5b7
+Revises: a7d2c4e91b30
+Create Date: 2026-10-18 11:02:17.904412
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3f1e8a2d5b7'
+down_revision = 'a7d2c4e91b30'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'mysql':
+        # The ngram parser drops every token containing a stopword, and
+        # the default list has "a", "i", "in", "on"... which would leave
+        # most names and emails unindexed. The setting is read when the
+        # index is created.
+        op.execute('SET SESSION innodb_ft_enable_stopword = 0')
+        op.execute('CREATE FULLTEXT INDEX ix_user_search '
+                   'ON user (email, displayname) WITH PARSER ngram')
+        op.execute('SET SESSION innodb_ft_enable_stopword = 1')
+    elif dialect == 'postgresql':
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        op.execute('CREATE INDEX ix_user_email_trgm ON "user" '
+                   'USING gin (email gin_trgm_ops)')
+        op.execute('CREATE INDEX ix_user_displayname_trgm ON "user" '
+                   'USING gin (displayname gin_trgm_ops)')
+    # SQLite uses an in-process index, see manuka.search
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'mysql':
+        op.drop_index('ix_user_search', table_name='user')
+    elif dialect == 'postgresql':
+        op.drop_index('ix_user_displayname_trgm', table_name='user')
+        op.drop_index('ix_user_email_trgm', table_name='user')
@@ -11,17 +11,26 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import atexit
+from concurrent import futures
 import datetime
 import flask
+import threading
+import time
 
 from keystoneauth1.identity import v3
 from keystoneauth1 import session
 from keystoneclient.v3 import client as keystone_client
 from oslo_config import cfg
 from oslo_log import log
+import sqlalchemy
+from sqlalchemy.dialects import mysql
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import attributes as orm_attributes
 
 from manuka.common import clients
 from manuka.common import keystone
+from manuka.common import keystone_cache
 from manuka.extensions import db
 
 
@@ -29,19 +38,31 @@ CONF = cfg.CONF
 LOG = log.getLogger(__name__)
 
 
+# Runs the independent Keystone calls made at login concurrently
+_keystone_executor = futures.ThreadPoolExecutor(
+    max_workers=16, thread_name_prefix='keystone-auth')
+
 AFFILIATION_VALUES = ["faculty", "student", "staff",
                       "employee", "member", "affiliate",
                       "alum", "library-walk-in"]
 
 
 class User(db.Model):
+    # Indexes to match the filters and ordering used by the user API
+    __table_args__ = (
+        db.Index('ix_user_state_keystone_user_id',
+                 'state', 'keystone_user_id'),
+        db.Index('ix_user_expiry_status_keystone_user_id',
+                 'expiry_status', 'keystone_user_id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     keystone_user_id = db.Column(db.String(64), unique=True)
     displayname = db.Column(db.String(250))
     email = db.Column(db.String(250))
     state = db.Column(db.Enum("new", "registered", "created"))
-    registered_at = db.Column(db.DateTime())
-    last_login = db.Column(db.DateTime())
+    registered_at = db.Column(db.DateTime(), index=True)
+    last_login = db.Column(db.DateTime(), index=True)
     terms_accepted_at = db.Column(db.DateTime())
     terms_version = db.Column(db.String(64))
     ignore_username_not_email = db.Column(db.Boolean())
@@ -66,11 +87,13 @@ class User(db.Model):
 
 class ExternalId(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey(User.id))
+    user_id = db.Column(db.Integer, db.ForeignKey(User.id), index=True)
     user = db.relationship("User", back_populates="external_ids")
     persistent_id = db.Column(db.String(250), unique=True)
     idp = db.Column(db.String(250))
-    attributes = db.Column(db.JSON)
+    # The raw Shibboleth attributes are only needed at login, so don't
+    # load them with every user
+    attributes = db.deferred(db.Column(db.JSON))
     last_login = db.Column(db.DateTime())
 
     def __init__(self, user, persistent_id, attributes):
@@ -79,22 +102,129 @@ class ExternalId(db.Model):
         self.attributes = attributes
 
 
+class TrialProject(db.Model):
+    """A trial project built ahead of time, waiting for a new user"""
+
+    __table_args__ = (
+        db.Index('ix_trial_project_domain_user_id', 'domain', 'user_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    project_id = db.Column(db.String(64), unique=True, nullable=False)
+    domain = db.Column(db.String(64), nullable=False)
+    created_at = db.Column(db.DateTime())
+    # Set once the project has been handed to a user
+    user_id = db.Column(db.Integer, db.ForeignKey(User.id))
+    claimed_at = db.Column(db.DateTime())
+
+    def __init__(self, project_id, domain):
+        self.project_id = project_id
+        self.domain = domain
+        self.created_at = datetime.datetime.now()
+
+
+class IdpDomainMapping(db.Model):
+    """The Keystone domain for the users of an IdP"""
+
+    id = db.Column(db.Integer, primary_key=True)
+    idp = db.Column(db.String(250), unique=True, nullable=False)
+    domain = db.Column(db.String(64), nullable=False)
+    created_at = db.Column(db.DateTime())
+    updated_at = db.Column(db.DateTime())
+
+    def __init__(self, idp, domain):
+        self.idp = idp
+        self.domain = domain
+        self.created_at = datetime.datetime.now()
+
+
+class ProvisioningRecord(db.Model):
+    """Progress of creating a user's account
+
+    Each step is recorded as it completes so a retried or redelivered
+    create_user resumes where the last attempt stopped.
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey(User.id), unique=True,
+                        nullable=False)
+    project_id = db.Column(db.String(64))
+    keystone_user_id = db.Column(db.String(64))
+    completed_steps = db.Column(db.JSON)
+    # Held while a worker is provisioning, so a duplicate message
+    # doesn't provision the same account concurrently
+    locked_until = db.Column(db.DateTime())
+    created_at = db.Column(db.DateTime())
+    updated_at = db.Column(db.DateTime())
+
+    def is_complete(self, step):
+        return step in (self.completed_steps or [])
+
+    def complete(self, *steps):
+        # Assign a new list, changes within the JSON aren't tracked
+        self.completed_steps = sorted(set(self.completed_steps or [])
+                                      | set(steps))
+        self.updated_at = datetime.datetime.now()
+
+
+class OrcidLookup(db.Model):
+    """The result of the last ORCID search for an email address
+
+    Most users without an ORCID don't have one, so not_found results
+    are kept too, to save searching for them on every login.
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    email = db.Column(db.String(250), unique=True, nullable=False)
+    status = db.Column(db.Enum("found", "not_found"), nullable=False)
+    orcid = db.Column(db.String(64))
+    checked_at = db.Column(db.DateTime(), nullable=False)
+
+    @property
+    def found(self):
+        return self.status == 'found'
+
+    def is_fresh(self, now=None):
+        ttl = (CONF.orcid.lookup_ttl if self.found
+               else CONF.orcid.lookup_negative_ttl)
+        now = now or datetime.datetime.now()
+        return self.checked_at + datetime.timedelta(seconds=ttl) > now
+
+
 def keystone_authenticate(db_user, project_id=None,
                           set_username_as_email=False):
     """Authenticate a user as their default project.
     """
-    k_session = keystone.KeystoneSession()
-    client = clients.get_admin_keystoneclient(k_session.get_session())
-    user = client.users.get(db_user.keystone_user_id)
-    domain = client.domains.get(user.domain_id)
+    start = time.monotonic()
+    timings = {}
+
+    def timed(name, func, *args, **kwargs):
+        start = time.monotonic()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timings[name] = time.monotonic() - start
+
+    admin_session = keystone.get_shared_session().get_session()
+    client = clients.get_admin_keystoneclient(admin_session)
+    user = timed('users.get', client.users.get, db_user.keystone_user_id)
+
+    # The domain is only needed for the user's token, so look it up
+    # while the user is re-enabled and synced
+    domain_future = _keystone_executor.submit(
+        timed, 'domains.get', keystone_cache.get_domain, client,
+        user.domain_id)
 
     if not user.enabled:
         if getattr(user, 'inactive', False):
-            client.users.update(user, enabled=True, inactive=False)
+            timed('users.update', client.users.update, user,
+                  enabled=True, inactive=False)
         else:
             flask.abort(401)
 
-    user = sync_keystone_user(client, db_user, user, set_username_as_email)
+    user = timed('sync', sync_keystone_user, client, db_user, user,
+                 set_username_as_email)
+    domain = domain_future.result()
 
     kwargs = {'username': user.name,
               'password': CONF.keystone.authenticate_password,
@@ -108,8 +238,16 @@ def keystone_authenticate(db_user, project_id=None,
     user_session = session.Session(auth=user_auth)
     user_client = keystone_client.Client(session=user_session)
 
-    token = user_client.auth.client.get_token()
-    projects = user_client.projects.list(user=user.id)
+    # The user's projects are listed with the (already authenticated)
+    # admin client so the listing doesn't wait for the user's token
+    projects_future = _keystone_executor.submit(
+        timed, 'projects.list', client.projects.list, user=user.id)
+    token = timed('get_token', user_client.auth.client.get_token)
+    projects = projects_future.result()
+
+    LOG.info("Keystone authentication for %s took %.3fs (%s)", user.id,
+             time.monotonic() - start,
+             ', '.join('%s %.3fs' % t for t in timings.items()))
 
     return token, projects[0].id, user
 
@@ -133,23 +271,129 @@ def sync_keystone_user(client, db_user, keystone_user,
     return keystone_user
 
 
-def create_db_user(shib_attrs):
+def _insert_ignore(table, values):
+    """Insert a row unless it would violate a unique constraint
+
+    Only key conflicts are ignored; any other error is raised. MySQL
+    reports the same row count whether or not the row was inserted, so
+    callers check the row itself afterwards.
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        stmt = postgresql.insert(table).on_conflict_do_nothing()
+    elif dialect == 'mysql':
+        # Unlike INSERT IGNORE, this doesn't also turn truncation and
+        # constraint errors into warnings
+        stmt = mysql.insert(table).on_duplicate_key_update(id=table.c.id)
+    elif dialect == 'sqlite':
+        stmt = table.insert().prefix_with('OR IGNORE')
+    else:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(table.insert().values(values))
+        except sqlalchemy.exc.IntegrityError:
+            pass
+        return
+    db.session.execute(stmt.values(values))
+
+
+def create_db_user(shib_attrs, commit=True):
     """Create a new user from the Shibboleth attributes
 
     Required Shibboleth attributes are `id`, `fullname` and `mail`
 
-    Return a newly created user.
+    The external id is claimed first with an insert that is ignored if
+    a concurrent login has already created it, in which case that
+    login's user is returned rather than failing on the unique
+    persistent_id.
+
+    With commit=False the new rows are only flushed, leaving the
+    caller to commit.
+
+    Return the user and its external id.
     """
-    # add db user
-    db_user = User()
-    external_id = ExternalId(db_user, shib_attrs['id'], shib_attrs)
-    external_id.idp = shib_attrs.get('idp')
-    db.session.add(db_user)
-    db.session.add(external_id)
-    db.session.commit()
+    _insert_ignore(ExternalId.__table__, {
+        'persistent_id': shib_attrs['id'],
+        'idp': shib_attrs.get('idp'),
+        'attributes': shib_attrs,
+    })
+    # A locking read sees the row committed by the other login even
+    # under repeatable read
+    external_id = db.session.query(ExternalId).filter_by(
+        persistent_id=shib_attrs['id']).options(
+            db.undefer(ExternalId.attributes)).with_for_update(
+                read=True).one()
+    if external_id.user is None:
+        db_user = User()
+        db.session.add(db_user)
+        external_id.user = db_user
+    else:
+        db_user = external_id.user
+        LOG.info("External id %s was created by a concurrent login",
+                 external_id.persistent_id)
+    if commit:
+        db.session.commit()
+    else:
+        db.session.flush()
     return db_user, external_id
 
 
+def acquire_provisioning_record(user_id, lease):
+    """Create or take the user's provisioning record for lease seconds
+
+    Return the record, or None if another worker holds it.
+    """
+    table = ProvisioningRecord.__table__
+    now = datetime.datetime.now()
+    _insert_ignore(table, {'user_id': user_id,
+                           'completed_steps': [],
+                           'created_at': now})
+    result = db.session.execute(
+        table.update().where(sqlalchemy.and_(
+            table.c.user_id == user_id,
+            sqlalchemy.or_(table.c.locked_until.is_(None),
+                           table.c.locked_until < now))).values(
+            locked_until=now + datetime.timedelta(seconds=lease)))
+    db.session.commit()
+    if result.rowcount != 1:
+        return None
+    return db.session.query(ProvisioningRecord).filter_by(
+        user_id=user_id).one()
+
+
+def release_provisioning_record(record_id):
+    table = ProvisioningRecord.__table__
+    db.session.execute(table.update().where(
+        table.c.id == record_id).values(locked_until=None))
+    db.session.commit()
+
+
+def get_orcid_lookup(email):
+    """Return the cached ORCID search for email, or None if it is stale"""
+    if not email:
+        return None
+    lookup = db.session.query(OrcidLookup).filter_by(
+        email=email.lower()).first()
+    if lookup is None or not lookup.is_fresh():
+        return None
+    return lookup
+
+
+def record_orcid_lookup(email, orcid, commit=True):
+    """Cache the result of an ORCID search for email"""
+    if not email:
+        return
+    table = OrcidLookup.__table__
+    values = {'status': 'found' if orcid else 'not_found',
+              'orcid': orcid,
+              'checked_at': datetime.datetime.now()}
+    _insert_ignore(table, dict(values, email=email.lower()))
+    db.session.execute(table.update().where(
+        table.c.email == email.lower()).values(values))
+    if commit:
+        db.session.commit()
+
+
 def _normalize(value):
     '''Normalize a string
 
@@ -205,9 +449,11 @@ def _merge_info_values(external_id, shib_attrs, name, current):
         return shib_current
 
 
-def update_db_user(db_user, external_id, shib_attrs):
+def update_db_user(db_user, external_id, shib_attrs, commit=True):
     """Update a DB User with new details passed from
     Shibboleth.
+
+    With commit=False the changes are left for the caller to commit.
     """
     db_user.displayname = shib_attrs["fullname"]
     db_user.email = shib_attrs["mail"]
@@ -246,9 +492,87 @@ def update_db_user(db_user, external_id, shib_attrs):
     external_id.attributes = shib_attrs
 
     date_now = datetime.datetime.now()
-    db_user.last_login = date_now
-    external_id.last_login = date_now
+    if (CONF.last_login_flush_interval > 0 and db_user.id is not None
+            and external_id.id is not None):
+        last_login_writer.record(db.engine, db_user.id, external_id.id,
+                                 date_now)
+        # Reflect the login without marking the rows dirty
+        orm_attributes.set_committed_value(db_user, 'last_login', date_now)
+        orm_attributes.set_committed_value(external_id, 'last_login',
+                                           date_now)
+    else:
+        db_user.last_login = date_now
+        external_id.last_login = date_now
     # Reset expiry if set
     db_user.expiry_status = None
     db_user.expiry_next_step = None
-    db.session.commit()
+    if commit:
+        db.session.commit()
+
+
+class LastLoginWriter(object):
+    """Coalesces last_login updates and writes them in batches
+
+    Only the latest login of each user and external id is kept, and
+    every [DEFAULT] last_login_flush_interval seconds the pending
+    updates are written with one executemany UPDATE per table.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._thread = None
+
+    def record(self, engine, user_id, external_id_id, when):
+        with self._lock:
+            users, external_ids = self._pending.setdefault(engine, ({}, {}))
+            users[user_id] = when
+            external_ids[external_id_id] = when
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run,
+                                                name='last-login-writer',
+                                                daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(max(CONF.last_login_flush_interval, 1))
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for engine, (users, external_ids) in pending.items():
+            try:
+                with engine.begin() as conn:
+                    for table, values in ((User.__table__, users),
+                                          (ExternalId.__table__,
+                                           external_ids)):
+                        self._update(conn, table, values)
+            except Exception:
+                LOG.exception("Failed to write %d last logins", len(users))
+                self._requeue(engine, users, external_ids)
+            else:
+                LOG.debug("Wrote %d last logins", len(users))
+
+    @staticmethod
+    def _update(conn, table, values):
+        if not values:
+            return
+        stmt = table.update().where(
+            table.c.id == sqlalchemy.bindparam('_id')).values(
+                last_login=sqlalchemy.bindparam('_last_login'))
+        conn.execute(stmt, [{'_id': id, '_last_login': when}
+                            for id, when in values.items()])
+
+    def _requeue(self, engine, users, external_ids):
+        # Keep any newer logins recorded while the flush was failing
+        with self._lock:
+            pending = self._pending.setdefault(engine, ({}, {}))
+            for current, failed in zip(pending, (users, external_ids)):
+                for id, when in failed.items():
+                    current.setdefault(id, when)
+
+
+last_login_writer = LastLoginWriter()
+atexit.register(last_login_writer.flush)
@@ -0,0 +1,303 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""User search backends
+
+``ILIKE '%term%'`` can't use an index, so MySQL uses a FULLTEXT ngram
+index, PostgreSQL pg_trgm indexes and SQLite an in-process n-gram index.
+All backends rank prefix matches first.
+"""
+
+import collections
+import threading
+import time
+import weakref
+
+from oslo_config import cfg
+from oslo_log import log as logging
+import sqlalchemy
+from sqlalchemy.ext import compiler
+from sqlalchemy.sql import expression
+from sqlalchemy.sql import sqltypes
+
+from manuka.extensions import db
+from manuka import models
+
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+NGRAM_SIZE = 3
+
+# Above this many candidates an IN (...) list is no cheaper than the
+# plain ILIKE scan
+MAX_CANDIDATES = 500
+
+
+def ngrams(value, n=NGRAM_SIZE):
+    value = (value or '').lower()
+    return {value[i:i + n] for i in range(len(value) - n + 1)}
+
+
+class NgramIndex(object):
+    """In-process n-gram index of user emails and display names
+
+    Maps each n-gram to the set of user ids whose email or display
+    name contains it. Built from the database and then kept up to date
+    as users are committed in this process. Writes made elsewhere are
+    only seen when it is rebuilt.
+    """
+
+    def __init__(self, n=NGRAM_SIZE):
+        self.n = n
+        self.built = False
+        self.built_at = None
+        # The highest id when the index was built
+        self.max_id = 0
+        self._lock = threading.Lock()
+        self._postings = collections.defaultdict(set)
+        self._docs = {}
+
+    def build(self, rows):
+        with self._lock:
+            self._postings.clear()
+            self._docs.clear()
+            self.max_id = 0
+            for row in rows:
+                self._add(row[0], row[1:])
+                self.max_id = max(self.max_id, row[0])
+            self.built = True
+            self.built_at = time.monotonic()
+        LOG.info("Built user search index of %d users", len(self._docs))
+
+    def add(self, id, *values):
+        with self._lock:
+            self._remove(id)
+            self._add(id, values)
+
+    def remove(self, id):
+        with self._lock:
+            self._remove(id)
+
+    def _add(self, id, values):
+        grams = set()
+        for value in values:
+            grams |= ngrams(value, self.n)
+        self._docs[id] = grams
+        for gram in grams:
+            self._postings[gram].add(id)
+
+    def _remove(self, id):
+        for gram in self._docs.pop(id, ()):
+            postings = self._postings[gram]
+            postings.discard(id)
+            if not postings:
+                del self._postings[gram]
+
+    def is_stale(self, ttl):
+        return (not self.built
+                or time.monotonic() - self.built_at >= ttl)
+
+    def candidates(self, term):
+        """Return the ids that may contain term, or None if unknown"""
+        grams = ngrams(term, self.n)
+        if not grams:
+            return None
+        with self._lock:
+            postings = sorted((self._postings.get(g, set()) for g in grams),
+                              key=len)
+            result = set(postings[0])
+            for p in postings[1:]:
+                result &= p
+                if not result:
+                    break
+        return result
+
+    def __len__(self):
+        return len(self._docs)
+
+
+# One index per engine, so separate apps (and tests) don't share state
+_indexes = weakref.WeakKeyDictionary()
+_indexes_lock = threading.Lock()
+
+
+def get_ngram_index(engine):
+    with _indexes_lock:
+        index = _indexes.get(engine)
+        if index is None:
+            index = _indexes[engine] = NgramIndex()
+    return index
+
+
+def _escape_like(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+class MatchAgainst(expression.ColumnElement):
+    """MySQL MATCH (columns) AGAINST (term IN BOOLEAN MODE)"""
+
+    type = sqltypes.Float()
+
+    def __init__(self, columns, term):
+        self.columns = columns
+        self.term = expression.literal(term)
+
+
+@compiler.compiles(MatchAgainst)
+def _compile_match_against(element, sql_compiler, **kw):
+    return "MATCH (%s) AGAINST (%s IN BOOLEAN MODE)" % (
+        ', '.join(sql_compiler.process(c, **kw) for c in element.columns),
+        sql_compiler.process(element.term, **kw))
+
+
+class LikeBackend(object):
+    """Substring match with ILIKE; works everywhere, uses no index"""
+
+    name = 'like'
+
+    def search(self, query, term):
+        query = query.filter(self._like(term))
+        return query.order_by(*self._rank(term))
+
+    def _like(self, term):
+        pattern = "%%%s%%" % _escape_like(term)
+        return db.or_(models.User.email.ilike(pattern, escape='\\'),
+                      models.User.displayname.ilike(pattern, escape='\\'))
+
+    def _rank(self, term):
+        prefix = "%s%%" % _escape_like(term)
+        is_prefix = db.or_(models.User.email.ilike(prefix, escape='\\'),
+                           models.User.displayname.ilike(prefix, escape='\\'))
+        return [db.case([(is_prefix, 0)], else_=1),
+                models.User.keystone_user_id]
+
+
+class NgramBackend(LikeBackend):
+    """ILIKE restricted to the candidates from an in-process n-gram index"""
+
+    name = 'ngram'
+
+    def search(self, query, term):
+        ttl = CONF.search_index_ttl
+        if ttl <= 0:
+            return super().search(query, term)
+        index = get_ngram_index(db.engine)
+        if index.is_stale(ttl):
+            index.build(db.session.query(models.User.id,
+                                         models.User.email,
+                                         models.User.displayname))
+        candidates = index.candidates(term)
+        if candidates is not None and len(candidates) <= MAX_CANDIDATES:
+            # Users created since the build, perhaps by another process,
+            # aren't in the index, so they are always checked. Changes
+            # other processes make to existing users are only seen
+            # once the index is rebuilt, after search_index_ttl seconds.
+            newer = models.User.id > index.max_id
+            if candidates:
+                query = query.filter(db.or_(
+                    models.User.id.in_(candidates), newer))
+            else:
+                query = query.filter(newer)
+        return super().search(query, term)
+
+
+class TrigramBackend(LikeBackend):
+    """PostgreSQL: ILIKE served by pg_trgm GIN indexes"""
+
+    name = 'trigram'
+
+    def _rank(self, term):
+        similarity = db.func.greatest(
+            db.func.similarity(models.User.email, term),
+            db.func.similarity(models.User.displayname, term))
+        rank = super()._rank(term)
+        return rank[:1] + [similarity.desc()] + rank[1:]
+
+
+class FulltextBackend(LikeBackend):
+    """MySQL: FULLTEXT index using the ngram parser"""
+
+    name = 'fulltext'
+
+    def search(self, query, term):
+        # A quoted phrase matches the term's n-grams in sequence. MATCH
+        # only narrows the candidates, ILIKE keeps results exact
+        # substring matches as with the other backends.
+        phrase = '"%s"' % term.replace('"', ' ')
+        match = MatchAgainst([models.User.email, models.User.displayname],
+                             phrase)
+        query = query.filter(match, self._like(term))
+        rank = self._rank(term)
+        return query.order_by(rank[0], match.desc(), *rank[1:])
+
+
+BACKENDS = {b.name: b for b in (LikeBackend, NgramBackend, TrigramBackend,
+                                FulltextBackend)}
+DIALECT_BACKENDS = {
+    'mysql': FulltextBackend,
+    'postgresql': TrigramBackend,
+    'sqlite': NgramBackend,
+}
+
+
+def get_backend():
+    name = CONF.search_backend
+    if name == 'auto':
+        backend = DIALECT_BACKENDS.get(db.engine.dialect.name, LikeBackend)
+    else:
+        backend = BACKENDS[name]
+    return backend()
+
+
+def search_users(query, term):
+    """Filter and rank a User query by a search term"""
+    return get_backend().search(query, term)
+
+
+# Keep the in-process n-gram indexes up to date. Changes are collected
+# as they are flushed and only applied once the transaction commits.
+
+def _record_change(op):
+    def listener(mapper, connection, target):
+        index = _indexes.get(connection.engine)
+        if index is None or not index.built:
+            return
+        session = sqlalchemy.orm.object_session(target)
+        if session is None:
+            return
+        session.info.setdefault('search_changes', []).append(
+            (index, op, target.id, target.email, target.displayname))
+    return listener
+
+
+def _apply_changes(session):
+    for index, op, id, email, displayname in session.info.pop(
+            'search_changes', []):
+        if op == 'delete':
+            index.remove(id)
+        else:
+            index.add(id, email, displayname)
+
+
+def _discard_changes(session):
+    session.info.pop('search_changes', None)
+
+
+for _op in ('insert', 'update', 'delete'):
+    sqlalchemy.event.listen(models.User, 'after_%s' % _op,
+                            _record_change(_op))
+sqlalchemy.event.listen(sqlalchemy.orm.Session, 'after_commit',
+                        _apply_changes)
+sqlalchemy.event.listen(sqlalchemy.orm.Session, 'after_rollback',
+                        _discard_changes)
@@ -0,0 +1,165 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from manuka.common import idp_domains
+from manuka.extensions import db
+from manuka import models
+from manuka.tests.unit import base
+
+
+class TestIdpDomainMappingApi(base.ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.mapping = models.IdpDomainMapping('https://idp1', 'domain1')
+        db.session.add(self.mapping)
+        db.session.add(models.IdpDomainMapping('https://idp2', 'domain2'))
+        db.session.commit()
+
+    def test_list(self):
+        response = self.client.get('/api/v1/idp-domain-mappings/')
+        self.assert200(response)
+        data = response.get_json()
+        self.assertEqual(2, data['total'])
+        self.assertEqual(['https://idp1', 'https://idp2'],
+                         [m['idp'] for m in data['results']])
+
+    def test_list_domain(self):
+        response = self.client.get(
+            '/api/v1/idp-domain-mappings/?domain=domain2')
+        self.assert200(response)
+        results = response.get_json()['results']
+        self.assertEqual(['https://idp2'], [m['idp'] for m in results])
+
+    def test_create(self):
+        # Looked up, and cached, before the mapping exists
+        self.assertEqual('default', idp_domains.get_domain('https://idp3'))
+
+        response = self.client.post('/api/v1/idp-domain-mappings/',
+                                    json={'idp': 'https://idp3',
+                                          'domain': 'domain3'})
+        self.assertStatus(response, 201)
+        data = response.get_json()
+        self.assertEqual('https://idp3', data['idp'])
+        self.assertEqual('domain3', data['domain'])
+        mapping = db.session.query(models.IdpDomainMapping).get(data['id'])
+        self.assertEqual('domain3', mapping.domain)
+        self.assertEqual('domain3', idp_domains.get_domain('https://idp3'))
+
+    def test_create_duplicate(self):
+        response = self.client.post('/api/v1/idp-domain-mappings/',
+                                    json={'idp': 'https://idp1',
+                                          'domain': 'domain3'})
+        self.assertStatus(response, 409)
+
+    def test_create_invalid(self):
+        response = self.client.post('/api/v1/idp-domain-mappings/',
+                                    json={'idp': 'https://idp3'})
+        self.assert400(response)
+        response = self.client.post('/api/v1/idp-domain-mappings/',
+                                    json={'idp': 'https://idp3',
+                                          'domain': 'domain3',
+                                          'id': 7})
+        self.assert400(response)
+
+    def test_get(self):
+        response = self.client.get('/api/v1/idp-domain-mappings/%s/'
+                                   % self.mapping.id)
+        self.assert200(response)
+        self.assertEqual('domain1', response.get_json()['domain'])
+
+    def test_get_missing(self):
+        response = self.client.get('/api/v1/idp-domain-mappings/999/')
+        self.assert404(response)
+
+    def test_update(self):
+        self.assertEqual('domain1', idp_domains.get_domain('https://idp1'))
+        response = self.client.patch('/api/v1/idp-domain-mappings/%s/'
+                                     % self.mapping.id,
+                                     json={'domain': 'domain3'})
+        self.assert200(response)
+        self.assertEqual('domain3', response.get_json()['domain'])
+        self.assertIsNotNone(response.get_json()['updated_at'])
+        self.assertEqual('domain3', idp_domains.get_domain('https://idp1'))
+
+    def test_update_idp(self):
+        response = self.client.patch('/api/v1/idp-domain-mappings/%s/'
+                                     % self.mapping.id,
+                                     json={'idp': 'https://other'})
+        self.assert400(response)
+
+    def test_delete(self):
+        self.assertEqual('domain1', idp_domains.get_domain('https://idp1'))
+        response = self.client.delete('/api/v1/idp-domain-mappings/%s/'
+                                      % self.mapping.id)
+        self.assertStatus(response, 204)
+        self.assertEqual(1, db.session.query(
+            models.IdpDomainMapping).count())
+        self.assertEqual('default', idp_domains.get_domain('https://idp1'))
+
+
+class TestIdpDomainMappingApiUser(TestIdpDomainMappingApi):
+
+    ROLES = ['member']
+
+    def test_list(self):
+        response = self.client.get('/api/v1/idp-domain-mappings/')
+        self.assert403(response)
+
+    def test_list_domain(self):
+        response = self.client.get(
+            '/api/v1/idp-domain-mappings/?domain=domain2')
+        self.assert403(response)
+
+    def test_create(self):
+        response = self.client.post('/api/v1/idp-domain-mappings/',
+                                    json={'idp': 'https://idp3',
+                                          'domain': 'domain3'})
+        self.assert403(response)
+
+    def test_create_duplicate(self):
+        response = self.client.post('/api/v1/idp-domain-mappings/',
+                                    json={'idp': 'https://idp1',
+                                          'domain': 'domain3'})
+        self.assert403(response)
+
+    def test_create_invalid(self):
+        response = self.client.post('/api/v1/idp-domain-mappings/',
+                                    json={'idp': 'https://idp3'})
+        self.assert403(response)
+
+    def test_get(self):
+        response = self.client.get('/api/v1/idp-domain-mappings/%s/'
+                                   % self.mapping.id)
+        self.assert404(response)
+
+    def test_update(self):
+        response = self.client.patch('/api/v1/idp-domain-mappings/%s/'
+                                     % self.mapping.id,
+                                     json={'domain': 'domain3'})
+        self.assert404(response)
+        self.assertEqual('domain1', db.session.query(
+            models.IdpDomainMapping).get(self.mapping.id).domain)
+
+    def test_update_idp(self):
+        response = self.client.patch('/api/v1/idp-domain-mappings/%s/'
+                                     % self.mapping.id,
+                                     json={'idp': 'https://other'})
+        self.assert404(response)
+
+    def test_delete(self):
+        response = self.client.delete('/api/v1/idp-domain-mappings/%s/'
+                                      % self.mapping.id)
+        self.assert404(response)
+        self.assertEqual(2, db.session.query(
+            models.IdpDomainMapping).count())
@@ -0,0 +1,75 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import datetime
+
+import marshmallow
+
+from manuka.api.v1.schemas import compiled
+from manuka.api.v1.schemas import user as schemas
+from manuka.extensions import db
+from manuka import models
+from manuka.tests.unit import base
+
+
+class TestCompiledSchema(base.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.make_db_user(id=1, state='created',
+                          expiry_status='warning',
+                          expiry_next_step=datetime.date(2030, 1, 2))
+        self.make_db_user(id=2, state='registered', orcid=None)
+        user3, external_id = self.make_db_user(id=3, keystone_user_id=None)
+        user3.affiliation = 'staff'
+        user3.ignore_username_not_email = None
+        external_id.last_login = datetime.datetime(2020, 1, 2, 3, 4, 5, 6)
+        db.session.commit()
+        self.users = db.session.query(models.User).order_by(
+            models.User.id).all()
+
+    def test_users(self):
+        self.assertEqual(schemas.users.dump(self.users),
+                         compiled.dump(schemas.users, self.users))
+
+    def test_user(self):
+        for user in self.users:
+            self.assertEqual(schemas.user.dump(user),
+                             compiled.dump(schemas.user, user))
+
+    def test_pending_users(self):
+        self.assertEqual(schemas.pending_users.dump(self.users),
+                         compiled.dump(schemas.pending_users, self.users))
+
+    def test_only(self):
+        schema = schemas.UserSchema(many=True,
+                                    only=('id', 'email', 'external_ids'))
+        self.assertEqual(schema.dump(self.users),
+                         compiled.dump(schema, self.users))
+
+    def test_serializer_cached(self):
+        self.assertIs(compiled.get_serializer(schemas.users),
+                      compiled.get_serializer(schemas.UserSchema(many=True)))
+        self.assertIsNot(compiled.get_serializer(schemas.users),
+                         compiled.get_serializer(schemas.user))
+
+    def test_hooks_not_compiled(self):
+        class HookedSchema(schemas.UserSchema):
+            @marshmallow.post_dump
+            def add(self, data, **kwargs):
+                data['extra'] = True
+                return data
+
+        schema = HookedSchema()
+        self.assertIs(schema, compiled.get_serializer(schema))
+        self.assertTrue(compiled.dump(schema, self.users[0])['extra'])
@@ -11,13 +11,23 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import csv
+import io
+import json
 from unittest import mock
 
+from oslo_config import cfg
+import sqlalchemy
+
+from manuka.api.v1.resources import user
 from manuka.extensions import db
 from manuka import models
 from manuka.tests.unit import base
 
 
+CONF = cfg.CONF
+
+
 class TestUserApiBase(base.ApiTestCase):
 
     def setUp(self):
@@ -48,6 +58,213 @@ class TestUserApi(TestUserApiBase):
         results = response.get_json().get('results')
         self.assertEqual(2, len(results))
 
+    def test_user_list_cursor(self):
+        for id in range(10, 15):
+            self.make_db_user(id=id, email='test%s@example.com' % id)
+
+        seen = []
+        url = '/api/v1/users/?limit=2&cursor='
+        while url:
+            response = self.client.get(url)
+            self.assert200(response)
+            data = response.get_json()
+            self.assertNotIn('total', data)
+            self.assertLessEqual(len(data['results']), 2)
+            seen.extend(u['id'] for u in data['results'])
+            url = data.get('next')
+        self.assertEqual(6, len(seen))
+        self.assertEqual(sorted(seen), seen)
+
+    def test_user_list_cursor_keeps_filters(self):
+        for id in range(10, 13):
+            self.make_db_user(id=id, state='created')
+        response = self.client.get(
+            '/api/v1/users/?state=created&limit=2&cursor=')
+        data = response.get_json()
+        self.assertEqual(['ksid-10', 'ksid-11'],
+                         [u['id'] for u in data['results']])
+
+        response = self.client.get(data['next'])
+        data = response.get_json()
+        self.assertEqual(['ksid-12'], [u['id'] for u in data['results']])
+        self.assertNotIn('next', data)
+
+    def test_user_list_pages(self):
+        for id in range(10, 13):
+            self.make_db_user(id=id, state='created')
+        response = self.client.get('/api/v1/users/?state=created&limit=2')
+        data = response.get_json()
+        self.assertEqual(3, data['total'])
+        self.assertEqual(['ksid-10', 'ksid-11'],
+                         [u['id'] for u in data['results']])
+
+        response = self.client.get(data['next'])
+        data = response.get_json()
+        self.assertEqual(['ksid-12'], [u['id'] for u in data['results']])
+        self.assertNotIn('next', data)
+
+    def test_user_list_page_out_of_range(self):
+        self.assert404(self.client.get('/api/v1/users/?page=2'))
+        self.assert404(self.client.get('/api/v1/users/?page=0'))
+
+    def test_user_list_without_total(self):
+        self.make_db_user(id=10)
+        statements = []
+
+        def capture(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        sqlalchemy.event.listen(db.engine, 'before_cursor_execute', capture)
+        self.addCleanup(sqlalchemy.event.remove, db.engine,
+                        'before_cursor_execute', capture)
+        response = self.client.get('/api/v1/users/?with_total=false&limit=1')
+
+        self.assert200(response)
+        data = response.get_json()
+        self.assertNotIn('total', data)
+        self.assertIn('with_total=false', data['next'])
+        self.assertEqual(1, len(statements))
+        self.assertNotIn('count(', statements[0].lower())
+
+    def test_user_list_estimated_total(self):
+        url = '/api/v1/users/?with_total=estimated'
+        self.assertEqual(1, self.client.get(url).get_json()['total'])
+        self.make_db_user(id=10)
+        # Served from the cache until it expires
+        self.assertEqual(1, self.client.get(url).get_json()['total'])
+        self.assertEqual(2, self.client.get(
+            url + '&state=new').get_json()['total'])
+        self.assertEqual(2, self.client.get(
+            '/api/v1/users/').get_json()['total'])
+
+    def test_user_list_estimated_total_disabled(self):
+        CONF.set_override('count_cache_ttl', 0, 'api')
+        url = '/api/v1/users/?with_total=estimated'
+        self.assertEqual(1, self.client.get(url).get_json()['total'])
+        self.make_db_user(id=10)
+        self.assertEqual(2, self.client.get(url).get_json()['total'])
+
+    def test_user_list_with_total_invalid(self):
+        self.assert400(self.client.get('/api/v1/users/?with_total=maybe'))
+
+    def test_user_list_cursor_invalid(self):
+        response = self.client.get('/api/v1/users/?cursor=bogus')
+        self.assert400(response)
+
+    def test_user_list_fields(self):
+        statements = []
+
+        def capture(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        sqlalchemy.event.listen(db.engine, 'before_cursor_execute', capture)
+        self.addCleanup(sqlalchemy.event.remove, db.engine,
+                        'before_cursor_execute', capture)
+        response = self.client.get('/api/v1/users/?fields=email,state')
+
+        self.assert200(response)
+        results = response.get_json().get('results')
+        self.assertEqual([{'email': self.user.email,
+                           'state': self.user.state}], results)
+        for statement in statements:
+            self.assertNotIn('external_id', statement)
+            self.assertNotIn('displayname', statement)
+
+    def test_user_list_fields_external_ids(self):
+        response = self.client.get('/api/v1/users/?fields=id,external_ids')
+
+        self.assert200(response)
+        results = response.get_json().get('results')
+        self.assertEqual({'id', 'external_ids'}, set(results[0]))
+        self.assertUserEqual(self.user, results[0])
+
+    def test_user_list_fields_unknown(self):
+        response = self.client.get('/api/v1/users/?fields=email,bogus')
+        self.assert400(response)
+
+    def test_user_get_fields(self):
+        response = self.client.get('/api/v1/users/%s/?fields=email' %
+                                   self.user.keystone_user_id)
+
+        self.assert200(response)
+        self.assertEqual({'email': self.user.email}, response.get_json())
+
+    def test_user_export(self):
+        user2, external_id = self.make_db_user(
+            id=10, state='created', email='test10@example.com')
+        response = self.client.get('/api/v1/users/export/')
+
+        self.assert200(response)
+        self.assertEqual('application/x-ndjson', response.mimetype)
+        results = [json.loads(line) for line in
+                   response.get_data(as_text=True).splitlines()]
+        self.assertEqual(2, len(results))
+        self.assertUserEqual(user2, results[0])
+        self.assertUserEqual(self.user, results[1])
+
+    def test_user_export_batches(self):
+        for i in range(2, 7):
+            self.make_db_user(id=i, state='created',
+                              email='test%d@example.com' % i)
+        with mock.patch.object(user.UserExport, 'BATCH_SIZE', 2):
+            response = self.client.get('/api/v1/users/export/')
+            # The body is generated as it's read
+            data = response.get_data(as_text=True)
+
+        self.assert200(response)
+        results = [json.loads(line) for line in data.splitlines()]
+        self.assertEqual(['ksid-%d' % i for i in (2, 3, 4, 5, 6, 1324)],
+                         [r['id'] for r in results])
+        for result in results:
+            self.assertEqual(1, len(result['external_ids']))
+
+    def test_user_export_filtered(self):
+        self.make_db_user(id=10, state='created', email='test10@example.com')
+        response = self.client.get('/api/v1/users/export/?state=new')
+
+        self.assert200(response)
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(1, len(lines))
+        self.assertEqual(self.user.keystone_user_id,
+                         json.loads(lines[0])['id'])
+
+    def test_user_export_csv(self):
+        response = self.client.get('/api/v1/users/export/?format=csv')
+
+        self.assert200(response)
+        self.assertEqual('text/csv', response.mimetype)
+        rows = list(csv.DictReader(
+            io.StringIO(response.get_data(as_text=True))))
+        self.assertEqual(1, len(rows))
+        self.assertNotIn('external_ids', rows[0])
+        self.assertEqual(self.user.keystone_user_id, rows[0]['id'])
+        self.assertEqual(self.user.email, rows[0]['email'])
+
+    def test_user_export_csv_statements(self):
+        for i in range(2, 7):
+            self.make_db_user(id=i, state='created',
+                              email='test%d@example.com' % i)
+        statements = []
+
+        def capture(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        sqlalchemy.event.listen(db.engine, 'before_cursor_execute', capture)
+        self.addCleanup(sqlalchemy.event.remove, db.engine,
+                        'before_cursor_execute', capture)
+        with mock.patch.object(user.UserExport, 'BATCH_SIZE', 2):
+            response = self.client.get('/api/v1/users/export/?format=csv')
+            data = response.get_data(as_text=True)
+
+        self.assert200(response)
+        rows = list(csv.DictReader(io.StringIO(data)))
+        self.assertEqual(6, len(rows))
+        # One query per batch of users (the last one is empty), none
+        # per row for external IDs
+        self.assertEqual(4, len(statements))
+        for statement in statements:
+            self.assertNotIn('FROM external_id', statement)
+
     def test_user_get(self):
         response = self.client.get('/api/v1/users/%s/' %
                                    self.user.keystone_user_id)
@@ -148,6 +365,85 @@ class TestUserApiUser(TestUserApi):
         response = self.client.get('/api/v1/users/?expiry_status=active')
         self.assert403(response)
 
+    def test_user_list_cursor(self):
+        response = self.client.get('/api/v1/users/?cursor=')
+        self.assert403(response)
+
+    def test_user_list_fields(self):
+        response = self.client.get('/api/v1/users/?fields=email,state')
+        self.assert403(response)
+
+    def test_user_list_pages(self):
+        response = self.client.get('/api/v1/users/?limit=2')
+        self.assert403(response)
+
+    def test_user_list_page_out_of_range(self):
+        response = self.client.get('/api/v1/users/?page=2')
+        self.assert403(response)
+
+    def test_user_list_without_total(self):
+        response = self.client.get('/api/v1/users/?with_total=false')
+        self.assert403(response)
+
+    def test_user_list_estimated_total(self):
+        response = self.client.get('/api/v1/users/?with_total=estimated')
+        self.assert403(response)
+
+    def test_user_list_estimated_total_disabled(self):
+        response = self.client.get('/api/v1/users/?with_total=estimated')
+        self.assert403(response)
+
+    def test_user_list_with_total_invalid(self):
+        response = self.client.get('/api/v1/users/?with_total=maybe')
+        self.assert403(response)
+
+    def test_user_list_fields_external_ids(self):
+        response = self.client.get('/api/v1/users/?fields=id,external_ids')
+        self.assert403(response)
+
+    def test_user_list_fields_unknown(self):
+        response = self.client.get('/api/v1/users/?fields=email,bogus')
+        self.assert403(response)
+
+    def test_user_get_fields(self):
+        response = self.client.get('/api/v1/users/%s/?fields=email' %
+                                   self.user.keystone_user_id)
+        self.assert404(response)
+
+    def test_user_get_self_fields(self):
+        response = self.client.get('/api/v1/users/%s/?fields=email' %
+                                   base.KEYSTONE_USER_ID)
+        self.assert200(response)
+        self.assertEqual({'email': self.user_self.email}, response.get_json())
+
+    def test_user_export(self):
+        response = self.client.get('/api/v1/users/export/')
+        self.assert403(response)
+
+    def test_user_export_batches(self):
+        response = self.client.get('/api/v1/users/export/')
+        self.assert403(response)
+
+    def test_user_export_filtered(self):
+        response = self.client.get('/api/v1/users/export/?state=new')
+        self.assert403(response)
+
+    def test_user_export_csv(self):
+        response = self.client.get('/api/v1/users/export/?format=csv')
+        self.assert403(response)
+
+    def test_user_export_csv_statements(self):
+        response = self.client.get('/api/v1/users/export/?format=csv')
+        self.assert403(response)
+
+    def test_user_list_cursor_keeps_filters(self):
+        response = self.client.get('/api/v1/users/?state=created&cursor=')
+        self.assert403(response)
+
+    def test_user_list_cursor_invalid(self):
+        response = self.client.get('/api/v1/users/?cursor=bogus')
+        self.assert403(response)
+
     def test_user_get(self):
         response = self.client.get('/api/v1/users/%s/' %
                                    self.user.keystone_user_id)
@@ -243,6 +539,31 @@ class PendingTestUserApi(base.ApiTestCase):
         self.assertEqual(1, len(results))
         self.assertUserEqual(self.user, results[0])
 
+    def test_user_list_cursor(self):
+        user4, external_id4 = self.make_db_user(
+            id=2470,
+            state='registered', agreed_terms=True, email='test4@example.com',
+            keystone_user_id=None)
+
+        response = self.client.get('/api/v1/pending-users/?limit=1&cursor=')
+        self.assert200(response)
+        data = response.get_json()
+        self.assertEqual([self.user.id], [u['id'] for u in data['results']])
+
+        response = self.client.get(data['next'])
+        self.assert200(response)
+        data = response.get_json()
+        self.assertEqual([user4.id], [u['id'] for u in data['results']])
+        self.assertNotIn('next', data)
+
+    def test_user_list_fields(self):
+        response = self.client.get('/api/v1/pending-users/?fields=id,email')
+
+        self.assert200(response)
+        results = response.get_json().get('results')
+        self.assertEqual([{'id': self.user.id, 'email': self.user.email}],
+                         results)
+
     def test_user_get(self):
         response = self.client.get('/api/v1/pending-users/%s/' %
                                    self.user.id)
@@ -273,11 +594,67 @@ class PendingTestUserApi(base.ApiTestCase):
         self.assert404(response)
 
 
+class UserListIndexTest(TestUserApiBase):
+    """Check the user list queries are served by an index"""
+
+    def _query_plans(self, url):
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context,
+                    executemany):
+            if 'FROM user' in statement:
+                statements.append((statement, parameters))
+
+        sqlalchemy.event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            response = self.client.get(url)
+        finally:
+            sqlalchemy.event.remove(db.engine, 'before_cursor_execute',
+                                    capture)
+        self.assert200(response)
+        self.assertTrue(statements)
+        return [db.engine.execute('EXPLAIN QUERY PLAN ' + statement,
+                                  parameters).fetchall()
+                for statement, parameters in statements]
+
+    def _assert_uses_index(self, url, index):
+        # The planner may walk the keystone_user_id index to satisfy
+        # ORDER BY ... LIMIT for the page itself, but no statement should
+        # fall back to a full table scan.
+        details = [row[-1] for plan in self._query_plans(url)
+                   for row in plan]
+        self.assertTrue(any(index in d for d in details),
+                        msg="%s not used for %s: %s" % (index, url, details))
+        for d in details:
+            self.assertNotRegex(d, r'^SCAN (user|external_id)\b')
+
+    def test_state(self):
+        self._assert_uses_index('/api/v1/users/?state=created',
+                                'ix_user_state_keystone_user_id')
+
+    def test_expiry_status(self):
+        self._assert_uses_index('/api/v1/users/?expiry_status=inactive',
+                                'ix_user_expiry_status_keystone_user_id')
+
+    def test_last_login(self):
+        self._assert_uses_index('/api/v1/users/?last_login__lt=2020-01-01',
+                                'ix_user_last_login')
+
+    def test_registered_at(self):
+        self._assert_uses_index(
+            '/api/v1/users/?registered_at__lt=2020-01-01',
+            'ix_user_registered_at')
+
+    def test_pending(self):
+        self._assert_uses_index('/api/v1/pending-users/',
+                                'sqlite_autoindex_user_1')
+
+
 class ProjectsWithRoleTestUserApi(TestUserApiBase):
 
     @mock.patch('manuka.common.clients.get_admin_keystoneclient')
     @mock.patch('manuka.models.keystone_authenticate')
-    @mock.patch('manuka.worker.utils.get_roles')
+    @mock.patch('manuka.common.keystone_cache.get_roles')
     def test_user_projects(self, mock_get_roles, mock_ks_auth, mock_get):
         role = mock.Mock()
         role.name = 'role1'
@@ -19,6 +19,9 @@ from oslo_config import cfg
 from oslo_context import context
 
 from manuka import app
+from manuka.common import cache
+from manuka.common import clients
+from manuka.common import idp_domains
 from manuka.common import keystone
 from manuka import extensions
 from manuka.extensions import db
@@ -51,6 +54,10 @@ class TestCase(flask_testing.TestCase):
         db.session.remove()
         db.drop_all()
         cfg.CONF.reset()
+        cache.clear_all()
+        keystone.reset_shared_sessions()
+        clients.reset_orcid_client()
+        idp_domains.reset()
         extensions.api.resources = []
 
     def make_db_user(self, state='new', agreed_terms=True,
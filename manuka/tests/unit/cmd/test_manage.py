@@ -0,0 +1,110 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from unittest import mock
+
+from requests import exceptions
+
+from manuka.cmd import manage
+from manuka.extensions import db
+from manuka import models
+from manuka.tests.unit import base
+
+
+class TestImportIdpDomainMappings(base.TestCase):
+
+    def _mappings(self):
+        return {m.idp: m.domain
+                for m in db.session.query(models.IdpDomainMapping)}
+
+    def test_import(self):
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(manage.import_idp_domain_mappings)
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertIn("Added 1 and updated 0", result.output)
+        self.assertEqual({'https://idp2': 'domain123'}, self._mappings())
+
+        # Importing again changes nothing
+        result = runner.invoke(manage.import_idp_domain_mappings)
+        self.assertIn("Added 0 and updated 0", result.output)
+
+    def test_import_existing(self):
+        db.session.add(models.IdpDomainMapping('https://idp2', 'other'))
+        db.session.commit()
+        runner = self.app.test_cli_runner()
+
+        result = runner.invoke(manage.import_idp_domain_mappings)
+        self.assertIn("Added 0 and updated 0", result.output)
+        self.assertEqual({'https://idp2': 'other'}, self._mappings())
+
+        result = runner.invoke(manage.import_idp_domain_mappings,
+                               ['--update'])
+        self.assertIn("Added 0 and updated 1", result.output)
+        db.session.expire_all()
+        self.assertEqual({'https://idp2': 'domain123'}, self._mappings())
+
+
+class TestRefreshAllOrcids(base.TestCase):
+
+    ORCIDS = {'found@example.com': '0000-0001-0000-0001',
+              'has@example.com': '0000-0001-0000-0002'}
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('manuka.common.clients.get_orcid_client')
+        self.client = patcher.start().return_value
+        self.client.search_by_email.side_effect = self._search
+        self.make_db_user(id=1, email='found@example.com', orcid=None)
+        self.make_db_user(id=2, email='missing@example.com', orcid=None)
+        self.make_db_user(id=3, email='has@example.com', orcid='old')
+        self.make_db_user(id=4, email='cached@example.com', orcid='')
+        self.make_db_user(id=5, email='broken@example.com', orcid=None)
+        models.record_orcid_lookup('cached@example.com', None)
+
+    def _search(self, email):
+        if email == 'broken@example.com':
+            raise exceptions.HTTPError("404 Client Error")
+        return self.ORCIDS.get(email)
+
+    def _orcids(self):
+        db.session.expire_all()
+        return {u.id: u.orcid for u in db.session.query(models.User)}
+
+    def _searched(self):
+        return sorted(c[0][0] for c in
+                      self.client.search_by_email.call_args_list)
+
+    def test_refresh_all(self):
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(manage.refresh_all_orcids,
+                               ['--batch-size', '2', '--rate', '1000'])
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertIn("Found 1 ORCIDs (1 changed), 1 not found, 1 failed "
+                      "and 1 skipped", result.output)
+        self.assertIn("Search for user 5 failed", result.output)
+        self.assertEqual(['broken@example.com', 'found@example.com',
+                          'missing@example.com'], self._searched())
+        self.assertEqual({1: '0000-0001-0000-0001', 2: None, 3: 'old',
+                          4: '', 5: None}, self._orcids())
+        self.assertFalse(models.get_orcid_lookup('missing@example.com').found)
+        self.assertIsNone(models.get_orcid_lookup('broken@example.com'))
+
+    def test_refresh_all_users(self):
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(manage.refresh_all_orcids,
+                               ['--all', '--force', '--rate', '1000'])
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertIn("Found 2 ORCIDs (2 changed), 2 not found, 1 failed "
+                      "and 0 skipped", result.output)
+        self.assertEqual(5, len(self._searched()))
+        self.assertEqual('0000-0001-0000-0002', self._orcids()[3])
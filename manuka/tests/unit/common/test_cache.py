@@ -0,0 +1,66 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from unittest import mock
+
+from manuka.common import cache
+from manuka.tests.unit import base
+
+
+@mock.patch('time.monotonic')
+class TestTTLCache(base.TestCase):
+
+    def test_get_set(self, mock_time):
+        mock_time.return_value = 100
+        c = cache.TTLCache(10)
+        self.assertIsNone(c.get('a'))
+        c.set('a', 1)
+        self.assertEqual(1, c.get('a'))
+        self.assertEqual({'hits': 1, 'misses': 1, 'size': 1}, c.stats())
+
+    def test_expiry(self, mock_time):
+        mock_time.return_value = 100
+        c = cache.TTLCache(10)
+        c.set('a', 1)
+        mock_time.return_value = 110
+        self.assertEqual('gone', c.get('a', 'gone'))
+        self.assertEqual(0, len(c))
+
+    def test_callable_ttl(self, mock_time):
+        mock_time.return_value = 100
+        ttl = mock.Mock(return_value=0)
+        c = cache.TTLCache(ttl)
+        c.set('a', 1)
+        self.assertIsNone(c.get('a'))
+        ttl.return_value = 5
+        c.set('a', 1)
+        self.assertEqual(1, c.get('a'))
+
+    def test_maxsize(self, mock_time):
+        mock_time.return_value = 100
+        c = cache.TTLCache(10, maxsize=2)
+        for key in 'abc':
+            c.set(key, key)
+        self.assertIsNone(c.get('a'))
+        self.assertEqual('c', c.get('c'))
+        self.assertEqual(2, len(c))
+
+    def test_invalidate_and_clear_all(self, mock_time):
+        mock_time.return_value = 100
+        c = cache.TTLCache(10)
+        c.set('a', 1)
+        c.set('b', 2)
+        c.invalidate('a')
+        self.assertIsNone(c.get('a'))
+        cache.clear_all()
+        self.assertIsNone(c.get('b'))
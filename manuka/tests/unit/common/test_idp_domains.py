@@ -0,0 +1,137 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import tempfile
+from unittest import mock
+
+from oslo_config import cfg
+
+from manuka.common import idp_domains
+from manuka.extensions import db
+from manuka import models
+from manuka.tests.unit import base
+
+
+CONF = cfg.CONF
+
+
+class TestIdpDomainIndex(base.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = tmp.name
+        CONF.set_override('idp_domain_mapping_dir', self.path)
+        CONF.set_override('idp_domain_mapping_check_interval', 0)
+        self.index = idp_domains.IdpDomainIndex()
+
+    def _write(self, domain, *idps, mtime=None):
+        filename = os.path.join(self.path, domain)
+        with open(filename, 'w') as f:
+            f.write('\n'.join(idps) + '\n')
+        if mtime is not None:
+            os.utime(filename, ns=(mtime, mtime))
+
+    def test_lookup(self):
+        self._write('domain1', 'https://idp1', 'https://idp2')
+        self._write('domain2', 'https://idp3')
+        self.assertEqual('domain1', self.index.lookup('https://idp2'))
+        self.assertEqual('domain2', self.index.lookup('https://idp3'))
+        self.assertIsNone(self.index.lookup('https://other'))
+        self.assertIsNone(self.index.lookup(''))
+        stats = self.index.stats()
+        self.assertEqual(1, stats['reloads'])
+        self.assertEqual(4, stats['lookups'])
+        self.assertEqual(3, stats['size'])
+
+    def test_reload_on_change(self):
+        self._write('domain1', 'https://idp1', mtime=10 ** 18)
+        self.assertEqual('domain1', self.index.lookup('https://idp1'))
+        self.index.lookup('https://idp1')
+        self.assertEqual(1, self.index.reloads)
+
+        # An edit in place only changes the file's mtime and size
+        self._write('domain1', 'https://idp2', mtime=2 * 10 ** 18)
+        self.assertEqual('domain1', self.index.lookup('https://idp2'))
+        self.assertIsNone(self.index.lookup('https://idp1'))
+        self.assertEqual(2, self.index.reloads)
+
+        os.unlink(os.path.join(self.path, 'domain1'))
+        self.assertIsNone(self.index.lookup('https://idp2'))
+        self.assertEqual(3, self.index.reloads)
+
+    def test_check_interval(self):
+        CONF.set_override('idp_domain_mapping_check_interval', 60)
+        self._write('domain1', 'https://idp1')
+        self.index.lookup('https://idp1')
+        with mock.patch('os.scandir') as mock_scandir:
+            self.index.lookup('https://idp1')
+        mock_scandir.assert_not_called()
+
+        # A new directory is loaded straight away
+        CONF.set_override('idp_domain_mapping_dir', 'missing')
+        self.assertIsNone(self.index.lookup('https://idp1'))
+        self.assertEqual(2, self.index.reloads)
+
+    def test_missing_dir(self):
+        CONF.set_override('idp_domain_mapping_dir',
+                          os.path.join(self.path, 'missing'))
+        self.assertIsNone(self.index.lookup('https://idp1'))
+        self.assertEqual('default', idp_domains.get_domain('https://idp1'))
+
+    def test_duplicate(self):
+        self._write('b-domain', 'https://idp1')
+        self._write('a-domain', 'https://idp1')
+        self.assertEqual('a-domain', self.index.lookup('https://idp1'))
+
+
+class TestGetDomain(base.TestCase):
+
+    def test_database(self):
+        db.session.add(models.IdpDomainMapping('https://idp2', 'db-domain'))
+        db.session.commit()
+        # The database takes precedence over the mapping files
+        self.assertEqual('db-domain', idp_domains.get_domain('https://idp2'))
+
+    def test_file_fallback(self):
+        self.assertEqual('domain123', idp_domains.get_domain('https://idp2'))
+        self.assertEqual('default', idp_domains.get_domain('https://idp3'))
+        self.assertEqual('default', idp_domains.get_domain(None))
+
+    def test_cached(self):
+        db.session.add(models.IdpDomainMapping('https://idp3', 'db-domain'))
+        db.session.commit()
+        idp_domains.get_domain('https://idp3')
+        idp_domains.get_domain('https://idp4')
+
+        with mock.patch.object(db.session, 'query') as mock_query:
+            self.assertEqual('db-domain',
+                             idp_domains.get_domain('https://idp3'))
+            self.assertEqual('default',
+                             idp_domains.get_domain('https://idp4'))
+        mock_query.assert_not_called()
+        self.assertEqual(2, idp_domains.stats()['cache']['hits'])
+
+    def test_invalidate(self):
+        self.assertEqual('default', idp_domains.get_domain('https://idp3'))
+        db.session.add(models.IdpDomainMapping('https://idp3', 'db-domain'))
+        db.session.commit()
+        self.assertEqual('default', idp_domains.get_domain('https://idp3'))
+        idp_domains.invalidate('https://idp3')
+        self.assertEqual('db-domain', idp_domains.get_domain('https://idp3'))
+
+    def test_load_files(self):
+        self.assertEqual({'https://idp2': 'domain123'},
+                         idp_domains.load_files())
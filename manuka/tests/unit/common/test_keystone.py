@@ -0,0 +1,97 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+from unittest import mock
+
+from manuka.common import clients
+from manuka.common import keystone
+from manuka.tests.unit import base
+
+
+@mock.patch('keystoneauth1.loading.load_auth_from_conf_options')
+@mock.patch('keystoneauth1.loading.load_session_from_conf_options')
+class TestSharedSession(base.TestCase):
+
+    def test_shared(self, mock_load_session, mock_load_auth):
+        k_session = keystone.get_shared_session()
+        self.assertIs(k_session, keystone.get_shared_session())
+        self.assertIsNot(k_session, keystone.get_shared_session('other'))
+        self.assertIs(k_session.get_session(), k_session.get_session())
+        mock_load_session.assert_called_once()
+        mock_load_auth.assert_called_once()
+
+    def test_concurrent_first_use(self, mock_load_session, mock_load_auth):
+        mock_load_session.side_effect = lambda *a, **kw: mock.Mock()
+        barrier = threading.Barrier(8)
+        sessions = []
+
+        def get():
+            barrier.wait()
+            sessions.append(keystone.get_shared_session().get_session())
+
+        threads = [threading.Thread(target=get) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(1, len(set(map(id, sessions))))
+        mock_load_session.assert_called_once()
+
+    def test_reset(self, mock_load_session, mock_load_auth):
+        k_session = keystone.get_shared_session()
+        keystone.reset_shared_sessions()
+        self.assertIsNot(k_session, keystone.get_shared_session())
+
+
+@mock.patch('keystoneclient.v3.client.Client')
+class TestAdminKeystoneClient(base.TestCase):
+
+    def test_cached_per_session(self, mock_client):
+        mock_client.side_effect = lambda session: mock.Mock()
+        session1 = mock.Mock()
+        session2 = mock.Mock()
+
+        client = clients.get_admin_keystoneclient(session1)
+        self.assertIs(client, clients.get_admin_keystoneclient(session1))
+        self.assertIsNot(client, clients.get_admin_keystoneclient(session2))
+        self.assertEqual(2, mock_client.call_count)
+
+
+@mock.patch('openstack.connection.Connection')
+class TestAdminOpenstackClient(base.TestCase):
+
+    def test_cached_per_session(self, mock_connection):
+        mock_connection.side_effect = lambda session: mock.Mock()
+        session1 = mock.Mock()
+        session2 = mock.Mock()
+
+        client = clients.get_admin_openstack_client(session1)
+        self.assertIs(client, clients.get_admin_openstack_client(session1))
+        self.assertIsNot(client,
+                         clients.get_admin_openstack_client(session2))
+        self.assertEqual(2, mock_connection.call_count)
+
+
+@mock.patch('manuka.common.orcid_client.Client')
+class TestOrcidClient(base.TestCase):
+
+    def test_shared(self, mock_client):
+        mock_client.side_effect = lambda: mock.Mock()
+        client = clients.get_orcid_client()
+        self.assertIs(client, clients.get_orcid_client())
+        mock_client.assert_called_once_with()
+
+        clients.reset_orcid_client()
+        self.assertIsNot(client, clients.get_orcid_client())
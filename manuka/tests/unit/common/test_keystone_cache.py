@@ -0,0 +1,88 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+from unittest import mock
+
+from oslo_config import cfg
+
+from manuka.common import keystone_cache
+from manuka.tests.unit import base
+
+
+CONF = cfg.CONF
+
+
+class TestKeystoneCache(base.TestCase):
+
+    def test_get_roles(self):
+        client = mock.Mock()
+        role_names = ['role1', 'role2']
+        role1 = mock.Mock()
+        role2 = mock.Mock()
+        role3 = mock.Mock()
+        role1.name = 'role1'
+        role2.name = 'role2'
+        role3.name = 'role3'
+
+        client.roles.list.return_value = [role1, role2, role3]
+        roles = keystone_cache.get_roles(client, role_names)
+
+        client.roles.list.assert_called_once_with()
+        self.assertEqual([role1, role2], roles)
+
+    def _roles_client(self, *names):
+        client = mock.Mock()
+        roles = []
+        for name in names:
+            role = mock.Mock()
+            role.name = name
+            roles.append(role)
+        client.roles.list.return_value = roles
+        return client, roles
+
+    def test_get_roles_cached(self):
+        client, (role1, role2) = self._roles_client('role1', 'role2')
+
+        self.assertEqual([role1], keystone_cache.get_roles(client, ['role1']))
+        self.assertEqual([role2], keystone_cache.get_roles(client, ['role2']))
+
+        client.roles.list.assert_called_once_with()
+        self.assertEqual(1, keystone_cache.stats()['roles']['hits'])
+
+    def test_get_roles_unknown_role_refreshes(self):
+        client, (role1,) = self._roles_client('role1')
+        keystone_cache.get_roles(client, ['role1'])
+
+        self.assertEqual([], keystone_cache.get_roles(client, ['new']))
+        self.assertEqual(2, client.roles.list.call_count)
+
+    def test_get_roles_cache_disabled(self):
+        CONF.set_override('role_cache_ttl', 0, 'keystone')
+        client, roles = self._roles_client('role1')
+        keystone_cache.get_roles(client, ['role1'])
+        keystone_cache.get_roles(client, ['role1'])
+        self.assertEqual(2, client.roles.list.call_count)
+
+    def test_get_domain(self):
+        client = mock.Mock()
+
+        domain = keystone_cache.get_domain(client, 'dom1')
+        self.assertIs(domain, keystone_cache.get_domain(client, 'dom1'))
+        client.domains.get.assert_called_once_with('dom1')
+
+        keystone_cache.invalidate()
+        keystone_cache.get_domain(client, 'dom1')
+        self.assertEqual(2, client.domains.get.call_count)
+        self.assertEqual({'hits': 1, 'misses': 2, 'size': 1},
+                         keystone_cache.stats()['domains'])
@@ -11,13 +11,21 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from unittest import mock
 from unittest.mock import patch
 
+import requests
 from requests import exceptions
 
+import orcid
+from oslo_config import cfg
+
 from manuka.common import orcid_client
 from manuka.tests.unit import base
 
+
+CONF = cfg.CONF
+
 SEARCH_RESULTS = {
     'text:Foo': ['0000-0001-0000-0001',
                  '0000-0001-0000-0002'],
@@ -31,8 +39,8 @@ class FakePublicAPI(object):
     def __init__(self, *args, **kwargs):
         pass
 
-    def get_search_token_from_orcid(self):
-        return ""
+    def get_search_token(self):
+        return "", 3600
 
     def search(self, query, **kwargs):
         orcids = SEARCH_RESULTS.get(query, [])
@@ -99,9 +107,26 @@ class FailingFakePublicAPI(UnreliableFakePublicAPI):
         raise FakeHTTPError()
 
 
+class UnauthorizedFakePublicAPI(FakePublicAPI):
+    """Rejects the first token it handed out"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tokens = 0
+
+    def get_search_token(self):
+        self.tokens += 1
+        return "token%d" % self.tokens, 3600
+
+    def search(self, query, access_token=None, **kwargs):
+        if access_token == "token1":
+            raise FakeHTTPError(status_code=401)
+        return super().search(query, **kwargs)
+
+
 class OrcidClientTest(base.TestCase):
 
-    @patch('orcid.PublicAPI', new=FakePublicAPI)
+    @patch('manuka.common.orcid_client.PublicAPI', new=FakePublicAPI)
     def test_orcid_searches(self):
         client = orcid_client.Client()
         self.assertEqual('0000-0001-0000-0001',
@@ -114,7 +139,7 @@ class OrcidClientTest(base.TestCase):
         orcids = client.search_by_names("Spriggs", "Jim")
         self.assertEqual(1, len(orcids))
 
-    @patch('orcid.PublicAPI', new=UnreliableFakePublicAPI)
+    @patch('manuka.common.orcid_client.PublicAPI', new=UnreliableFakePublicAPI)
     def test_orcid_searches_unreliable(self):
         client = orcid_client.Client(retry_delay=0)
         self.assertEqual('0000-0001-0000-0001',
@@ -127,7 +152,7 @@ class OrcidClientTest(base.TestCase):
         orcids = client.search_by_names("Spriggs", "Jim")
         self.assertEqual(1, len(orcids))
 
-    @patch('orcid.PublicAPI', new=FailingFakePublicAPI)
+    @patch('manuka.common.orcid_client.PublicAPI', new=FailingFakePublicAPI)
     def test_orcid_searches_failing(self):
         client = orcid_client.Client(retry_delay=0)
         with self.assertRaises(exceptions.HTTPError):
@@ -136,3 +161,115 @@ class OrcidClientTest(base.TestCase):
             client.search_by_text("Foo")
         with self.assertRaises(exceptions.HTTPError):
             client.search_by_names("Spriggs", "Jim")
+
+    def test_is_transient(self):
+        # A requests Response with an error status is falsy
+        response = requests.Response()
+        response.status_code = 503
+        self.assertTrue(orcid_client.is_transient(
+            exceptions.HTTPError(response=response)))
+        response.status_code = 404
+        self.assertFalse(orcid_client.is_transient(
+            exceptions.HTTPError(response=response)))
+        self.assertFalse(orcid_client.is_transient(exceptions.HTTPError()))
+
+    @patch('time.sleep')
+    @patch('manuka.common.orcid_client.PublicAPI', new=FailingFakePublicAPI)
+    def test_orcid_no_retries(self, mock_sleep):
+        client = orcid_client.Client(max_retries=0)
+        with self.assertRaises(exceptions.HTTPError):
+            client.search_by_email('foo@bar.com')
+        mock_sleep.assert_not_called()
+
+    @patch('time.sleep')
+    @patch('manuka.common.orcid_client.PublicAPI', new=FailingFakePublicAPI)
+    def test_orcid_retry_backoff(self, mock_sleep):
+        client = orcid_client.Client(max_retries=3, retry_delay=1)
+        with self.assertRaises(exceptions.HTTPError):
+            client.search_by_email('foo@bar.com')
+        self.assertEqual(3, mock_sleep.call_count)
+        for attempt, call in enumerate(mock_sleep.call_args_list):
+            self.assertLessEqual(call[0][0], 2 ** attempt)
+
+    @patch('manuka.common.orcid_client.PublicAPI', new=FakePublicAPI)
+    def test_token_reused(self):
+        client = orcid_client.Client()
+        client.search_by_email('foo@bar.com')
+        client.search_by_text("Foo")
+        client.search_by_email('baz@bar.com')
+        self.assertEqual({'tokens_fetched': 1, 'searches': 3},
+                         client.stats())
+
+    @patch('time.monotonic')
+    @patch('manuka.common.orcid_client.PublicAPI', new=FakePublicAPI)
+    def test_token_expiry(self, mock_monotonic):
+        mock_monotonic.return_value = 1000
+        client = orcid_client.Client()
+        client.search_by_email('foo@bar.com')
+        # The fake token lasts an hour, less the expiry margin
+        mock_monotonic.return_value = 1000 + 3600 - 61
+        client.search_by_email('foo@bar.com')
+        self.assertEqual(1, client.tokens_fetched)
+        mock_monotonic.return_value = 1000 + 3600
+        client.search_by_email('foo@bar.com')
+        self.assertEqual(2, client.tokens_fetched)
+
+    @patch('time.monotonic')
+    @patch('manuka.common.orcid_client.PublicAPI', new=FakePublicAPI)
+    def test_token_ttl(self, mock_monotonic):
+        CONF.set_override('token_ttl', 60, 'orcid')
+        mock_monotonic.return_value = 1000
+        client = orcid_client.Client()
+        client.search_by_email('foo@bar.com')
+        mock_monotonic.return_value = 1060
+        client.search_by_email('foo@bar.com')
+        self.assertEqual(2, client.tokens_fetched)
+
+    @patch('time.sleep')
+    @patch('manuka.common.orcid_client.PublicAPI',
+           new=UnauthorizedFakePublicAPI)
+    def test_token_rejected(self, mock_sleep):
+        client = orcid_client.Client(max_retries=0)
+        self.assertEqual('0000-0001-0000-0001',
+                         client.search_by_email('foo@bar.com'))
+        self.assertEqual(2, client.tokens_fetched)
+        mock_sleep.assert_not_called()
+
+
+class PublicAPITest(base.TestCase):
+
+    def test_requests_use_session(self):
+        session = mock.Mock()
+        session.post.return_value.json.return_value = {
+            'access_token': 'token', 'expires_in': 631138518}
+        session.get.return_value.json.return_value = {
+            'result': [], 'num-found': 0}
+        api = orcid_client.PublicAPI('key', 'secret', True, session,
+                                     timeout=5)
+
+        self.assertEqual(('token', 631138518), api.get_search_token())
+        session.post.assert_called_once_with(
+            'https://pub.sandbox.orcid.org/oauth/token',
+            data={'client_id': 'key', 'client_secret': 'secret',
+                  'scope': '/read-public',
+                  'grant_type': 'client_credentials'},
+            headers={'Accept': 'application/json'}, timeout=5)
+
+        self.assertEqual({'result': [], 'num-found': 0},
+                         api.search('email:foo@bar.com', rows=2,
+                                    access_token='token'))
+        session.get.assert_called_once_with(
+            'https://pub.sandbox.orcid.org%s/search/'
+            '?defType=lucene&q=email:foo@bar.com&rows=2'
+            % orcid.orcid.SEARCH_VERSION,
+            headers={'Accept': 'application/orcid+json',
+                     'Authorization': 'Bearer token'},
+            timeout=5)
+
+    def test_session_proxies(self):
+        CONF.set_override('https_proxy', 'http://proxy:3128', 'orcid')
+        session = orcid_client.make_session()
+        self.assertEqual({'https': 'http://proxy:3128'}, session.proxies)
+        self.assertEqual(
+            CONF.orcid.pool_size,
+            session.get_adapter('https://pub.orcid.org')._pool_maxsize)
@@ -0,0 +1,51 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from unittest import mock
+
+from manuka.common import ratelimit
+from manuka.tests.unit import base
+
+
+@mock.patch('time.sleep')
+@mock.patch('time.monotonic')
+class TestTokenBucket(base.TestCase):
+
+    def test_burst(self, mock_monotonic, mock_sleep):
+        mock_monotonic.return_value = 100
+        bucket = ratelimit.TokenBucket(2, burst=3)
+        for i in range(3):
+            self.assertEqual(0, bucket.acquire())
+        mock_sleep.assert_not_called()
+
+        # Once empty, callers wait in turn for the next tokens
+        self.assertEqual(0.5, bucket.acquire())
+        self.assertEqual(1.0, bucket.acquire())
+        mock_sleep.assert_has_calls([mock.call(0.5), mock.call(1.0)])
+
+    def test_refill(self, mock_monotonic, mock_sleep):
+        mock_monotonic.return_value = 100
+        bucket = ratelimit.TokenBucket(10, burst=2)
+        bucket.acquire()
+        bucket.acquire()
+
+        mock_monotonic.return_value = 100.25
+        self.assertEqual(0, bucket.acquire())
+        # Refilling stops at the burst size
+        mock_monotonic.return_value = 200
+        self.assertEqual(0, bucket.acquire())
+        self.assertEqual(0, bucket.acquire())
+        self.assertGreater(bucket.acquire(), 0)
+
+    def test_invalid_rate(self, mock_monotonic, mock_sleep):
+        self.assertRaises(ValueError, ratelimit.TokenBucket, 0)
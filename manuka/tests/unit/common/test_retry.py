@@ -0,0 +1,89 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+import time
+from unittest import mock
+
+from manuka.common import retry
+from manuka.tests.unit import base
+
+
+class TestBackoff(base.TestCase):
+
+    def test_backoff(self):
+        for attempt in range(5):
+            delay = retry.backoff(attempt, 2)
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, 2 * 2 ** attempt)
+
+    def test_backoff_cap(self):
+        self.assertLessEqual(retry.backoff(30, 2, cap=10), 10)
+
+    @mock.patch('random.uniform')
+    def test_backoff_jitter(self, mock_uniform):
+        retry.backoff(3, 2, cap=100)
+        mock_uniform.assert_called_once_with(0, 16)
+
+
+class TestRetryScheduler(base.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.scheduler = retry.RetryScheduler(2)
+        self.addCleanup(self.scheduler.shutdown)
+
+    def test_schedule(self):
+        done = threading.Event()
+        calls = []
+
+        def task(name, last=False):
+            calls.append(name)
+            if last:
+                done.set()
+
+        self.scheduler.schedule(0.2, task, 'later', last=True)
+        self.scheduler.schedule(0, task, 'sooner')
+        self.assertTrue(done.wait(5))
+        self.assertEqual(['sooner', 'later'], calls)
+        self.assertEqual(0, len(self.scheduler))
+
+    def test_schedule_does_not_block(self):
+        start = time.monotonic()
+        self.scheduler.schedule(60, mock.Mock())
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(1, len(self.scheduler))
+
+    def test_failed_call(self):
+        done = threading.Event()
+
+        def fail():
+            raise ValueError('broken')
+
+        # A failing call doesn't stop the scheduler
+        self.scheduler.schedule(0, fail)
+        self.scheduler.schedule(0.05, done.set)
+        self.assertTrue(done.wait(5))
+
+    def test_shutdown(self):
+        task = mock.Mock()
+        self.scheduler.schedule(0.1, task, 'a', attempt=2)
+        pending = self.scheduler.shutdown()
+        self.assertEqual(1, len(pending))
+        self.assertIs(task, pending[0].func)
+        self.assertEqual(('a',), pending[0].args)
+        self.assertEqual({'attempt': 2}, pending[0].keywords)
+        time.sleep(0.2)
+        task.assert_not_called()
+        self.assertEqual(0, len(self.scheduler))
+        self.assertRaises(RuntimeError, self.scheduler.schedule, 0, task)
@@ -0,0 +1,85 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+from unittest import mock
+
+from manuka.common import status
+from manuka.tests.unit import base
+
+
+class TestStatusWaiter(base.TestCase):
+
+    def test_notify_wakes_watchers(self):
+        waiter = status.StatusWaiter()
+        with waiter.watch('pid1') as event1, \
+                waiter.watch('pid1') as event2, \
+                waiter.watch('pid2') as other:
+            waiter.notify('pid1')
+            self.assertTrue(event1.is_set())
+            self.assertTrue(event2.is_set())
+            self.assertFalse(other.is_set())
+        self.assertEqual(0, len(waiter))
+
+    def test_notify_without_watchers(self):
+        waiter = status.StatusWaiter()
+        waiter.notify('pid1')
+        with waiter.watch('pid1') as event:
+            self.assertFalse(event.wait(0))
+
+    def test_wait_from_another_thread(self):
+        waiter = status.StatusWaiter()
+        with waiter.watch('pid1') as event:
+            threading.Timer(0.05, waiter.notify, ['pid1']).start()
+            self.assertTrue(event.wait(5))
+
+    def test_max_waiters(self):
+        waiter = status.StatusWaiter(lambda: 2)
+        with waiter.watch('pid1') as event1, \
+                waiter.watch('pid2') as event2:
+            self.assertIsNotNone(event1)
+            self.assertIsNotNone(event2)
+            with waiter.watch('pid1') as full:
+                self.assertIsNone(full)
+        # Slots are freed once the waiters are done
+        with waiter.watch('pid3') as event:
+            self.assertIsNotNone(event)
+        self.assertEqual(0, len(waiter))
+
+    def test_endpoint(self):
+        waiter = mock.Mock()
+        status.StatusEndpoints(waiter).account_created({}, 'pid1')
+        waiter.notify.assert_called_once_with('pid1')
+
+
+class TestStatusAPI(base.TestCase):
+
+    @mock.patch('oslo_messaging.RPCClient')
+    def test_account_created(self, mock_client):
+        status.notify_account_created('pid1')
+        prepare = mock_client.return_value.prepare
+        prepare.assert_called_once_with(version='1.0', fanout=True)
+        prepare.return_value.cast.assert_called_once_with(
+            mock.ANY, 'account_created', persistent_id='pid1')
+
+    @mock.patch('oslo_messaging.RPCClient')
+    def test_account_created_error_ignored(self, mock_client):
+        mock_client.return_value.prepare.side_effect = Exception('down')
+        status.notify_account_created('pid1')
+
+    @mock.patch('manuka.common.status._waiter', new=None)
+    @mock.patch('manuka.common.status._start_listener')
+    def test_get_waiter(self, mock_start):
+        waiter = status.get_waiter()
+        self.assertIs(waiter, status.get_waiter())
+        mock_start.assert_called_once_with(waiter)
@@ -12,12 +12,18 @@
 #    under the License.
 
 from datetime import datetime
+import os
+import tempfile
+import threading
 from unittest import mock
 import werkzeug
 
 from freezegun import freeze_time
 from oslo_config import cfg
+import sqlalchemy
+from sqlalchemy.dialects import mysql
 
+from manuka import app
 from manuka.extensions import db
 from manuka import models
 from manuka.tests.unit import base
@@ -40,6 +46,22 @@ class TestModels(base.TestCase):
         self.assertEqual(external_ids[0].user, db_user)
         self.assertEqual('new', db_user.state)
 
+    def test_create_db_user_existing(self):
+        user, external_id = models.create_db_user(self.shib_attrs)
+        user2, external_id2 = models.create_db_user(self.shib_attrs)
+        self.assertEqual(user.id, user2.id)
+        self.assertEqual(external_id.id, external_id2.id)
+        self.assertEqual(1, db.session.query(models.User).count())
+
+    def test_external_id_attributes_deferred(self):
+        user, external_id = self.make_db_user()
+        db.session.expire_all()
+
+        db_user = db.session.query(models.User).get(user.id)
+        state = sqlalchemy.inspect(db_user.external_ids[0])
+        self.assertIn('attributes', state.unloaded)
+        self.assertEqual(self.shib_attrs, db_user.external_ids[0].attributes)
+
     @freeze_time("2012-01-14")
     def test_update_db_user(self):
         # testing classic behavior: handling the mandatory attributes
@@ -92,6 +114,136 @@ class TestModels(base.TestCase):
         self.assertIsNone(db_user.organisation)
         self.assertEqual('pretty', db_user.orcid)
 
+    def _capture_updates(self):
+        statements = []
+
+        def capture(conn, cursor, statement, *args):
+            if statement.startswith('UPDATE'):
+                statements.append(statement)
+
+        sqlalchemy.event.listen(db.engine, 'before_cursor_execute', capture)
+        self.addCleanup(sqlalchemy.event.remove, db.engine,
+                        'before_cursor_execute', capture)
+        return statements
+
+    def test_update_unchanged_attributes_not_written(self):
+        user, external_id = self.make_db_user()
+        models.update_db_user(user, external_id, self.shib_attrs)
+        updates = self._capture_updates()
+
+        models.update_db_user(user, external_id, dict(self.shib_attrs))
+
+        # SQLAlchemy doesn't write values equal to the loaded ones
+        self.assertEqual(2, len(updates))
+        for statement in updates:
+            self.assertNotIn('attributes', statement)
+
+    def test_update_buffered_last_login(self):
+        CONF.set_override('last_login_flush_interval', 60)
+        user, external_id = self.make_db_user()
+        updates = self._capture_updates()
+
+        with freeze_time("2021-02-03 04:05:06"):
+            models.update_db_user(user, external_id, self.shib_attrs,
+                                  commit=False)
+        self.assertEqual(datetime(2021, 2, 3, 4, 5, 6), user.last_login)
+        db.session.commit()
+        for statement in updates:
+            self.assertNotIn('last_login', statement)
+
+        models.last_login_writer.flush()
+        db.session.expire_all()
+        user = db.session.query(models.User).get(user.id)
+        self.assertEqual(datetime(2021, 2, 3, 4, 5, 6), user.last_login)
+        self.assertEqual(datetime(2021, 2, 3, 4, 5, 6),
+                         user.external_ids[0].last_login)
+
+    def test_last_login_writer_coalesces(self):
+        user1, external_id1 = self.make_db_user(id=1)
+        user2, external_id2 = self.make_db_user(id=2)
+        writer = models.LastLoginWriter()
+        updates = self._capture_updates()
+
+        with mock.patch('threading.Thread'):
+            writer.record(db.engine, user1.id, external_id1.id,
+                          datetime(2021, 1, 1))
+            writer.record(db.engine, user1.id, external_id1.id,
+                          datetime(2021, 1, 2))
+            writer.record(db.engine, user2.id, external_id2.id,
+                          datetime(2021, 1, 3))
+        writer.flush()
+
+        # One executemany per table
+        self.assertEqual(2, len(updates))
+        db.session.expire_all()
+        self.assertEqual(datetime(2021, 1, 2),
+                         db.session.query(models.User).get(1).last_login)
+        self.assertEqual(datetime(2021, 1, 3),
+                         db.session.query(models.User).get(2).last_login)
+
+    def test_acquire_provisioning_record(self):
+        user, external_id = self.make_db_user()
+        record = models.acquire_provisioning_record(user.id, 60)
+        self.assertEqual(user.id, record.user_id)
+        self.assertEqual([], record.completed_steps)
+        self.assertIsNotNone(record.locked_until)
+        # Held until released
+        self.assertIsNone(models.acquire_provisioning_record(user.id, 60))
+
+        record.complete('roles')
+        db.session.commit()
+        models.release_provisioning_record(record.id)
+        record = models.acquire_provisioning_record(user.id, 60)
+        self.assertEqual(['roles'], record.completed_steps)
+        self.assertEqual(1, db.session.query(
+            models.ProvisioningRecord).count())
+
+    def test_acquire_provisioning_record_expired(self):
+        user, external_id = self.make_db_user()
+        models.acquire_provisioning_record(user.id, -1)
+        self.assertIsNotNone(models.acquire_provisioning_record(user.id, 60))
+
+    def test_insert_ignore_mysql(self):
+        table = models.OrcidLookup.__table__
+        with mock.patch.object(db.session, 'get_bind') as mock_get_bind, \
+                mock.patch.object(db.session, 'execute') as mock_execute:
+            mock_get_bind.return_value.dialect.name = 'mysql'
+            models._insert_ignore(table, {'email': 'foo@bar.com'})
+        sql = str(mock_execute.call_args[0][0].compile(
+            dialect=mysql.dialect()))
+        # Only key conflicts are ignored, not truncation or NULLs
+        self.assertNotIn('IGNORE', sql)
+        self.assertIn('ON DUPLICATE KEY UPDATE id = orcid_lookup.id', sql)
+
+    def test_orcid_lookup(self):
+        self.assertIsNone(models.get_orcid_lookup('Foo@Bar.com'))
+        with freeze_time('2021-01-01'):
+            models.record_orcid_lookup('Foo@Bar.com', None)
+            lookup = models.get_orcid_lookup('foo@bar.com')
+            self.assertFalse(lookup.found)
+            self.assertIsNone(lookup.orcid)
+
+        with freeze_time('2021-01-02'):
+            models.record_orcid_lookup('foo@bar.com', '0000-0001-0000-0001')
+            lookup = models.get_orcid_lookup('FOO@bar.com')
+            self.assertTrue(lookup.found)
+            self.assertEqual('0000-0001-0000-0001', lookup.orcid)
+        self.assertEqual(1, db.session.query(models.OrcidLookup).count())
+
+    def test_orcid_lookup_ttls(self):
+        CONF.set_override('lookup_ttl', 86400, 'orcid')
+        CONF.set_override('lookup_negative_ttl', 3600, 'orcid')
+        with freeze_time('2021-01-01 00:00'):
+            models.record_orcid_lookup('found@bar.com', '0000-0001-0000-0001')
+            models.record_orcid_lookup('missing@bar.com', None)
+        with freeze_time('2021-01-01 00:59'):
+            self.assertIsNotNone(models.get_orcid_lookup('missing@bar.com'))
+        with freeze_time('2021-01-01 01:00'):
+            self.assertIsNone(models.get_orcid_lookup('missing@bar.com'))
+            self.assertIsNotNone(models.get_orcid_lookup('found@bar.com'))
+        with freeze_time('2021-01-02 00:00'):
+            self.assertIsNone(models.get_orcid_lookup('found@bar.com'))
+
     def test_update_bad_affiliation(self):
         user, external_id = self.make_db_user()
         self.shib_attrs.update({'affiliation': 'parasite'})
@@ -116,7 +268,7 @@ class TestModels(base.TestCase):
         updated_keystone_user = mock_sync_keystone_user.return_value
         p1 = mock.Mock()
         p2 = mock.Mock()
-        user_client.projects.list.return_value = [p1, p2]
+        client.projects.list.return_value = [p1, p2]
         db_user, external_id = self.make_db_user()
 
         token, project_id, user = models.keystone_authenticate(db_user)
@@ -136,7 +288,7 @@ class TestModels(base.TestCase):
         )
 
         user_client.auth.client.get_token.assert_called_once_with()
-        user_client.projects.list.assert_called_once_with(
+        client.projects.list.assert_called_once_with(
             user=updated_keystone_user.id)
 
         self.assertEqual(user_client.auth.client.get_token.return_value,
@@ -169,7 +321,7 @@ class TestModels(base.TestCase):
         mock_keystone_password.assert_not_called()
 
         user_client.auth.client.get_token.assert_not_called()
-        user_client.projects.list.assert_not_called()
+        client.projects.list.assert_not_called()
 
     @mock.patch('keystoneauth1.identity.v3.Password')
     @mock.patch('manuka.models.keystone_client.Client')
@@ -188,7 +340,7 @@ class TestModels(base.TestCase):
         updated_keystone_user = mock_sync_keystone_user.return_value
         p1 = mock.Mock()
         p2 = mock.Mock()
-        user_client.projects.list.return_value = [p1, p2]
+        client.projects.list.return_value = [p1, p2]
         db_user, external_id = self.make_db_user(
             expiry_status='inactive', expiry_next_step=datetime(2013, 1, 1))
 
@@ -212,7 +364,7 @@ class TestModels(base.TestCase):
         )
 
         user_client.auth.client.get_token.assert_called_once_with()
-        user_client.projects.list.assert_called_once_with(
+        client.projects.list.assert_called_once_with(
             user=updated_keystone_user.id)
 
         self.assertEqual(user_client.auth.client.get_token.return_value,
@@ -220,6 +372,48 @@ class TestModels(base.TestCase):
         self.assertEqual(p1.id, project_id)
         self.assertEqual(updated_keystone_user, user)
 
+    @mock.patch('keystoneauth1.identity.v3.Password')
+    @mock.patch('manuka.models.keystone_client.Client')
+    @mock.patch('manuka.common.clients.get_admin_keystoneclient')
+    @mock.patch('manuka.models.sync_keystone_user')
+    def test_keystone_authenticate_concurrent(self, mock_sync_keystone_user,
+                                              mock_get_admin_keystone_client,
+                                              mock_keystone_client,
+                                              mock_keystone_password):
+        # Each call only returns once its concurrent partner has
+        # started, so this deadlocks (and times out) if run in sequence
+        synced = threading.Event()
+        token_requested = threading.Event()
+        client = mock_get_admin_keystone_client.return_value
+        user_client = mock_keystone_client.return_value
+
+        def get_domain(domain_id):
+            self.assertTrue(synced.wait(5))
+            return mock.Mock()
+
+        def sync(*args):
+            synced.set()
+            return mock.Mock()
+
+        def list_projects(user):
+            self.assertTrue(token_requested.wait(5))
+            return [mock.Mock(id='p1')]
+
+        def get_token():
+            token_requested.set()
+            return 'token'
+
+        client.domains.get.side_effect = get_domain
+        mock_sync_keystone_user.side_effect = sync
+        client.projects.list.side_effect = list_projects
+        user_client.auth.client.get_token.side_effect = get_token
+        db_user, external_id = self.make_db_user()
+
+        token, project_id, user = models.keystone_authenticate(db_user)
+
+        self.assertEqual('token', token)
+        self.assertEqual('p1', project_id)
+
     @mock.patch('manuka.common.clients.get_admin_keystoneclient')
     def test_sync_keystone_user(self, mock_keystone):
         keystone_user = mock.Mock(email='email1', full_name='name1')
@@ -253,3 +447,53 @@ class TestModels(base.TestCase):
             name='email1')
         self.assertEqual(mock_client.users.update.return_value,
                          updated_keystone_user)
+
+
+class TestCreateDbUserConcurrent(base.TestCase):
+    """Many first logins of the same user at once, on a real database"""
+
+    THREADS = 10
+
+    def create_app(self):
+        fd, self.db_path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        return app.create_app({
+            'SECRET_KEY': 'secret',
+            'TESTING': True,
+            'SQLALCHEMY_DATABASE_URI': "sqlite:///%s" % self.db_path,
+            'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        }, conf_file='manuka/tests/etc/manuka.conf')
+
+    def tearDown(self):
+        super().tearDown()
+        os.unlink(self.db_path)
+
+    def test_create_db_user_concurrent(self):
+        barrier = threading.Barrier(self.THREADS)
+        results = []
+        errors = []
+
+        def login():
+            with self.app.app_context():
+                try:
+                    barrier.wait()
+                    db_user, external_id = models.create_db_user(
+                        self.shib_attrs)
+                    results.append((db_user.id, external_id.id))
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    db.session.remove()
+
+        threads = [threading.Thread(target=login)
+                   for _ in range(self.THREADS)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual([], errors)
+        self.assertEqual(self.THREADS, len(results))
+        self.assertEqual(1, len(set(results)))
+        self.assertEqual(1, db.session.query(models.User).count())
+        self.assertEqual(1, db.session.query(models.ExternalId).count())
@@ -0,0 +1,149 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from unittest import mock
+
+from oslo_config import cfg
+from sqlalchemy.dialects import mysql
+
+from manuka.extensions import db
+from manuka import models
+from manuka import search
+from manuka.tests.unit import base
+
+
+CONF = cfg.CONF
+
+
+class TestNgramIndex(base.TestCase):
+
+    def test_candidates(self):
+        index = search.NgramIndex()
+        index.build([(1, 'alice@example.com', 'Alice Smith'),
+                     (2, 'bob@example.com', 'Bob Smithers')])
+        self.assertEqual({1, 2}, index.candidates('smith'))
+        self.assertEqual({2}, index.candidates('SMITHERS'))
+        self.assertEqual({1}, index.candidates('alice@'))
+        self.assertEqual(set(), index.candidates('carol'))
+        self.assertIsNone(index.candidates('ab'))
+
+    def test_add_remove(self):
+        index = search.NgramIndex()
+        index.build([])
+        index.add(1, 'alice@example.com', 'Alice')
+        self.assertEqual({1}, index.candidates('alice'))
+        index.add(1, 'carol@example.com', 'Carol')
+        self.assertEqual(set(), index.candidates('alice'))
+        self.assertEqual({1}, index.candidates('carol'))
+        index.remove(1)
+        self.assertEqual(set(), index.candidates('carol'))
+        self.assertEqual(0, len(index))
+
+
+class TestSearchBackends(base.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user1, _ = self.make_db_user(
+            id=1, displayname='Jane Citizen', email='jane@example.com')
+        self.user2, _ = self.make_db_user(
+            id=2, displayname='Alex Jane', email='alex@example.com')
+        self.user3, _ = self.make_db_user(
+            id=3, displayname='Sam Other', email='sam@example.org')
+
+    def _search(self, term):
+        query = db.session.query(models.User)
+        return [u.id for u in search.search_users(query, term)]
+
+    def test_auto_backend(self):
+        self.assertIsInstance(search.get_backend(), search.NgramBackend)
+
+    def test_ngram_search(self):
+        self.assertEqual([1, 2], self._search('jane'))
+        self.assertEqual([1, 2], self._search('example.com'))
+        self.assertEqual([], self._search('nobody'))
+
+    def test_prefix_ranked_first(self):
+        # 'alex' is a prefix match for user 2, 'jane' only for user 1
+        self.assertEqual([2], self._search('alex'))
+        self.assertEqual([1, 2], self._search('jan'))
+        self.make_db_user(id=4, displayname='Bo', email='bo.jan@example.com')
+        self.assertEqual([1, 2, 4], self._search('jan'))
+        self.make_db_user(id=5, displayname='Jan', email='z@example.com')
+        self.assertEqual([1, 5, 2, 4], self._search('jan'))
+
+    def test_like_backend(self):
+        CONF.set_override('search_backend', 'like')
+        self.assertIsInstance(search.get_backend(), search.LikeBackend)
+        self.assertEqual([1, 2], self._search('jane'))
+
+    def test_wildcards_escaped(self):
+        self.assertEqual([], self._search('j%e'))
+        self.assertEqual([], self._search('___'))
+
+    def test_index_updated_on_commit(self):
+        self.assertEqual([], self._search('newperson'))
+        self.make_db_user(id=4, displayname='New Person',
+                          email='newperson@example.com')
+        self.assertEqual([4], self._search('newperson'))
+
+        self.user1.email = 'renamed@example.com'
+        self.user1.displayname = 'Renamed'
+        db.session.commit()
+        self.assertEqual([2], self._search('jane'))
+
+    def test_index_rollback_discarded(self):
+        index = search.get_ngram_index(db.engine)
+        self._search('jane')
+        self.user3.email = 'rolledback@example.com'
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(set(), index.candidates('rolledback'))
+
+    def _write_elsewhere(self, statement):
+        # Core statements on their own connection don't fire the ORM
+        # events that keep the index up to date, like another process
+        with db.engine.connect() as conn:
+            conn.execute(statement)
+
+    def test_user_created_elsewhere(self):
+        self.assertEqual([1, 2], self._search('jane'))
+        self._write_elsewhere(models.User.__table__.insert().values(
+            id=4, displayname='Janet Outside', email='janet@example.net',
+            keystone_user_id='ksid-4'))
+        self.assertEqual([1, 4, 2], self._search('jane'))
+        self.assertEqual([4], self._search('outside'))
+
+    @mock.patch('time.monotonic')
+    def test_user_changed_elsewhere(self, mock_monotonic):
+        mock_monotonic.return_value = 1000
+        self.assertEqual([1, 2], self._search('jane'))
+        table = models.User.__table__
+        self._write_elsewhere(table.update().where(table.c.id == 3).values(
+            displayname='Jane Elsewhere'))
+        # Seen once the index is rebuilt
+        mock_monotonic.return_value = 1000 + CONF.search_index_ttl
+        self.assertEqual([1, 3, 2], self._search('jane'))
+
+    def test_index_disabled(self):
+        CONF.set_override('search_index_ttl', 0)
+        self.assertEqual([1, 2], self._search('jane'))
+        self.assertFalse(search.get_ngram_index(db.engine).built)
+
+    def test_fulltext_sql(self):
+        query = search.FulltextBackend().search(
+            db.session.query(models.User.id), 'jane')
+        sql = str(query.statement.compile(dialect=mysql.dialect()))
+        self.assertIn('MATCH (user.email, user.displayname) AGAINST '
+                      '(%s IN BOOLEAN MODE)', sql)
+        self.assertIn('lower(user.email) LIKE lower(%s)', sql)
@@ -11,10 +11,14 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import threading
+import time
 from unittest import mock
 
 from oslo_config import cfg
+import sqlalchemy
 
+from manuka.common import status
 from manuka.extensions import db
 from manuka import models
 from manuka.tests.unit import base
@@ -147,7 +151,8 @@ class TestViews(base.TestCase):
             user, user.external_ids[0], {'mail': fake_shib.EMAIL,
                                          'fullname': fake_shib.DISPLAYNAME,
                                          'id': fake_shib.ID,
-                                         'idp': fake_shib.IDP})
+                                         'idp': fake_shib.IDP},
+            commit=False)
 
         self.assertEqual(user.state, "registered")
         self.assert200(response)
@@ -343,6 +348,78 @@ class TestViews(base.TestCase):
                            "http://bad URL, "
                            "which is not permitted by this service.")
 
+    def _count_commits(self):
+        commits = []
+
+        def count(session):
+            commits.append(session)
+
+        sqlalchemy.event.listen(sqlalchemy.orm.Session, 'after_commit', count)
+        self.addCleanup(sqlalchemy.event.remove, sqlalchemy.orm.Session,
+                        'after_commit', count)
+        return commits
+
+    def test_commits_new_user(self):
+        commits = self._count_commits()
+        self.client.get('/login/')
+        self.assertTemplateUsed('terms_form.html')
+        self.assertEqual(1, len(commits))
+
+    def _mock_worker(self):
+        # worker_api is replaced with a Mock for the whole class
+        worker = views.worker_api.WorkerAPI.return_value
+        worker.reset_mock()
+        return worker
+
+    def test_commits_agreed_terms(self):
+        self.make_db_user(state='new')
+        commits = self._count_commits()
+        worker = self._mock_worker()
+        # The worker must only be told once the user is committed
+        worker.create_user.side_effect = lambda *args: self.assertEqual(
+            1, len(commits))
+
+        self.client.post('/login/', data={'agree': True})
+
+        self.assertTemplateUsed('creating_account.html')
+        worker.create_user.assert_called_once()
+        self.assertEqual(1, len(commits))
+
+    @mock.patch("manuka.models.keystone_authenticate")
+    def test_commits_created_user(self, mock_keystone_authenticate):
+        CONF.set_override('terms_version', 'v2')
+        self.make_db_user(state='created', orcid=None)
+        commits = self._count_commits()
+        worker = self._mock_worker()
+        user = mock.Mock()
+        user.configure_mock(name="test", email="test@example.com")
+        mock_keystone_authenticate.return_value = 'secret', 'abcdef', user
+
+        self.client.post('/login/', data={'agree': True,
+                                          'ignore_username': True})
+
+        self.assertTemplateUsed('redirect.html')
+        worker.refresh_orcid.assert_called_once()
+        self.assertEqual(1, len(commits))
+
+    @mock.patch("manuka.models.keystone_authenticate")
+    def test_no_orcid_refresh_when_recently_not_found(
+            self, mock_keystone_authenticate):
+        CONF.set_override('terms_version', 'v2')
+        db_user, external_id = self.make_db_user(state='created',
+                                                 orcid=None)
+        models.record_orcid_lookup(db_user.email, None)
+        worker = self._mock_worker()
+        user = mock.Mock()
+        user.configure_mock(name="test", email="test@example.com")
+        mock_keystone_authenticate.return_value = 'secret', 'abcdef', user
+
+        self.client.post('/login/', data={'agree': True,
+                                          'ignore_username': True})
+
+        self.assertTemplateUsed('redirect.html')
+        worker.refresh_orcid.assert_not_called()
+
     def test_account_status_no_user(self):
         response = self.client.get('/login/account_status')
         self.assert404(response)
@@ -354,3 +431,107 @@ class TestViews(base.TestCase):
         response = self.client.get('/login/account_status')
         self.assert200(response)
         self.assertEqual(b'{"state": "registered"}', response.get_data())
+
+    def _capture_selects(self):
+        statements = []
+
+        def capture(conn, cursor, statement, *args):
+            if statement.startswith('SELECT'):
+                statements.append(statement)
+
+        sqlalchemy.event.listen(db.engine, 'before_cursor_execute', capture)
+        self.addCleanup(sqlalchemy.event.remove, db.engine,
+                        'before_cursor_execute', capture)
+        return statements
+
+    def test_account_status_query(self):
+        self.make_db_user(state='registered')
+        with self.client.session_transaction() as sess:
+            sess['shib_user_id'] = '1324'
+        selects = self._capture_selects()
+
+        self.client.get('/login/account_status')
+
+        self.assertEqual(1, len(selects))
+        self.assertNotIn('displayname', selects[0])
+        self.assertNotIn('attributes', selects[0])
+
+    def test_account_status_cached(self):
+        db_user, external_id = self.make_db_user(state='registered')
+        with self.client.session_transaction() as sess:
+            sess['shib_user_id'] = '1324'
+        self.client.get('/login/account_status')
+        db_user.state = 'created'
+        db.session.commit()
+        selects = self._capture_selects()
+
+        response = self.client.get('/login/account_status')
+        self.assertEqual(b'{"state": "registered"}', response.get_data())
+        self.assertEqual([], selects)
+
+        # The worker's notification drops the cached state
+        status.StatusEndpoints(mock.Mock()).account_created({}, '1324')
+        response = self.client.get('/login/account_status')
+        self.assertEqual(b'{"state": "created"}', response.get_data())
+
+    def test_account_status_cache_disabled(self):
+        CONF.set_override('account_status_cache_ttl', 0)
+        db_user, external_id = self.make_db_user(state='registered')
+        with self.client.session_transaction() as sess:
+            sess['shib_user_id'] = '1324'
+        self.client.get('/login/account_status')
+        db_user.state = 'created'
+        db.session.commit()
+
+        response = self.client.get('/login/account_status')
+        self.assertEqual(b'{"state": "created"}', response.get_data())
+
+    @mock.patch('manuka.common.status.get_waiter')
+    @mock.patch('manuka.views._account_state')
+    def test_account_status_wait(self, mock_state, mock_get_waiter):
+        waiter = status.StatusWaiter()
+        mock_get_waiter.return_value = waiter
+        mock_state.side_effect = ['registered', 'created']
+        with self.client.session_transaction() as sess:
+            sess['shib_user_id'] = '1324'
+
+        threading.Timer(0.05, waiter.notify, ['1324']).start()
+        response = self.client.get('/login/account_status?wait=10')
+
+        self.assert200(response)
+        self.assertEqual(b'{"state": "created"}', response.get_data())
+        self.assertEqual(0, len(waiter))
+
+    @mock.patch('manuka.common.status.get_waiter')
+    def test_account_status_wait_created(self, mock_get_waiter):
+        mock_get_waiter.return_value = status.StatusWaiter()
+        self.make_db_user(state='created')
+        with self.client.session_transaction() as sess:
+            sess['shib_user_id'] = '1324'
+        response = self.client.get('/login/account_status?wait=10')
+        self.assertEqual(b'{"state": "created"}', response.get_data())
+
+    @mock.patch('manuka.common.status.get_waiter')
+    def test_account_status_wait_too_many_waiters(self, mock_get_waiter):
+        waiter = status.StatusWaiter(lambda: 1)
+        mock_get_waiter.return_value = waiter
+        self.make_db_user(state='registered')
+        with self.client.session_transaction() as sess:
+            sess['shib_user_id'] = '1324'
+        with waiter.watch('other'):
+            start = time.monotonic()
+            response = self.client.get('/login/account_status?wait=10')
+        # Answered without waiting
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(b'{"state": "registered"}', response.get_data())
+        self.assertEqual(0, len(waiter))
+
+    @mock.patch('manuka.common.status.get_waiter')
+    def test_account_status_wait_disabled(self, mock_get_waiter):
+        CONF.set_override('account_status_max_wait', 0)
+        self.make_db_user(state='registered')
+        with self.client.session_transaction() as sess:
+            sess['shib_user_id'] = '1324'
+        response = self.client.get('/login/account_status?wait=10')
+        self.assertEqual(b'{"state": "registered"}', response.get_data())
+        mock_get_waiter.assert_not_called()
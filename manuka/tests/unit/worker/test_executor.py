@@ -0,0 +1,96 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import contextlib
+import threading
+
+from manuka.tests.unit import base
+from manuka.worker import executor
+
+
+class TestStepExecutor(base.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.executor = executor.StepExecutor(4)
+        self.addCleanup(self.executor.shutdown)
+
+    def test_run(self):
+        steps = [executor.Step('a', lambda: 1),
+                 executor.Step('b', lambda a: a + 1, requires=['a']),
+                 executor.Step('c', lambda a, b: a + b, requires=['a', 'b'])]
+        result = self.executor.run(steps)
+        self.assertEqual({'a': 1, 'b': 2, 'c': 3}, result.results)
+        self.assertEqual(3, result['c'])
+        self.assertEqual({'a', 'b', 'c'}, set(result.durations))
+
+    def test_run_concurrently(self):
+        # Each step waits for the other, so this only completes if
+        # they run at the same time
+        barrier = threading.Barrier(2, timeout=5)
+        steps = [executor.Step('a', barrier.wait),
+                 executor.Step('b', barrier.wait)]
+        result = self.executor.run(steps)
+        self.assertEqual({0, 1}, set(result.results.values()))
+
+    def test_run_waits_for_requirements(self):
+        order = []
+        steps = [executor.Step('second', lambda first: order.append(2),
+                               requires=['first']),
+                 executor.Step('first', lambda: order.append(1))]
+        self.executor.run(steps)
+        self.assertEqual([1, 2], order)
+
+    def test_failures(self):
+        def fail():
+            raise ValueError('broken')
+
+        ran = []
+        steps = [executor.Step('a', fail),
+                 executor.Step('b', lambda a: ran.append('b'),
+                               requires=['a']),
+                 executor.Step('c', lambda b: ran.append('c'),
+                               requires=['b']),
+                 executor.Step('d', lambda: ran.append('d'))]
+        with self.assertRaises(executor.StepsFailed) as cm:
+            self.executor.run(steps)
+        e = cm.exception
+        self.assertEqual(['a'], list(e.failures))
+        self.assertIsInstance(e.failures['a'], ValueError)
+        self.assertEqual(['b', 'c'], e.skipped)
+        self.assertEqual(['d'], ran)
+        self.assertEqual({'a', 'd'}, set(e.durations))
+
+    def test_context(self):
+        entered = []
+
+        @contextlib.contextmanager
+        def context():
+            entered.append(threading.current_thread())
+            yield
+
+        step_executor = executor.StepExecutor(1, context=context)
+        self.addCleanup(step_executor.shutdown)
+        step_executor.run([executor.Step('a', lambda: None)])
+        self.assertEqual(1, len(entered))
+        self.assertIsNot(threading.current_thread(), entered[0])
+
+    def test_invalid_graph(self):
+        self.assertRaises(ValueError, self.executor.run,
+                          [executor.Step('a', None, requires=['missing'])])
+        self.assertRaises(ValueError, self.executor.run,
+                          [executor.Step('a', None, requires=['b']),
+                           executor.Step('b', None, requires=['a'])])
+        self.assertRaises(ValueError, self.executor.run,
+                          [executor.Step('a', None),
+                           executor.Step('a', None)])
@@ -11,13 +11,16 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import datetime
 from unittest import mock
 
 from oslo_config import cfg
 
+from manuka.common import retry
 from manuka.extensions import db
 from manuka import models
 from manuka.tests.unit import base
+from manuka.worker import executor
 from manuka.worker import manager as worker_manager
 
 
@@ -28,10 +31,10 @@ CONF = cfg.CONF
 @mock.patch('manuka.app.create_app')
 class TestManager(base.TestCase):
 
-    @mock.patch('manuka.models.keystone_authenticate')
+    @mock.patch('manuka.common.status.notify_account_created')
     @mock.patch('manuka.worker.manager.utils')
-    def test_create_user(self, mock_utils, mock_ks_auth, mock_app,
-                         mock_keystone):
+    def test_create_user(self, mock_utils, mock_notify,
+                         mock_app, mock_keystone):
 
         swift_quota = 10
         CONF.set_override('default_quota_gb', swift_quota, 'swift')
@@ -47,9 +50,6 @@ class TestManager(base.TestCase):
         db_user_id = db_user.id
         self.shib_attrs['idp'] = 'fake-idp'
 
-        token = 'token'
-        mock_ks_auth.return_value = (token, project.id, user)
-
         manager = worker_manager.Manager()
         manager.create_user(self.shib_attrs)
 
@@ -78,18 +78,292 @@ class TestManager(base.TestCase):
             roles=['Member'])
 
         self.assertEqual(user.id, db_user.keystone_user_id)
+        mock_notify.assert_called_once_with(self.shib_attrs['id'])
         self.assertEqual('created', db_user.state)
 
         mock_utils.send_welcome_email.assert_called_once_with(
             user, project)
 
-        mock_utils.add_security_groups.assert_called_once_with(
-            user.id, project.id, token)
+        mock_utils.add_project_security_groups.assert_called_once_with(
+            mock.ANY, project.id)
         mock_utils.set_nova_quota.assert_called_once_with(
             mock.ANY, project.id)
         mock_utils.set_swift_quota.assert_called_once_with(
             mock.ANY, project.id, swift_quota)
 
+        record = db.session.query(models.ProvisioningRecord).filter_by(
+            user_id=db_user_id).one()
+        self.assertEqual(project.id, record.project_id)
+        self.assertEqual(user.id, record.keystone_user_id)
+        self.assertEqual(['finished', 'nova_quota', 'roles',
+                          'security_groups', 'swift_quota', 'welcome_email'],
+                         record.completed_steps)
+        self.assertIsNone(record.locked_until)
+
+    @mock.patch('manuka.common.status.notify_account_created')
+    @mock.patch('manuka.worker.manager.utils')
+    def test_create_user_step_failure(self, mock_utils, mock_notify,
+                                      mock_app, mock_keystone):
+        CONF.set_override('default_quota_gb', 10, 'swift')
+        mock_utils.create_user.return_value.id = 'ksu-123'
+        mock_utils.create_project.return_value.id = 'ksp-123'
+        mock_utils.add_project_security_groups.side_effect = ValueError(
+            'neutron down')
+        mock_utils.set_nova_quota.side_effect = RuntimeError('nova down')
+        self.make_db_user()
+
+        manager = worker_manager.Manager()
+        with self.assertRaises(executor.StepsFailed) as cm:
+            manager.create_user(self.shib_attrs)
+
+        self.assertEqual({'security_groups', 'nova_quota'},
+                         set(cm.exception.failures))
+        # The independent steps still ran
+        mock_utils.send_welcome_email.assert_called_once()
+        mock_utils.set_swift_quota.assert_called_once()
+
+        record = db.session.query(models.ProvisioningRecord).one()
+        self.assertEqual('ksp-123', record.project_id)
+        self.assertEqual('ksu-123', record.keystone_user_id)
+        self.assertEqual(['roles', 'swift_quota', 'welcome_email'],
+                         record.completed_steps)
+        self.assertIsNone(record.locked_until)
+
+    @mock.patch('manuka.common.status.notify_account_created')
+    @mock.patch('manuka.worker.manager.utils')
+    def test_create_user_resume(self, mock_utils, mock_notify, mock_app,
+                                mock_keystone):
+        CONF.set_override('default_quota_gb', 10, 'swift')
+        client = mock_keystone.return_value
+        project = client.projects.get.return_value
+        project.id = 'ksp-123'
+        user = client.users.get.return_value
+        user.id = 'ksu-123'
+        db_user, external_id = self.make_db_user(state='created')
+        db_user.keystone_user_id = 'ksu-123'
+        record = models.ProvisioningRecord(user_id=db_user.id)
+        record.project_id = 'ksp-123'
+        record.keystone_user_id = 'ksu-123'
+        record.complete('roles', 'welcome_email', 'swift_quota')
+        db.session.add(record)
+        db.session.commit()
+
+        manager = worker_manager.Manager()
+        manager.create_user(self.shib_attrs)
+
+        client.projects.get.assert_called_once_with('ksp-123')
+        client.users.get.assert_called_once_with('ksu-123')
+        mock_utils.create_project.assert_not_called()
+        mock_utils.create_user.assert_not_called()
+        mock_utils.add_user_roles.assert_not_called()
+        mock_notify.assert_not_called()
+        mock_utils.send_welcome_email.assert_not_called()
+        mock_utils.set_swift_quota.assert_not_called()
+        # Only the steps that hadn't completed
+        mock_utils.add_project_security_groups.assert_called_once_with(
+            mock.ANY, 'ksp-123')
+        mock_utils.set_nova_quota.assert_called_once_with(
+            mock.ANY, 'ksp-123')
+        record = db.session.query(models.ProvisioningRecord).one()
+        self.assertEqual(['finished', 'nova_quota', 'roles',
+                          'security_groups', 'swift_quota', 'welcome_email'],
+                         record.completed_steps)
+
+    @mock.patch('manuka.worker.manager.utils')
+    def test_create_user_in_progress(self, mock_utils, mock_app,
+                                     mock_keystone):
+        db_user, external_id = self.make_db_user()
+        record = models.ProvisioningRecord(user_id=db_user.id)
+        record.locked_until = datetime.datetime.now() + \
+            datetime.timedelta(minutes=5)
+        db.session.add(record)
+        db.session.commit()
+
+        manager = worker_manager.Manager()
+        with mock.patch.object(manager.retries, 'schedule') as mock_schedule:
+            manager.create_user(self.shib_attrs, attempt=2)
+
+        mock_utils.create_project.assert_not_called()
+        mock_keystone.return_value.projects.get.assert_not_called()
+        # The holder may have died, so try again once its lease ends
+        mock_schedule.assert_called_once_with(
+            mock.ANY, manager.create_user, self.shib_attrs, attempt=2)
+        delay = mock_schedule.call_args[0][0]
+        self.assertGreater(delay, 290)
+        self.assertLessEqual(delay, 301)
+
+    @mock.patch('manuka.common.status.notify_account_created')
+    @mock.patch('manuka.worker.manager.utils')
+    def test_create_user_lease_expired(self, mock_utils, mock_notify,
+                                       mock_app, mock_keystone):
+        client = mock_keystone.return_value
+        client.projects.get.return_value.id = 'ksp-123'
+        mock_utils.create_user.return_value.id = 'ksu-123'
+        db_user, external_id = self.make_db_user()
+        # Left by a worker that died part way through
+        record = models.ProvisioningRecord(user_id=db_user.id)
+        record.project_id = 'ksp-123'
+        record.locked_until = datetime.datetime.now() - \
+            datetime.timedelta(seconds=1)
+        db.session.add(record)
+        db.session.commit()
+
+        manager = worker_manager.Manager()
+        with mock.patch.object(manager.retries, 'schedule') as mock_schedule:
+            manager.create_user(self.shib_attrs)
+
+        mock_schedule.assert_not_called()
+        client.projects.get.assert_called_once_with('ksp-123')
+        mock_utils.create_project.assert_not_called()
+        mock_utils.create_user.assert_called_once()
+        record = db.session.query(models.ProvisioningRecord).one()
+        self.assertTrue(record.is_complete(worker_manager.FINISHED))
+        self.assertIsNone(record.locked_until)
+        self.assertEqual('created', db.session.query(models.User).get(
+            db_user.id).state)
+
+    @mock.patch('manuka.worker.manager.utils')
+    def test_create_user_finished(self, mock_utils, mock_app,
+                                  mock_keystone):
+        db_user, external_id = self.make_db_user(state='created')
+        record = models.ProvisioningRecord(user_id=db_user.id)
+        record.complete(worker_manager.FINISHED)
+        db.session.add(record)
+        db.session.commit()
+
+        manager = worker_manager.Manager()
+        with mock.patch.object(manager.retries, 'schedule') as mock_schedule:
+            manager.create_user(self.shib_attrs)
+            # Even while another worker holds the lease
+            models.acquire_provisioning_record(db_user.id, 60)
+            manager.create_user(self.shib_attrs)
+
+        mock_schedule.assert_not_called()
+        mock_utils.create_project.assert_not_called()
+        mock_keystone.return_value.projects.get.assert_not_called()
+
+    @mock.patch('manuka.worker.api.WorkerAPI')
+    def test_shutdown_requeues_retries(self, mock_worker_api, mock_app,
+                                       mock_keystone):
+        manager = worker_manager.Manager()
+        manager.retries.schedule(60, manager.create_user, self.shib_attrs,
+                                 attempt=2)
+        manager.retries.schedule(60, manager.refresh_orcid, 1234,
+                                 attempt=3)
+
+        manager.shutdown()
+
+        api = mock_worker_api.return_value
+        api.create_user.assert_called_once_with(mock.ANY, self.shib_attrs)
+        api.refresh_orcid.assert_called_once_with(mock.ANY, 1234)
+
+    @mock.patch('manuka.common.status.notify_account_created')
+    @mock.patch('manuka.worker.manager.utils')
+    def test_create_user_pooled(self, mock_utils, mock_notify,
+                                mock_app, mock_keystone):
+        CONF.set_override('size', 2, 'trial_pool')
+        client = mock_keystone.return_value
+        client.projects.update.return_value.id = 'pooled-1'
+        mock_utils.get_domain_for_idp.return_value = 'default'
+        user = mock_utils.create_user.return_value
+        user.id = 'ksu-123'
+        db_user, external_id = self.make_db_user()
+        db_user_id = db_user.id
+        db.session.add(models.TrialProject('pooled-1', 'default'))
+        db.session.commit()
+
+        manager = worker_manager.Manager()
+        manager.create_user(self.shib_attrs)
+
+        project = client.projects.update.return_value
+        client.projects.update.assert_called_once_with(
+            'pooled-1', name="pt-%s" % db_user_id,
+            description="%s's project trial." % self.shib_attrs['fullname'])
+        mock_utils.create_project.assert_not_called()
+        mock_utils.create_user.assert_called_once_with(
+            client, self.shib_attrs['mail'], self.shib_attrs['mail'],
+            project, self.shib_attrs['fullname'])
+        mock_utils.add_user_roles.assert_called_once_with(
+            client, project=project, user=user, roles=['Member'])
+        # Already done when the project was built
+        mock_utils.add_project_security_groups.assert_not_called()
+        mock_utils.set_nova_quota.assert_not_called()
+        mock_utils.set_swift_quota.assert_not_called()
+        self.assertEqual(1, manager.pool.hits)
+
+    @mock.patch('manuka.common.status.notify_account_created')
+    @mock.patch('manuka.worker.manager.utils')
+    def test_create_user_pool_empty(self, mock_utils, mock_notify,
+                                    mock_app, mock_keystone):
+        CONF.set_override('size', 2, 'trial_pool')
+        mock_utils.get_domain_for_idp.return_value = 'default'
+        mock_utils.create_user.return_value.id = 'ksu-123'
+        mock_utils.create_project.return_value.id = 'ksp-123'
+        self.make_db_user()
+
+        manager = worker_manager.Manager()
+        manager.create_user(self.shib_attrs)
+
+        mock_utils.create_project.assert_called_once()
+        mock_utils.add_project_security_groups.assert_called_once()
+        self.assertEqual(1, manager.pool.misses)
+
+    @mock.patch('manuka.common.status.notify_account_created')
+    @mock.patch('manuka.worker.manager.utils')
+    def test_create_user_retry(self, mock_utils, mock_notify, mock_app,
+                               mock_keystone):
+        CONF.set_override('default_quota_gb', 10, 'swift')
+        mock_utils.create_user.return_value.id = 'ksu-123'
+        mock_utils.create_project.return_value.id = 'ksp-123'
+        mock_utils.set_swift_quota.side_effect = retry.RetryLater('down')
+        db_user, external_id = self.make_db_user()
+
+        manager = worker_manager.Manager()
+        with mock.patch.object(manager.retries, 'schedule') as mock_schedule:
+            manager.create_user(self.shib_attrs)
+
+        mock_schedule.assert_called_once_with(
+            mock.ANY, manager.create_user, self.shib_attrs, attempt=2)
+        delay = mock_schedule.call_args[0][0]
+        self.assertLessEqual(delay, CONF.worker.retry_base_delay)
+        # The retry can take the record and only sets the quota
+        record = db.session.query(models.ProvisioningRecord).one()
+        self.assertIsNone(record.locked_until)
+        self.assertNotIn('swift_quota', record.completed_steps)
+        self.assertIn('nova_quota', record.completed_steps)
+
+    @mock.patch('manuka.common.status.notify_account_created')
+    @mock.patch('manuka.worker.manager.utils')
+    def test_create_user_retries_exhausted(self, mock_utils, mock_notify,
+                                           mock_app, mock_keystone):
+        CONF.set_override('default_quota_gb', 10, 'swift')
+        CONF.set_override('retry_max_attempts', 3, 'worker')
+        mock_utils.create_user.return_value.id = 'ksu-123'
+        mock_utils.create_project.return_value.id = 'ksp-123'
+        mock_utils.set_swift_quota.side_effect = retry.RetryLater('down')
+        self.make_db_user()
+
+        manager = worker_manager.Manager()
+        with mock.patch.object(manager.retries, 'schedule') as mock_schedule:
+            self.assertRaises(executor.StepsFailed, manager.create_user,
+                              self.shib_attrs, attempt=3)
+        mock_schedule.assert_not_called()
+
+    @mock.patch('manuka.common.status.notify_account_created')
+    @mock.patch('manuka.worker.manager.utils')
+    def test_create_user_not_retryable(self, mock_utils, mock_notify,
+                                       mock_app, mock_keystone):
+        mock_utils.create_user.return_value.id = 'ksu-123'
+        mock_utils.create_project.return_value.id = 'ksp-123'
+        mock_utils.set_nova_quota.side_effect = ValueError('bad quota')
+        self.make_db_user()
+
+        manager = worker_manager.Manager()
+        with mock.patch.object(manager.retries, 'schedule') as mock_schedule:
+            self.assertRaises(executor.StepsFailed, manager.create_user,
+                              self.shib_attrs)
+        mock_schedule.assert_not_called()
+
     @mock.patch('manuka.worker.manager.utils')
     def test_refresh_orcid(self, mock_utils, mock_app, mock_keystone):
         manager = worker_manager.Manager()
@@ -97,4 +371,14 @@ class TestManager(base.TestCase):
         db_user, external_id = self.make_db_user()
         manager.refresh_orcid(db_user.id)
         mock_utils.refresh_orcid.assert_called_once_with(
-            db_user)
+            db_user, retryable=True)
+
+    @mock.patch('manuka.worker.manager.utils')
+    def test_refresh_orcid_retry(self, mock_utils, mock_app, mock_keystone):
+        manager = worker_manager.Manager()
+        mock_utils.refresh_orcid.side_effect = retry.RetryLater('down')
+        db_user, external_id = self.make_db_user()
+        with mock.patch.object(manager.retries, 'schedule') as mock_schedule:
+            manager.refresh_orcid(db_user.id)
+        mock_schedule.assert_called_once_with(
+            mock.ANY, manager.refresh_orcid, db_user.id, attempt=2)
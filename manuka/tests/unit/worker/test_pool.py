@@ -0,0 +1,144 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from unittest import mock
+
+from oslo_config import cfg
+
+from manuka.extensions import db
+from manuka import models
+from manuka.tests.unit import base
+from manuka.worker import pool
+
+
+CONF = cfg.CONF
+
+
+class TestTrialProjectPool(base.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        CONF.set_override('size', 3, 'trial_pool')
+        self.pool = pool.TrialProjectPool()
+        self.client = mock.Mock()
+
+    def _add(self, *project_ids, domain='default'):
+        for project_id in project_ids:
+            db.session.add(models.TrialProject(project_id, domain))
+        db.session.commit()
+
+    def test_enabled_for(self):
+        self.assertTrue(self.pool.enabled_for('default'))
+        self.assertFalse(self.pool.enabled_for('other'))
+        CONF.set_override('size', 0, 'trial_pool')
+        self.assertFalse(self.pool.enabled_for('default'))
+
+    def test_claim(self):
+        self._add('p1', 'p2')
+        self._add('p3', domain='other')
+        db_user, external_id = self.make_db_user()
+
+        project = self.pool.claim(self.client, db_user, 'pt-1', 'desc')
+
+        self.client.projects.update.assert_called_once_with(
+            'p1', name='pt-1', description='desc')
+        self.assertEqual(self.client.projects.update.return_value, project)
+        claimed = db.session.query(models.TrialProject).filter_by(
+            project_id='p1').one()
+        self.assertEqual(db_user.id, claimed.user_id)
+        self.assertIsNotNone(claimed.claimed_at)
+        self.assertEqual(1, self.pool.ready_count('default'))
+        self.assertEqual(1, self.pool.hits)
+
+    def test_claim_skips_claimed(self):
+        self._add('p1', 'p2')
+        db_user, external_id = self.make_db_user()
+        other_user, external_id = self.make_db_user(id=2)
+        real_execute = db.session.execute
+
+        def execute(stmt, *args, **kwargs):
+            # Another worker claims p1 between the select and update
+            if not execute.raced:
+                execute.raced = True
+                db.session.query(models.TrialProject).filter_by(
+                    project_id='p1').update({'user_id': other_user.id})
+            return real_execute(stmt, *args, **kwargs)
+        execute.raced = False
+
+        with mock.patch.object(db.session, 'execute', execute):
+            self.pool.claim(self.client, db_user, 'pt-1', 'desc')
+
+        self.client.projects.update.assert_called_once_with(
+            'p2', name='pt-1', description='desc')
+
+    def test_claim_already_claimed(self):
+        self._add('p1', 'p2')
+        db_user, external_id = self.make_db_user()
+        self.pool.claim(self.client, db_user, 'pt-1', 'desc')
+        self.client.reset_mock()
+
+        # A retried claim gets the same project back
+        self.pool.claim(self.client, db_user, 'pt-1', 'desc')
+        self.client.projects.update.assert_called_once_with(
+            'p1', name='pt-1', description='desc')
+        self.assertEqual(1, self.pool.ready_count('default'))
+
+    def test_claim_empty(self):
+        db_user, external_id = self.make_db_user()
+        self.assertIsNone(self.pool.claim(self.client, db_user, 'pt-1', 'd'))
+        self.client.projects.update.assert_not_called()
+        self.assertEqual(1, self.pool.misses)
+
+    @mock.patch('manuka.worker.pool.utils')
+    def test_build(self, mock_utils):
+        CONF.set_override('default_quota_gb', 10, 'swift')
+        session = mock.Mock()
+        project = mock_utils.create_project.return_value
+        project.id = 'new'
+
+        self.pool.build(self.client, session, 'default')
+
+        mock_utils.create_project.assert_called_once_with(
+            self.client, mock.ANY, 'Pooled project trial.', 'default')
+        mock_utils.add_project_security_groups.assert_called_once_with(
+            session, 'new')
+        mock_utils.set_nova_quota.assert_called_once_with(session, 'new')
+        mock_utils.set_swift_quota.assert_called_once_with(
+            session, 'new', 10)
+        self.assertEqual(1, self.pool.ready_count('default'))
+
+    @mock.patch('manuka.worker.pool.utils')
+    def test_build_failure(self, mock_utils):
+        project = mock_utils.create_project.return_value
+        mock_utils.set_nova_quota.side_effect = ValueError('nova down')
+
+        self.assertRaises(ValueError, self.pool.build, self.client,
+                          mock.Mock(), 'default')
+
+        self.client.projects.delete.assert_called_once_with(project.id)
+        self.assertEqual(0, self.pool.ready_count('default'))
+
+    @mock.patch('manuka.common.clients.get_admin_keystoneclient')
+    @mock.patch('manuka.common.keystone.get_shared_session')
+    def test_refill(self, mock_session, mock_client):
+        CONF.set_override('refill_batch', 5, 'trial_pool')
+        self._add('p1')
+        with mock.patch.object(self.pool, 'build') as mock_build:
+            self.assertEqual(2, self.pool.refill())
+        self.assertEqual(2, mock_build.call_count)
+
+    def test_refill_full(self):
+        self._add('p1', 'p2', 'p3')
+        with mock.patch.object(self.pool, 'build') as mock_build:
+            self.assertEqual(0, self.pool.refill())
+        mock_build.assert_not_called()
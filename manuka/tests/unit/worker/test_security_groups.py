@@ -0,0 +1,130 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from unittest import mock
+
+from oslo_config import cfg
+
+from manuka.tests.unit import base
+from manuka.worker import security_groups
+
+
+CONF = cfg.CONF
+
+
+class TestSecurityGroups(base.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.conn = mock.Mock()
+        self.conn.network.security_groups.return_value = []
+        self.conn.network.create_security_group_rules.return_value = []
+        self.conn.network.create_security_group.side_effect = (
+            lambda name, **kwargs: mock.Mock(id='sg-' + name))
+
+    def test_load_templates_default(self):
+        templates = security_groups.load_templates()
+        self.assertEqual(['icmp', 'ssh', 'http'],
+                         [t.name for t in templates])
+        http = templates[2]
+        self.assertEqual('Allow HTTP/S', http.description)
+        self.assertEqual([(80, 80), (443, 443)],
+                         [(r['port_range_min'], r['port_range_max'])
+                          for r in http.rules])
+        icmp = templates[0].rules[0]
+        self.assertEqual('icmp', icmp['protocol'])
+        self.assertIsNone(icmp['port_range_min'])
+        self.assertEqual('IPv4', icmp['ethertype'])
+
+    def test_load_templates_config(self):
+        CONF.set_override('group', ['web:Web: HTTP'], 'security_groups')
+        CONF.set_override('rule', ['web:tcp:8000-8080:::/0'],
+                          'security_groups')
+        templates = security_groups.load_templates()
+        self.assertEqual(1, len(templates))
+        self.assertEqual('Web: HTTP', templates[0].description)
+        self.assertEqual([{'direction': 'ingress',
+                           'ethertype': 'IPv6',
+                           'protocol': 'tcp',
+                           'port_range_min': 8000,
+                           'port_range_max': 8080,
+                           'remote_ip_prefix': '::/0'}],
+                         templates[0].rules)
+
+    def test_load_templates_invalid(self):
+        CONF.set_override('rule', ['nope:tcp:22:0.0.0.0/0'],
+                          'security_groups')
+        self.assertRaises(ValueError, security_groups.load_templates)
+        CONF.set_override('rule', ['ssh:tcp:22'], 'security_groups')
+        self.assertRaises(ValueError, security_groups.load_templates)
+        CONF.set_override('rule', ['ssh:tcp:22:not-a-network'],
+                          'security_groups')
+        self.assertRaises(ValueError, security_groups.load_templates)
+        CONF.set_override('group', ['ssh'], 'security_groups')
+        self.assertRaises(ValueError, security_groups.load_templates)
+
+    def test_provision(self):
+        created = security_groups.provision(self.conn, 'p123')
+
+        self.assertEqual(4, created)
+        network = self.conn.network
+        network.security_groups.assert_called_once_with(project_id='p123')
+        self.assertEqual(3, network.create_security_group.call_count)
+        network.create_security_group.assert_any_call(
+            name='ssh', description='Allow SSH', project_id='p123')
+        # Every rule in one request
+        network.create_security_group_rules.assert_called_once()
+        rules = network.create_security_group_rules.call_args[0][0]
+        self.assertEqual(['sg-icmp', 'sg-ssh', 'sg-http', 'sg-http'],
+                         [r['security_group_id'] for r in rules])
+        self.assertEqual({'p123'}, {r['project_id'] for r in rules})
+
+    def test_provision_existing(self):
+        # An earlier attempt created the groups, but not all the rules
+        ssh = mock.Mock(id='sg-ssh', security_group_rules=[{
+            'direction': 'ingress', 'ethertype': 'IPv4', 'protocol': 'tcp',
+            'port_range_min': 22, 'port_range_max': 22,
+            'remote_ip_prefix': '0.0.0.0/0'}])
+        ssh.name = 'ssh'
+        http = mock.Mock(id='sg-http', security_group_rules=[])
+        http.name = 'http'
+        self.conn.network.security_groups.return_value = [ssh, http]
+
+        created = security_groups.provision(self.conn, 'p123')
+
+        self.assertEqual(3, created)
+        network = self.conn.network
+        network.create_security_group.assert_called_once_with(
+            name='icmp', description='Allow ICMP (eg. ping)',
+            project_id='p123')
+        rules = network.create_security_group_rules.call_args[0][0]
+        self.assertEqual(['sg-icmp', 'sg-http', 'sg-http'],
+                         [r['security_group_id'] for r in rules])
+
+    def test_provision_complete(self):
+        security_groups.provision(self.conn, 'p123')
+        groups = []
+        for call in self.conn.network.create_security_group.call_args_list:
+            group = mock.Mock(id='sg-' + call[1]['name'])
+            group.name = call[1]['name']
+            group.security_group_rules = [
+                r for r in
+                self.conn.network.create_security_group_rules.call_args[0][0]
+                if r['security_group_id'] == group.id]
+            groups.append(group)
+        self.conn.network.reset_mock()
+        self.conn.network.security_groups.return_value = groups
+
+        self.assertEqual(0, security_groups.provision(self.conn, 'p123'))
+        self.conn.network.create_security_group.assert_not_called()
+        self.conn.network.create_security_group_rules.assert_not_called()
@@ -11,11 +11,14 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import threading
 from unittest import mock
 
+from keystoneauth1 import exceptions as ks_exc
 from oslo_config import cfg
 from requests import exceptions
 
+from manuka.common import retry
 from manuka.extensions import db
 from manuka import models
 from manuka.tests.unit import base
@@ -65,7 +68,25 @@ class TestUtils(base.TestCase):
             name=name, domain=domain, description=description)
         self.assertEqual(client.projects.create.return_value, project)
 
-    @mock.patch('manuka.worker.utils.get_roles')
+    def test_create_project_exists(self):
+        client = mock.Mock()
+        client.projects.create.side_effect = ks_exc.Conflict()
+        existing = mock.Mock()
+        client.projects.list.return_value = [existing]
+        project = utils.create_project(client, 'pt-1', 'description',
+                                       'domain')
+        client.projects.list.assert_called_once_with(name='pt-1',
+                                                     domain='domain')
+        self.assertEqual(existing, project)
+
+    def test_create_project_conflict(self):
+        client = mock.Mock()
+        client.projects.create.side_effect = ks_exc.Conflict()
+        client.projects.list.return_value = []
+        self.assertRaises(ks_exc.Conflict, utils.create_project, client,
+                          'pt-1', 'description', 'domain')
+
+    @mock.patch('manuka.common.keystone_cache.get_roles')
     def test_add_user_roles(self, mock_get_roles):
         client = mock.Mock()
         user = mock.Mock()
@@ -80,41 +101,23 @@ class TestUtils(base.TestCase):
                  mock.call(user=user, project=project, role=role2)]
         client.roles.grant.assert_has_calls(calls)
 
-    def test_get_roles(self):
-        client = mock.Mock()
-        role_names = ['role1', 'role2']
-        role1 = mock.Mock()
-        role2 = mock.Mock()
-        role3 = mock.Mock()
-        role1.name = 'role1'
-        role2.name = 'role2'
-        role3.name = 'role3'
-
-        client.roles.list.return_value = [role1, role2, role3]
-        roles = utils.get_roles(client, role_names)
-
-        client.roles.list.assert_called_once_with()
-        self.assertEqual([role1, role2], roles)
-
     def test_get_domain_for_idp(self):
         domain = utils.get_domain_for_idp('http://idp1')
         self.assertEqual('default', domain)
         domain = utils.get_domain_for_idp('https://idp2')
         self.assertEqual('domain123', domain)
 
-    @mock.patch('manuka.common.clients.get_openstack_client')
-    def test_add_security_groups(self, mock_get_osc):
-        token = 'fake'
-        project_id = 'p123'
-        user_id = 'u123'
-
-        client = mock_get_osc.return_value
+    @mock.patch('manuka.worker.security_groups.provision')
+    @mock.patch('manuka.common.clients.get_admin_openstack_client')
+    def test_add_project_security_groups(self, mock_get_osc,
+                                         mock_provision):
+        session = mock.Mock()
 
-        utils.add_security_groups(user_id, project_id, token)
+        utils.add_project_security_groups(session, 'p123')
 
-        mock_get_osc.assert_called_once_with(project_id, token)
-        client.network.create_security_group.call_count = 3
-        client.network.create_security_group_rule.call_count = 4
+        mock_get_osc.assert_called_once_with(session)
+        mock_provision.assert_called_once_with(
+            mock_get_osc.return_value, 'p123', log_id='p123')
 
     @mock.patch('manuka.common.clients.get_admin_nova_client')
     def test_set_nova_quota(self, mock_get_nova):
@@ -143,6 +146,23 @@ class TestUtils(base.TestCase):
             headers={'x-account-meta-quota-bytes':
                      quota_gb * 1024 * 1024 * 1024})
 
+    @mock.patch('time.sleep')
+    @mock.patch('manuka.common.clients.get_swift_client')
+    def test_set_swift_quota_failure(self, mock_get_swift, mock_sleep):
+        client = mock_get_swift.return_value
+        client.post_account.side_effect = Exception('swift down')
+
+        sleepers = []
+        mock_sleep.side_effect = lambda delay: sleepers.append(
+            threading.current_thread())
+
+        self.assertRaises(retry.RetryLater, utils.set_swift_quota,
+                          mock.Mock(), 'p123', 10)
+        # A single attempt, without sleeping. Threads left over from
+        # other tests may still sleep.
+        client.post_account.assert_called_once()
+        self.assertNotIn(threading.current_thread(), sleepers)
+
     @mock.patch('manuka.common.email_utils.send_email')
     def test_send_welcome_email(self, mock_send_email):
         user = FakeUser()
@@ -236,3 +256,57 @@ class TestUtils(base.TestCase):
         # Check the orcid has not changed
         db_user = db.session.query(models.User).get(db_user_id)
         self.assertEqual('mutter', db_user.orcid)
+
+    @mock.patch('manuka.common.clients.get_orcid_client')
+    def test_refresh_orcid_retryable(self, mock_get_client):
+        mock_client = mock_get_client.return_value
+        mock_client.search_by_email.side_effect = \
+            test_orcid_client.FakeHTTPError()
+
+        db_user, external_id = self.make_db_user(orcid='mutter')
+        self.assertRaises(retry.RetryLater, utils.refresh_orcid, db_user,
+                          retryable=True)
+        # The client mustn't retry (and sleep) itself
+        mock_client.search_by_email.assert_called_once_with(
+            db_user.email, max_retries=0)
+
+        mock_client.search_by_email.side_effect = \
+            test_orcid_client.FakeHTTPError(status_code=404)
+        self.assertFalse(utils.refresh_orcid(db_user, retryable=True))
+
+    @mock.patch('manuka.common.clients.get_orcid_client')
+    def test_refresh_orcid_cached(self, mock_get_client):
+        mock_client = mock_get_client.return_value
+        mock_client.search_by_email.return_value = None
+
+        db_user, external_id = self.make_db_user(orcid=None)
+        self.assertTrue(utils.refresh_orcid(db_user))
+        self.assertTrue(utils.refresh_orcid(db_user))
+        mock_client.search_by_email.assert_called_once_with(db_user.email)
+        self.assertFalse(models.get_orcid_lookup(db_user.email).found)
+
+        # An explicit refresh always searches
+        mock_client.search_by_email.return_value = '0000-0001-0000-0001'
+        self.assertTrue(utils.refresh_orcid(db_user, force=True))
+        self.assertEqual(2, mock_client.search_by_email.call_count)
+        self.assertEqual('0000-0001-0000-0001', db_user.orcid)
+        self.assertTrue(models.get_orcid_lookup(db_user.email).found)
+
+    @mock.patch('manuka.common.clients.get_orcid_client')
+    def test_refresh_orcid_cached_found(self, mock_get_client):
+        db_user, external_id = self.make_db_user(orcid=None)
+        models.record_orcid_lookup(db_user.email, '0000-0001-0000-0001')
+
+        self.assertTrue(utils.refresh_orcid(db_user))
+        mock_get_client.assert_not_called()
+        self.assertEqual('0000-0001-0000-0001', db_user.orcid)
+
+    @mock.patch('manuka.common.clients.get_orcid_client')
+    def test_refresh_orcid_failure_not_cached(self, mock_get_client):
+        mock_client = mock_get_client.return_value
+        mock_client.search_by_email.side_effect = \
+            test_orcid_client.FakeHTTPError(status_code=404)
+
+        db_user, external_id = self.make_db_user(orcid=None)
+        self.assertFalse(utils.refresh_orcid(db_user))
+        self.assertIsNone(models.get_orcid_lookup(db_user.email))
@@ -12,6 +12,7 @@
 #    under the License.
 
 import datetime
+import functools
 import json
 import re
 from urllib import parse
@@ -23,6 +24,7 @@ from oslo_config import cfg
 from oslo_context import context
 from oslo_log import log as logging
 
+from manuka.common import status
 from manuka.extensions import db
 from manuka import models
 from manuka.worker import api as worker_api
@@ -81,11 +83,39 @@ class ShibbolethAttrMap(object):
 
 @login_bp.route('/account_status')
 def account_status():
-    external_id = db.session.query(models.ExternalId).filter_by(
-        persistent_id=session.get("shib_user_id")).first_or_404()
-
-    data = {"state": external_id.user.state}
-    return json.dumps(data)
+    """Return the state of the logged in user's account
+
+    With ?wait=N, wait up to N seconds (capped by
+    account_status_max_wait) for the account to be created before
+    answering. Once account_status_max_waiters requests are waiting,
+    answer at once; the page then falls back to polling.
+    """
+    persistent_id = session.get("shib_user_id")
+    wait = min(request.args.get('wait', 0, type=int),
+               CONF.account_status_max_wait)
+    if wait <= 0 or persistent_id is None:
+        return json.dumps({"state": _account_state(persistent_id)})
+
+    with status.get_waiter().watch(persistent_id) as created:
+        state = _account_state(persistent_id)
+        if (state != "created" and created is not None
+                and created.wait(wait)):
+            state = _account_state(persistent_id)
+    return json.dumps({"state": state})
+
+
+def _account_state(persistent_id):
+    state = status.state_cache.get(persistent_id)
+    if state is None:
+        state = db.session.query(models.User.state).join(
+            models.ExternalId, models.ExternalId.user_id == models.User.id
+        ).filter(models.ExternalId.persistent_id == persistent_id).scalar()
+        # Don't hold a transaction open while waiting
+        db.session.rollback()
+        if state is None:
+            flask.abort(404)
+        status.state_cache.set(persistent_id, state)
+    return state
 
 
 @login_bp.route('/', methods=('GET', 'POST'))
@@ -129,10 +159,24 @@ def root():
             "errors": error_values}
         return flask.render_template("error.html", **data)
 
+    # The whole login is one transaction. Anything that must see the
+    # committed user, such as the worker, is only told after the commit.
+    after_commit = []
+    response = _login(shib_attrs, after_commit)
+    db.session.commit()
+    status.state_cache.invalidate(shib_attrs["id"])
+    for func in after_commit:
+        func()
+    return response
+
+
+def _login(shib_attrs, after_commit):
     external_id = db.session.query(models.ExternalId).filter_by(
-        persistent_id=shib_attrs["id"]).first()
+        persistent_id=shib_attrs["id"]).options(
+            db.undefer(models.ExternalId.attributes)).first()
     if not external_id:
-        db_user, external_id = models.create_db_user(shib_attrs)
+        db_user, external_id = models.create_db_user(shib_attrs,
+                                                     commit=False)
     else:
         db_user = external_id.user
 
@@ -146,25 +190,25 @@ def root():
         db_user.terms_accepted_at = date_now
         db_user.state = "registered"
         db_user.terms_version = current_terms_version
-        models.update_db_user(db_user, external_id, shib_attrs)
-        db.session.commit()
+        models.update_db_user(db_user, external_id, shib_attrs,
+                              commit=False)
         # after registering present the user with a page indicating
         # there account is being created
         worker = worker_api.WorkerAPI()
         ctxt = context.RequestContext()
-        worker.create_user(ctxt, shib_attrs)
+        after_commit.append(functools.partial(worker.create_user, ctxt,
+                                              shib_attrs))
 
     if request.form.get("agree") and db_user.state == "created":
         # New terms version accepted
         db_user.terms_version = current_terms_version
         db_user.terms_accepted_at = datetime.datetime.now()
-        models.update_db_user(db_user, external_id, shib_attrs)
-        db.session.commit()
+        models.update_db_user(db_user, external_id, shib_attrs,
+                              commit=False)
 
     if request.form.get("ignore_username"):
         # Ignore different username
         db_user.ignore_username_not_email = True
-        db.session.commit()
 
     if db_user.terms_version != current_terms_version:
         data = {"title": "Terms and Conditions.",
@@ -215,16 +259,20 @@ def root():
             # useful error page...
             return flask.render_template("error.html", **data)
 
-    models.update_db_user(db_user, external_id, shib_attrs)
+    models.update_db_user(db_user, external_id, shib_attrs, commit=False)
 
     if user.name != user.email and not db_user.ignore_username_not_email:
         data = {"user": user}
         return flask.render_template("username_form.html", **data)
 
-    if not db_user.orcid:
+    # Users recently found to have no ORCID aren't searched for again
+    lookup = None if db_user.orcid else models.get_orcid_lookup(
+        db_user.email)
+    if not db_user.orcid and (lookup is None or lookup.found):
         worker = worker_api.WorkerAPI()
         ctxt = context.RequestContext()
-        worker.refresh_orcid(ctxt, db_user.id)
+        after_commit.append(functools.partial(worker.refresh_orcid, ctxt,
+                                              db_user.id))
 
     # sjjf: default to the configured target URL, but allow the source
     # to specify a different return-path. The specified return path is
@@ -58,7 +58,7 @@ class ConsumerService(cotyledon.Service):
             LOG.info('Shutting down endpoint worker executors...')
             for e in self.endpoints:
                 try:
-                    e.worker.executor.shutdown()
+                    e.manager.shutdown()
                 except AttributeError:
                     pass
         super(ConsumerService, self).terminate()
@@ -0,0 +1,175 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Run a graph of provisioning steps
+
+Steps that don't depend on each other run concurrently on a bounded
+thread pool. A step only starts once every step it requires has
+succeeded, and is skipped if any of them failed.
+"""
+
+from concurrent import futures
+import contextlib
+import time
+
+from oslo_log import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+class Step(object):
+    """A named unit of work
+
+    func is called with the results of the steps it requires as
+    keyword arguments, so step names must be valid identifiers.
+    """
+
+    def __init__(self, name, func, requires=()):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+
+    def __repr__(self):
+        return '<Step %s>' % self.name
+
+
+class StepsFailed(Exception):
+    """One or more steps failed
+
+    failures maps the name of each failed step to its exception,
+    skipped lists the steps that didn't run because a step they
+    required failed.
+    """
+
+    def __init__(self, failures, skipped, results, durations):
+        self.failures = failures
+        self.skipped = skipped
+        self.results = results
+        self.durations = durations
+        msg = "Steps failed: %s" % ', '.join(
+            '%s (%s)' % (name, e) for name, e in failures.items())
+        if skipped:
+            msg += "; skipped: %s" % ', '.join(skipped)
+        super(StepsFailed, self).__init__(msg)
+
+
+class StepResults(object):
+
+    def __init__(self, results, durations):
+        self.results = results
+        self.durations = durations
+
+    def __getitem__(self, name):
+        return self.results[name]
+
+
+def _sort(steps):
+    """Return steps in dependency order, checking the graph"""
+    by_name = {}
+    for step in steps:
+        if step.name in by_name:
+            raise ValueError("Duplicate step %s" % step.name)
+        by_name[step.name] = step
+    ordered = []
+    state = {}
+
+    def visit(step):
+        if state.get(step.name) == 'done':
+            return
+        if state.get(step.name) == 'visiting':
+            raise ValueError("Step %s depends on itself" % step.name)
+        state[step.name] = 'visiting'
+        for name in step.requires:
+            if name not in by_name:
+                raise ValueError("Step %s requires unknown step %s"
+                                 % (step.name, name))
+            visit(by_name[name])
+        state[step.name] = 'done'
+        ordered.append(step)
+
+    for step in steps:
+        visit(step)
+    return ordered
+
+
+class StepExecutor(object):
+    """Runs steps on a thread pool shared by every run
+
+    context is an optional factory for a context manager that each
+    step runs in, such as a Flask app's app_context.
+    """
+
+    def __init__(self, max_workers=8, context=None):
+        self._pool = futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='manuka-step')
+        self._context = context or contextlib.nullcontext
+
+    def _call(self, step, kwargs):
+        start = time.monotonic()
+        try:
+            with self._context():
+                result = step.func(**kwargs)
+        except Exception as e:
+            return None, e, time.monotonic() - start
+        return result, None, time.monotonic() - start
+
+    def run(self, steps, log_id=None):
+        """Run steps, returning a StepResults
+
+        Waits for every step that can run before raising StepsFailed
+        if any of them failed.
+        """
+        start = time.monotonic()
+        pending = _sort(steps)
+        results = {}
+        durations = {}
+        failures = {}
+        skipped = []
+        running = {}
+        while pending or running:
+            waiting = []
+            for step in pending:
+                if any(r in failures or r in skipped for r in step.requires):
+                    skipped.append(step.name)
+                elif all(r in results for r in step.requires):
+                    kwargs = {r: results[r] for r in step.requires}
+                    future = self._pool.submit(self._call, step, kwargs)
+                    running[future] = step
+                else:
+                    waiting.append(step)
+            pending = waiting
+            if not running:
+                continue
+            done, _ = futures.wait(running,
+                                   return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                step = running.pop(future)
+                result, error, duration = future.result()
+                durations[step.name] = duration
+                if error is None:
+                    results[step.name] = result
+                else:
+                    LOG.error("%s: Step %s failed after %.3fs", log_id,
+                              step.name, duration, exc_info=error)
+                    failures[step.name] = error
+
+        LOG.info("%s: Ran %d steps in %.3fs (%s)", log_id, len(durations),
+                 time.monotonic() - start,
+                 ', '.join('%s %.3fs' % d for d in durations.items()))
+        if failures:
+            raise StepsFailed(failures, skipped, results, durations)
+        return StepResults(results, durations)
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
@@ -11,22 +11,34 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import datetime
 import functools
 
 from oslo_config import cfg
+from oslo_context import context
 from oslo_log import log as logging
 
 from manuka import app
 from manuka.common import clients
 from manuka.common import keystone
+from manuka.common import retry
+from manuka.common import status
 from manuka.extensions import db
 from manuka import models
+from manuka.worker import api as worker_api
+from manuka.worker import executor
+from manuka.worker import pool
 from manuka.worker import utils
 
 
 CONF = cfg.CONF
 LOG = logging.getLogger(__name__)
 
+# Steps a project from the trial project pool has already been through
+POOLED_STEPS = ('security_groups', 'nova_quota', 'swift_quota')
+# Recorded once every step has completed
+FINISHED = 'finished'
+
 
 def app_context(f):
     @functools.wraps(f)
@@ -40,58 +52,214 @@ class Manager(object):
 
     def __init__(self):
         self.app = app.create_app(init_config=False)
+        self.pool = pool.TrialProjectPool()
+        # Steps use the database and templates, so run them in an app
+        # context of their own
+        self.executor = executor.StepExecutor(
+            CONF.worker.step_workers, context=self.app.app_context)
+        self.retries = retry.RetryScheduler(CONF.worker.retry_workers)
 
-    @app_context
-    def create_user(self, attrs):
-        k_session = keystone.KeystoneSession()
-        session = k_session.get_session()
-        client = clients.get_admin_keystoneclient(session)
+    def _retry(self, name, attempt, error, func, *args):
+        """Schedule func(*args, attempt=attempt + 1) after a backoff
+
+        Return False once the attempts are used up.
+        """
+        if attempt >= CONF.worker.retry_max_attempts:
+            LOG.error("%s failed after %d attempts: %s", name, attempt,
+                      error)
+            return False
+        delay = retry.backoff(attempt - 1, CONF.worker.retry_base_delay,
+                              CONF.worker.retry_max_delay)
+        LOG.warning("%s failed (%s), retrying in %.1fs", name, error, delay)
+        self.retries.schedule(delay, func, *args, attempt=attempt + 1)
+        return True
 
+    @app_context
+    def create_user(self, attrs, attempt=1):
         # get the user from the database, if this fails then they
         # shouldn't be created
         external_id = db.session.query(models.ExternalId).filter_by(
             persistent_id=attrs["id"]).first()
         db_user = external_id.user
 
+        record = models.acquire_provisioning_record(
+            db_user.id, CONF.worker.provisioning_lease)
+        if record is None:
+            self._wait_for_lease(attrs, db_user, attempt)
+            return
+        record_id = record.id
+        if record.is_complete(FINISHED):
+            LOG.info("Account for user %s is already created", db_user.id)
+            models.release_provisioning_record(record_id)
+            return
+        try:
+            self._provision(attrs, db_user, record)
+        except Exception as e:
+            db.session.rollback()
+            # Released before any retry is scheduled, so the retry
+            # can take the record
+            models.release_provisioning_record(record_id)
+            # Only the steps that didn't complete run again
+            retryable = isinstance(e, executor.StepsFailed) and all(
+                isinstance(error, retry.RetryLater)
+                for error in e.failures.values())
+            if not retryable or not self._retry(
+                    "Creating account for user %s" % db_user.id, attempt,
+                    e, self.create_user, attrs):
+                raise
+        else:
+            models.release_provisioning_record(record_id)
+
+    def _wait_for_lease(self, attrs, db_user, attempt):
+        """Try again once another worker's lease on the record ends
+
+        The worker holding the lease may have died, so the message
+        can't just be dropped unless the account is finished.
+        """
+        record = db.session.query(models.ProvisioningRecord).filter_by(
+            user_id=db_user.id).one()
+        if record.is_complete(FINISHED):
+            LOG.info("Account for user %s is already created", db_user.id)
+            return
+        delay = 0
+        if record.locked_until is not None:
+            delay = max(0, (record.locked_until
+                            - datetime.datetime.now()).total_seconds())
+        LOG.info("Account for user %s is being created by another worker, "
+                 "trying again in %.0fs", db_user.id, delay + 1)
+        self.retries.schedule(delay + 1, self.create_user, attrs,
+                              attempt=attempt)
+
+    def _provision(self, attrs, db_user, record):
+        """Create the account, skipping steps that are already done"""
+        session = keystone.get_shared_session().get_session()
+        client = clients.get_admin_keystoneclient(session)
+
+        if record.completed_steps:
+            LOG.info("Resuming account creation for user %s, completed "
+                     "steps: %s", db_user.id,
+                     ', '.join(record.completed_steps))
+
+        project = self._provision_project(client, attrs, db_user, record)
+        user = self._provision_user(client, attrs, project, record)
+
+        if not record.is_complete('roles'):
+            utils.add_user_roles(client, project=project, user=user,
+                                 roles=['Member'])
+            record.complete('roles')
+
+        if db_user.state != "created":
+            db_user.keystone_user_id = user.id
+            db_user.state = "created"
+            db.session.add(db_user)
+            db.session.commit()
+            status.notify_account_created(attrs["id"])
+        else:
+            db.session.commit()
+
+        def welcome_email():
+            utils.send_welcome_email(user, project)
+            LOG.info('Send welcome email to %s', user.email)
+
+        steps = [executor.Step('welcome_email', welcome_email)]
+        steps.extend(self._project_steps(session, user, project))
+        steps = [step for step in steps
+                 if not record.is_complete(step.name)]
+        try:
+            results = self.executor.run(steps, log_id=user.id).results
+        except executor.StepsFailed as e:
+            self._checkpoint(record, e.results)
+            raise
+        self._checkpoint(record, list(results) + [FINISHED])
+        LOG.info('%s: Completed Processing.', user.id)
+
+    def _provision_project(self, client, attrs, db_user, record):
+        if record.project_id:
+            return client.projects.get(record.project_id)
+
         idp = attrs.get('idp')
         domain = utils.get_domain_for_idp(idp)
         LOG.info("Using project domain_id=%s", domain)
-        project = utils.create_project(client, "pt-%s" % db_user.id,
-                                       "%s's project trial." %
-                                       attrs["fullname"],
-                                       domain)
-        LOG.info('Created Project %s', project.name)
+        name = "pt-%s" % db_user.id
+        description = "%s's project trial." % attrs["fullname"]
+        project = None
+        if self.pool.enabled_for(domain):
+            project = self.pool.claim(client, db_user, name, description)
+        if project is not None:
+            # Pooled projects already have their security groups and
+            # quotas
+            record.complete(*POOLED_STEPS)
+        else:
+            project = utils.create_project(client, name, description,
+                                           domain)
+            LOG.info('Created Project %s', project.name)
+        record.project_id = project.id
+        db.session.commit()
+        return project
+
+    def _provision_user(self, client, attrs, project, record):
+        if record.keystone_user_id:
+            return client.users.get(record.keystone_user_id)
 
         user = utils.create_user(client, attrs["mail"],
                                  attrs["mail"], project,
                                  attrs['fullname'])
         LOG.info('Created user %s', user.name)
+        record.keystone_user_id = user.id
+        db.session.commit()
+        return user
 
-        utils.add_user_roles(client, project=project, user=user,
-                             roles=['Member'])
-
-        db_user.keystone_user_id = user.id
-        db_user.state = "created"
-        db.session.add(db_user)
+    @staticmethod
+    def _checkpoint(record, results):
+        record.complete(*results)
         db.session.commit()
 
-        utils.send_welcome_email(user, project)
-        LOG.info('Send welcome email to %s', user.email)
+    def _project_steps(self, session, user, project):
+        """Steps to set up a new project, which don't depend on each other
+
+        They all use the admin session, so they don't need a token for
+        the new user.
+        """
+        def security_groups():
+            utils.add_project_security_groups(session, project.id)
+            LOG.info("%s: Added security groups.", user.id)
+
+        def nova_quota():
+            utils.set_nova_quota(session, project.id)
+            LOG.info("%s: Set nova quota", user.id)
 
-        token, project_id, updated_user = models.keystone_authenticate(
-            db_user, project_id=project.id)
+        steps = [executor.Step('security_groups', security_groups),
+                 executor.Step('nova_quota', nova_quota)]
 
-        utils.add_security_groups(user.id, project.id, token)
-        LOG.info("%s: Added security groups.", user.id)
-        utils.set_nova_quota(session, project.id)
-        LOG.info("%s: Set nova quota", user.id)
         swift_quota = CONF.swift.default_quota_gb
         if swift_quota is not None:
-            utils.set_swift_quota(session, project.id, swift_quota)
-            LOG.info("%s: Set swift quota to %sGB.", user.id, swift_quota)
-        LOG.info('%s: Completed Processing.', user.id)
+            def swift_quota_step():
+                utils.set_swift_quota(session, project.id, swift_quota)
+                LOG.info("%s: Set swift quota to %sGB.", user.id,
+                         swift_quota)
+            steps.append(executor.Step('swift_quota', swift_quota_step))
+        return steps
+
+    def shutdown(self):
+        """Stop the worker's thread pools
+
+        Pending retries are sent back to the queue, so they aren't lost
+        with this process.
+        """
+        pending = self.retries.shutdown()
+        if pending:
+            api = worker_api.WorkerAPI()
+            ctxt = context.RequestContext()
+            for call in pending:
+                LOG.info("Requeuing %s%s", call.func.__name__, call.args)
+                getattr(api, call.func.__name__)(ctxt, *call.args)
+        self.executor.shutdown()
 
     @app_context
-    def refresh_orcid(self, user_id):
+    def refresh_orcid(self, user_id, attempt=1):
         db_user = db.session.query(models.User).get(user_id)
-        utils.refresh_orcid(db_user)
+        try:
+            utils.refresh_orcid(db_user, retryable=True)
+        except retry.RetryLater as e:
+            self._retry("ORCID refresh for user %s" % user_id, attempt, e,
+                        self.refresh_orcid, user_id)
@@ -0,0 +1,173 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Pool of ready made trial projects
+
+Building a trial project (project, security groups and quotas) takes
+most of the time a new user waits for their account. The pool service
+builds projects ahead of time, so account creation only has to claim
+one and rename it for the user.
+"""
+
+import datetime
+import threading
+import uuid
+
+import cotyledon
+from oslo_config import cfg
+from oslo_log import log as logging
+import sqlalchemy
+
+from manuka import app
+from manuka.common import clients
+from manuka.common import keystone
+from manuka.extensions import db
+from manuka import models
+from manuka.worker import utils
+
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+POOL_PROJECT_PREFIX = 'pt-pool-'
+
+# How many unclaimed rows to try before giving up on a claim; another
+# worker may take each of them first
+CLAIM_ATTEMPTS = 5
+
+
+class TrialProjectPool(object):
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.built = 0
+
+    @staticmethod
+    def enabled_for(domain):
+        return CONF.trial_pool.size > 0 and domain == CONF.trial_pool.domain
+
+    def ready_count(self, domain):
+        return db.session.query(models.TrialProject).filter_by(
+            domain=domain, user_id=None).count()
+
+    def claim(self, client, db_user, name, description):
+        """Take a project from the pool for db_user
+
+        The project is renamed for the user. Return the Keystone
+        project or None if the pool is empty.
+        """
+        domain = CONF.trial_pool.domain
+        table = models.TrialProject.__table__
+        # An earlier attempt at creating the account may have claimed
+        # a project already
+        project_id = db.session.query(
+            models.TrialProject.project_id).filter_by(
+                user_id=db_user.id).scalar()
+        if project_id is not None:
+            return client.projects.update(project_id, name=name,
+                                          description=description)
+        candidates = db.session.query(
+            models.TrialProject.id, models.TrialProject.project_id
+        ).filter_by(domain=domain, user_id=None).order_by(
+            models.TrialProject.id).limit(CLAIM_ATTEMPTS).all()
+        for id, project_id in candidates:
+            # Only one worker's update can match the unclaimed row
+            result = db.session.execute(
+                table.update().where(sqlalchemy.and_(
+                    table.c.id == id, table.c.user_id.is_(None))).values(
+                        user_id=db_user.id,
+                        claimed_at=datetime.datetime.now()))
+            db.session.commit()
+            if result.rowcount == 1:
+                break
+        else:
+            self.misses += 1
+            LOG.info("Trial project pool empty (%d hits, %d misses)",
+                     self.hits, self.misses)
+            return None
+
+        project = client.projects.update(project_id, name=name,
+                                         description=description)
+        self.hits += 1
+        LOG.info("Claimed pooled project %s for user %s (%d hits, "
+                 "%d misses)", project_id, db_user.id, self.hits,
+                 self.misses)
+        return project
+
+    def build(self, client, session, domain):
+        """Build one trial project and add it to the pool"""
+        project = utils.create_project(
+            client, POOL_PROJECT_PREFIX + uuid.uuid4().hex,
+            "Pooled project trial.", domain)
+        try:
+            utils.add_project_security_groups(session, project.id)
+            utils.set_nova_quota(session, project.id)
+            swift_quota = CONF.swift.default_quota_gb
+            if swift_quota is not None:
+                utils.set_swift_quota(session, project.id, swift_quota)
+        except Exception:
+            LOG.exception("Failed to build pooled project %s", project.id)
+            client.projects.delete(project.id)
+            raise
+        db.session.add(models.TrialProject(project.id, domain))
+        db.session.commit()
+        self.built += 1
+        return project
+
+    def refill(self):
+        """Build up to refill_batch projects if the pool is short
+
+        Return the number of projects built.
+        """
+        domain = CONF.trial_pool.domain
+        wanted = min(CONF.trial_pool.size - self.ready_count(domain),
+                     CONF.trial_pool.refill_batch)
+        if wanted <= 0:
+            return 0
+        session = keystone.get_shared_session().get_session()
+        client = clients.get_admin_keystoneclient(session)
+        built = 0
+        for _ in range(wanted):
+            try:
+                self.build(client, session, domain)
+            except Exception:
+                break
+            built += 1
+        LOG.info("Added %d projects to the trial project pool", built)
+        return built
+
+
+class PoolService(cotyledon.Service):
+    """Keeps the trial project pool topped up"""
+
+    def __init__(self, worker_id, conf):
+        super(PoolService, self).__init__(worker_id)
+        self.conf = conf
+        self.pool = TrialProjectPool()
+        self._shutdown = threading.Event()
+
+    def run(self):
+        LOG.info('Starting trial project pool...')
+        self.app = app.create_app(init_config=False)
+        while not self._shutdown.is_set():
+            try:
+                with self.app.app_context():
+                    self.pool.refill()
+            except Exception:
+                LOG.exception("Failed to refill the trial project pool")
+            self._shutdown.wait(self.conf.trial_pool.refill_interval)
+
+    def terminate(self):
+        self._shutdown.set()
+        super(PoolService, self).terminate()
@@ -0,0 +1,123 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Security groups for new projects
+
+The groups and their ingress rules are defined in the [security_groups]
+config section. Provisioning lists the project's groups once, creates
+the groups that are missing and then adds every missing rule in a
+single bulk request, so it is also safe to repeat.
+"""
+
+import ipaddress
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+
+class SecurityGroupTemplate(object):
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.rules = []
+
+    def add_rule(self, protocol, port_range_min, port_range_max,
+                 remote_ip_prefix):
+        network = ipaddress.ip_network(remote_ip_prefix)
+        self.rules.append({
+            'direction': 'ingress',
+            'ethertype': 'IPv%d' % network.version,
+            'protocol': protocol,
+            'port_range_min': port_range_min,
+            'port_range_max': port_range_max,
+            'remote_ip_prefix': str(network),
+        })
+
+
+def _parse_ports(value):
+    if not value:
+        return None, None
+    low, _, high = value.partition('-')
+    return int(low), int(high or low)
+
+
+def load_templates():
+    """Return the SecurityGroupTemplates defined in config
+
+    Raise ValueError if the config is invalid.
+    """
+    templates = {}
+    for entry in CONF.security_groups.group:
+        name, sep, description = entry.partition(':')
+        if not sep or not name:
+            raise ValueError("Invalid security group %r, expected "
+                             "name:description" % entry)
+        templates[name] = SecurityGroupTemplate(name, description)
+    for entry in CONF.security_groups.rule:
+        # The prefix may be IPv6, so only split off the first 3 fields
+        parts = entry.split(':', 3)
+        if len(parts) != 4:
+            raise ValueError("Invalid security group rule %r, expected "
+                             "group:protocol:ports:remote_ip_prefix"
+                             % entry)
+        group, protocol, ports, prefix = parts
+        if group not in templates:
+            raise ValueError("Security group rule %r is for unknown "
+                             "group %s" % (entry, group))
+        port_min, port_max = _parse_ports(ports)
+        templates[group].add_rule(protocol or None, port_min, port_max,
+                                  prefix)
+    return list(templates.values())
+
+
+def _rule_key(rule):
+    return (rule.get('direction'), rule.get('ethertype'),
+            rule.get('protocol'), rule.get('port_range_min'),
+            rule.get('port_range_max'), rule.get('remote_ip_prefix'))
+
+
+def provision(conn, project_id, log_id=None):
+    """Add the configured security groups and rules to a project
+
+    Return the number of rules created.
+    """
+    templates = load_templates()
+    existing = {g.name: g for g in conn.network.security_groups(
+        project_id=project_id)}
+    rules = []
+    for template in templates:
+        group = existing.get(template.name)
+        if group is None:
+            group = conn.network.create_security_group(
+                name=template.name, description=template.description,
+                project_id=project_id)
+            current = set()
+        else:
+            current = {_rule_key(r)
+                       for r in group.security_group_rules or []}
+        for rule in template.rules:
+            if _rule_key(rule) not in current:
+                rules.append(dict(rule, security_group_id=group.id,
+                                  project_id=project_id))
+    if rules:
+        # The bulk create returns a generator, consuming it sends the
+        # request
+        list(conn.network.create_security_group_rules(rules))
+    LOG.info('%s: Added security groups %s (%d rules)', log_id,
+             ', '.join(t.name for t in templates), len(rules))
+    return len(rules)
@@ -14,15 +14,21 @@
 import base64
 import logging
 import os
-import time
 
 import flask
+from keystoneauth1 import exceptions as ks_exc
 from oslo_config import cfg
 from requests import exceptions
 
 from manuka.common import clients
 from manuka.common import email_utils
+from manuka.common import idp_domains
+from manuka.common import keystone_cache
+from manuka.common import orcid_client
+from manuka.common import retry
 from manuka.extensions import db
+from manuka import models
+from manuka.worker import security_groups
 
 
 CONF = cfg.CONF
@@ -30,99 +36,65 @@ LOG = logging.getLogger(__name__)
 
 
 def create_user(client, name, email, project=None, full_name=None):
-    """Add a new user"""
+    """Add a new user
+
+    If the user already exists with project as its default project
+    it was created by an earlier attempt and is returned.
+    """
     password = str(base64.encodestring(os.urandom(16))[:20], 'utf-8')
-    user = client.users.create(name=name,
-                               password=password,
-                               email=email,
-                               domain='default',
-                               default_project=project)
+    try:
+        user = client.users.create(name=name,
+                                   password=password,
+                                   email=email,
+                                   domain='default',
+                                   default_project=project)
+    except ks_exc.Conflict:
+        users = [u for u in client.users.list(name=name, domain='default')
+                 if project is not None
+                 and getattr(u, 'default_project_id', None) == project.id]
+        if not users:
+            raise
+        user = users[0]
+        LOG.info("Using existing user %s", user.id)
     return client.users.update(user.id, full_name=full_name)
 
 
 def create_project(client, name, description, domain='default'):
-    """Add a new project"""
-    return client.projects.create(name=name,
-                                  domain=domain,
-                                  description=description)
+    """Add a new project, or return the existing one of the same name"""
+    try:
+        return client.projects.create(name=name,
+                                      domain=domain,
+                                      description=description)
+    except ks_exc.Conflict:
+        projects = client.projects.list(name=name, domain=domain)
+        if not projects:
+            raise
+        LOG.info("Using existing project %s", projects[0].id)
+        return projects[0]
 
 
 def add_user_roles(client, user, project, roles=[]):
     """Add a roles for a particular user and project.
     """
     # add default role to user.
-    for role in get_roles(client, roles):
+    for role in keystone_cache.get_roles(client, roles):
         LOG.info('Adding role %s to user %s project %s',
                  role.name, user.name, project.name)
         client.roles.grant(user=user, role=role, project=project)
 
 
-def get_roles(client, role_names):
-    roles = []
-    role_list = client.roles.list()
-    LOG.debug('Roles %s', role_list)
+def get_domain_for_idp(idp):
+    return idp_domains.get_domain(idp)
 
-    for role in role_list:
-        LOG.debug('Testing role %s in %s', role.name, role_names)
-        if role.name in role_names:
-            roles.append(role)
-    return roles
 
+def add_project_security_groups(session, project_id):
+    """Add the security groups to a project as the admin user
 
-def get_domain_for_idp(idp):
-    try:
-        domains = os.listdir(CONF.idp_domain_mapping_dir)
-
-        for domain in domains:
-            try:
-                with open(os.path.join(
-                        CONF.idp_domain_mapping_dir, domain)) as f:
-                    idps = f.read().split('\n')
-                    if idp in idps:
-                        return domain
-            except IOError:
-                continue
-    except FileNotFoundError:
-        pass
-    return 'default'
-
-
-def add_security_groups(user_id, project_id, token):
-    """Add the security groups to the user's project.
-
-    Security groups that are added are:
-    HTTP - port 80/443
-    ICMP - all
-    SSH - port 22
+    Reuses the admin connection for session, and doesn't need a token
+    for the project.
     """
-    c = clients.get_openstack_client(project_id, token)
-
-    group = c.network.create_security_group(
-        name="icmp", description="Allow ICMP (eg. ping)")
-    c.network.create_security_group_rule(
-        security_group_id=group.id, protocol="icmp",
-        direction='ingress', remote_ip_prefix="0.0.0.0/0")
-    LOG.info('%s: Added Security Group ICMP.', user_id)
-
-    group = c.network.create_security_group(
-        name="ssh", description="Allow SSH")
-    c.network.create_security_group_rule(
-        security_group_id=group.id, protocol="tcp",
-        port_range_min=22, port_range_max=22,
-        direction='ingress', remote_ip_prefix="0.0.0.0/0")
-    LOG.info('%s: Added Security Group SSH.', user_id)
-
-    group = c.network.create_security_group(
-        name="http", description="Allow HTTP/S")
-    c.network.create_security_group_rule(
-        security_group_id=group.id, protocol="tcp",
-        port_range_min=80, port_range_max=80,
-        direction='ingress', remote_ip_prefix="0.0.0.0/0")
-    c.network.create_security_group_rule(
-        security_group_id=group.id, protocol="tcp",
-        port_range_min=443, port_range_max=443,
-        direction='ingress', remote_ip_prefix="0.0.0.0/0")
-    LOG.info('%s: Added Security Group HTTP.', user_id)
+    c = clients.get_admin_openstack_client(session)
+    security_groups.provision(c, project_id, log_id=project_id)
 
 
 def set_nova_quota(session, project_id):
@@ -134,23 +106,21 @@ def set_nova_quota(session, project_id):
 
 
 def set_swift_quota(session, project_id, quota_gb):
+    """Set the project's swift quota
+
+    Makes a single attempt; a failure raises RetryLater so the caller
+    can retry without holding a thread.
+    """
     SWIFT_QUOTA_KEY = 'x-account-meta-quota-bytes'
     sclient = clients.get_swift_client(session, project_id=project_id)
     quota_bytes = quota_gb * 1024 * 1024 * 1024
-
-    attempt = 1
-    max_attempts = 10
-    while attempt <= max_attempts:
-        try:
-            sclient.post_account(headers={SWIFT_QUOTA_KEY: quota_bytes})
-        except Exception:
-            LOG.warn("Failed to set swift quota,"
-                     + " retying, attempt %s", attempt)
-            time.sleep(attempt * 2)
-            attempt += 1
-            continue
-        return
-    LOG.error("Failed to set swift quota for project %s", project_id)
+    try:
+        sclient.post_account(headers={SWIFT_QUOTA_KEY: quota_bytes})
+    except Exception as e:
+        LOG.warning("Failed to set swift quota for project %s: %s",
+                    project_id, e)
+        raise retry.RetryLater(
+            "Failed to set swift quota for project %s" % project_id) from e
 
 
 def send_welcome_email(user, project):
@@ -167,18 +137,49 @@ def send_welcome_email(user, project):
                            CONF.smtp.host, html)
 
 
-def refresh_orcid(db_user):
-    client = clients.get_orcid_client()
-    try:
-        orcid = client.search_by_email(db_user.email)
-    except exceptions.HTTPError as e:
-        LOG.error("Orcid refresh failed for user <User %s> (%s): url = %s",
-                  db_user.id,
-                  e.response.status_code,
-                  e.request.url)
-        LOG.exception(e)
-        return False
+def refresh_orcid(db_user, retryable=False, force=False):
+    """Look up and store the user's ORCID
+
+    A recent search for the user's email is reused from the lookup
+    cache unless force is True.
 
+    With retryable=True the ORCID client doesn't retry itself and a
+    transient error raises RetryLater instead.
+    """
+    lookup = None if force else models.get_orcid_lookup(db_user.email)
+    if lookup is not None:
+        LOG.debug("Using cached ORCID search for <User %s>", db_user.id)
+        orcid = lookup.orcid
+    else:
+        client = clients.get_orcid_client()
+        try:
+            if retryable:
+                orcid = client.search_by_email(db_user.email, max_retries=0)
+            else:
+                orcid = client.search_by_email(db_user.email)
+        except exceptions.HTTPError as e:
+            if retryable and orcid_client.is_transient(e):
+                raise retry.RetryLater(
+                    "ORCID search failed for <User %s> (%s)"
+                    % (db_user.id, e.response.status_code)) from e
+            LOG.error("Orcid refresh failed for user <User %s> (%s): "
+                      "url = %s",
+                      db_user.id,
+                      e.response.status_code,
+                      e.request.url)
+            LOG.exception(e)
+            return False
+        models.record_orcid_lookup(db_user.email, orcid)
+
+    update_orcid(db_user, orcid)
+    return True
+
+
+def update_orcid(db_user, orcid, commit=True):
+    """Store the ORCID found for the user
+
+    Return True if the user's ORCID changed.
+    """
     if orcid and orcid != db_user.orcid:
         if db_user.orcid:
             LOG.info("Changing orcid for <User %s>: %s -> %s",
@@ -187,10 +188,12 @@ def refresh_orcid(db_user):
             LOG.info("Adding orcid for <User %s>: %s", db_user.id, orcid)
         db_user.orcid = orcid
         db.session.add(db_user)
-        db.session.commit()
+        if commit:
+            db.session.commit()
+        return True
     elif orcid:
         LOG.info("Orcid has not changed for <User %s>: %s",
                  db_user.id, orcid)
     else:
         LOG.info("No orcid found for <User %s>", db_user.id)
-    return True
+    return False
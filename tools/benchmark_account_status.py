@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Measure /login/account_status requests per second
+
+Compares the original full ExternalId + User load, the column only
+query and the column only query with its cache, against an in-memory
+SQLite database.
+
+Usage: python tools/benchmark_account_status.py [--users N] [--requests N]
+"""
+
+import argparse
+import json
+import time
+from unittest import mock
+
+from oslo_config import cfg
+
+from manuka import app
+from manuka.extensions import db
+from manuka import models
+from manuka import views
+
+
+CONF = cfg.CONF
+
+
+def legacy_account_state(persistent_id):
+    external_id = db.session.query(models.ExternalId).filter_by(
+        persistent_id=persistent_id).first_or_404()
+    return external_id.user.state
+
+
+def populate(count):
+    for i in range(count):
+        user = models.User()
+        user.email = 'user%d@example.com' % i
+        user.displayname = 'User %d' % i
+        user.state = 'registered'
+        external_id = models.ExternalId(user, 'pid%d' % i,
+                                        {'mail': user.email, 'id': i})
+        db.session.add(user)
+        db.session.add(external_id)
+    db.session.commit()
+
+
+def run(application, users, requests):
+    client = application.test_client()
+    start = time.perf_counter()
+    for i in range(requests):
+        with client.session_transaction() as sess:
+            sess['shib_user_id'] = 'pid%d' % (i % users)
+        response = client.get('/login/account_status')
+        assert json.loads(response.get_data())['state'] == 'registered'
+    return requests / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    application = app.create_app({
+        'SECRET_KEY': 'secret',
+        'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+    }, conf_file='manuka/tests/etc/manuka.conf')
+    CONF.set_override('debug', False)
+    with application.app_context():
+        db.create_all()
+        populate(args.users)
+
+    with mock.patch.object(views, '_account_state', legacy_account_state):
+        before = run(application, args.users, args.requests)
+    CONF.set_override('account_status_cache_ttl', 0)
+    uncached = run(application, args.users, args.requests)
+    CONF.clear_override('account_status_cache_ttl')
+    cached = run(application, args.users, args.requests)
+
+    print("full load          %8.0f req/s" % before)
+    print("column only        %8.0f req/s  x%.2f" % (uncached,
+                                                    uncached / before))
+    print("column only cached %8.0f req/s  x%.2f" % (cached, cached / before))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Compare marshmallow and precompiled serialization of users
+
+Usage: python tools/benchmark_serializers.py [--users N] [--repeat N]
+"""
+
+import argparse
+import datetime
+import time
+
+from manuka.api.v1.schemas import compiled
+from manuka.api.v1.schemas import user as schemas
+from manuka import models
+
+
+def make_users(count):
+    now = datetime.datetime(2024, 1, 1)
+    users = []
+    for i in range(count):
+        user = models.User()
+        user.id = i
+        user.keystone_user_id = 'ks%d' % i
+        user.email = 'user%d@example.com' % i
+        user.displayname = 'User %d' % i
+        user.state = 'created'
+        user.registered_at = user.last_login = now
+        user.terms_accepted_at = now
+        user.terms_version = 'v1'
+        user.orcid = None if i % 3 else '0000-0000-0000-%04d' % (i % 10000)
+        user.affiliation = 'member'
+        user.ignore_username_not_email = False
+        user.expiry_next_step = now.date()
+        external_id = models.ExternalId(user, 'pid%d' % i,
+                                        {'mail': user.email})
+        external_id.id = i
+        external_id.idp = 'https://idp.example.com'
+        external_id.last_login = now
+        users.append(user)
+    return users
+
+
+def timeit(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    users = make_users(args.users)
+    for name, schema in (('UserSchema', schemas.users),
+                         ('PendingUserSchema', schemas.pending_users)):
+        slow, expected = timeit(lambda: schema.dump(users), args.repeat)
+        fast, result = timeit(lambda: compiled.dump(schema, users),
+                              args.repeat)
+        assert result == expected, "%s output differs" % name
+        print("%-18s marshmallow %7.1f ms  compiled %7.1f ms  x%.1f"
+              % (name, slow * 1000, fast * 1000, slow / fast))
+
+
+if __name__ == '__main__':
+    main()